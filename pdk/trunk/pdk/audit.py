@@ -26,12 +26,14 @@ cache Part of the PDK suite
 """
 __revision__ = '$Progeny$'
 
+import os
 from sets import Set
-import sha
-import md5
+from cPickle import Pickler, Unpickler, UnpicklingError
 import pdk.workspace as workspace
 from pdk.component import ComponentDescriptor
 from pdk.command_base import make_invokable
+from pdk.cache import calculate_checksums
+from pdk.util import pjoin, ensure_directory_exists, parallel_map
 import pdk.log as log
 from pdk.exceptions import IntegrityFault
 audit_logger = log.get_logger()
@@ -42,6 +44,10 @@ def audit(args):
 .PP
 Load the component,
 and verify that it and it's parts are well-formed.
+.PP
+Cache files whose checksums were verified by an earlier audit, and
+which have not changed since, are not read again unless --full is
+given. With --jobs, files are checksummed by several processes.
     """
     ##specialization code starts here
 
@@ -61,7 +67,8 @@ and verify that it and it's parts are well-formed.
 
     note_problem.called = False
 
-    my_cache = workspace.current_workspace().cache
+    ws = workspace.current_workspace()
+    my_cache = ws.cache
     arbiter = Arbiter(note_problem)
 
     for component_name in args.args:
@@ -109,6 +116,8 @@ and verify that it and it's parts are well-formed.
         if blob_id.endswith('.header'):
             arbiter.warrant(InCache(blob_id), True, 'cache')
             continue
+        if my_cache.is_metadata(blob_id):
+            continue
 
         entry = found_by_inode.setdefault(inode, Set([]))
         entry.add(blob_id)
@@ -117,35 +126,26 @@ and verify that it and it's parts are well-formed.
         for blob_id in found_by_inode[inode]:
             arbiter.predict(ChecksumMatches(blob_id), blob_id, 'cache')
 
+    ledger = AuditLedger(pjoin(ws.location, 'etc', 'audit-ledger'),
+                         not args.opts.full)
+    checksums = verify_inodes(my_cache, found_by_inode, ledger,
+                              args.opts.jobs)
+
     for inode, blob_ids in found_by_inode.iteritems():
         for blob_id in blob_ids:
             arbiter.warrant(InCache(blob_id), True, 'cache')
 
         # warrant cache checksums
-        one_id = tuple(blob_ids)[0]
-        handle = open(my_cache.file_path(one_id))
-        sha1_digest = sha.new()
-        md5_digest = md5.new()
-        read_size = 8196
-        while 1:
-            block = handle.read(read_size)
-            if not block:
-                break
-            sha1_digest.update(block)
-            md5_digest.update(block)
-        handle.close()
+        sha1_id, md5_id = checksums[inode]
 
         prefixes = []
         for blob_id in blob_ids:
             if blob_id.startswith('sha-1'):
                 prefixes.append('sha-1')
-                arbiter.warrant(ChecksumMatches(blob_id),
-                                'sha-1:' + sha1_digest.hexdigest(),
-                                'cache')
+                arbiter.warrant(ChecksumMatches(blob_id), sha1_id, 'cache')
             elif blob_id.startswith('md5'):
                 prefixes.append('md5')
-                arbiter.warrant(ChecksumMatches(blob_id),
-                                'md5:' + md5_digest.hexdigest(), 'cache')
+                arbiter.warrant(ChecksumMatches(blob_id), md5_id, 'cache')
             else:
                 # note unknown prefixes
                 arbiter.note_problem(
@@ -155,7 +155,7 @@ and verify that it and it's parts are well-formed.
                     )
         prefixes.sort()
         if prefixes != ['md5', 'sha-1']:
-            digests = (md5_digest.hexdigest(), sha1_digest.hexdigest())
+            digests = (md5_id[len('md5:'):], sha1_id[len('sha-1:'):])
             arbiter.note_problem(tuple(blob_ids), digests,
                                  'not hard linked properly')
 
@@ -164,7 +164,92 @@ and verify that it and it's parts are well-formed.
     if note_problem.called:
         raise IntegrityFault, "Audit detected fault(s)"
 
-audit = make_invokable(audit)
+audit = make_invokable(audit, 'full', 'jobs')
+
+# Files checksummed between checkpoints of the ledger, per worker.
+files_per_round = 64
+
+def verify_inodes(cache, found_by_inode, ledger, workers = 1):
+    """Return { inode: (sha1 blob_id, md5 blob_id) } for cache files.
+
+    found_by_inode is { inode: blob_ids linked to the inode }
+
+    Files the ledger already knows are not read. The rest are
+    checksummed by workers processes, a round at a time, and the
+    ledger is written after each round so that an interrupted audit
+    can resume where it left off.
+    """
+    checksums = {}
+    pending = []
+    for inode, blob_ids in found_by_inode.iteritems():
+        path = cache.file_path(tuple(blob_ids)[0])
+        stat_key = AuditLedger.get_stat_key(os.stat(path))
+        entry = ledger.get(stat_key)
+        if entry:
+            checksums[inode] = entry
+        else:
+            pending.append((stat_key, path))
+    pending.sort()
+
+    round_size = files_per_round * max(workers, 1)
+    for start in range(0, len(pending), round_size):
+        work = pending[start:start + round_size]
+        results = parallel_map(calculate_checksums,
+                               [ path for dummy, path in work ], workers)
+        for (stat_key, dummy), result in zip(work, results):
+            ledger.set(stat_key, result)
+            checksums[stat_key[0]] = result
+        ledger.write()
+    ledger.write()
+    return checksums
+
+class AuditLedger(object):
+    """Remember the checksums of cache files verified by audits.
+
+    filename - where the ledger is stored.
+    trusted - use the entries stored in the ledger. If false, the
+              ledger is only written.
+
+    Entries are keyed by inode, size, mtime and ctime, so any change
+    to a file makes its entry stale. Only entries used or set since
+    the ledger was loaded are written back.
+    """
+    def __init__(self, filename, trusted = True):
+        self.filename = filename
+        self.old_entries = {}
+        self.entries = {}
+        if trusted and os.path.exists(filename):
+            try:
+                self.old_entries = Unpickler(open(filename)).load()
+            except (EOFError, UnpicklingError, ValueError):
+                audit_logger.warn('Ignoring corrupt audit ledger %s'
+                                  % filename)
+
+    def get_stat_key(stats):
+        """Return the validity key for a file from its stat result."""
+        return (stats.st_ino, stats.st_size, stats.st_mtime,
+                stats.st_ctime)
+    get_stat_key = staticmethod(get_stat_key)
+
+    def get(self, stat_key):
+        """Return the checksums for stat_key, or None if unknown."""
+        entry = self.old_entries.get(stat_key)
+        if entry:
+            self.entries[stat_key] = entry
+        return entry
+
+    def set(self, stat_key, checksums):
+        """Note the checksums found for a file."""
+        self.entries[stat_key] = checksums
+
+    def write(self):
+        """Store the entries used or set since loading."""
+        ensure_directory_exists(os.path.dirname(self.filename))
+        new_filename = self.filename + '.new'
+        handle = open(new_filename, 'w')
+        Pickler(handle, 2).dump(self.entries)
+        handle.close()
+        os.rename(new_filename, self.filename)
 
 def string_together(fields, separator):
     """Stringify fields and join them with separator.
@@ -27,7 +27,16 @@ when referenced by component descriptors.
 Cache is indexed by 'blob', which is currently an sha1
 checksum.
 
-Cache contains .header files.
+Cache contains .header files, .checksums records listing all the
+blob_ids of a blob, and .stanza-* files holding rendered apt stanzas.
+
+Package headers may also be collected into .header-pack, see
+HeaderPack.
+
+The blob_ids present are listed in .blob-index, so membership tests
+don't need to touch the filesystem. Blobs are kept under one or more
+directory levels named by leading hex digits of their checksum, as
+recorded in .layout.
 """
 
 __revision__ = "$Progeny$"
@@ -36,17 +45,23 @@ import os
 import os.path
 import stat
 import re
-from stat import ST_INO, ST_SIZE
+import errno
+import mmap
+import fcntl
+from stat import ST_INO, ST_SIZE, ST_DEV
+from sets import Set
 import sha
 import md5
 import gzip
 import pycurl
-from shutil import copy2
+from shutil import copy2, copystat
 from urlparse import urlparse
 from tempfile import mkstemp
 from pdk.package import get_package_type
-from pdk.util import ensure_directory_exists, make_path_to, get_remote_file
-from pdk.exceptions import SemanticError, ConfigurationError
+from pdk.util import ensure_directory_exists, make_path_to, \
+     get_remote_file, MultiDownloader, LazyWriter, gen_file_fragments, \
+     parallel_map
+from pdk.exceptions import SemanticError, ConfigurationError, InputError
 
 # Debugging aids
 import pdk.log
@@ -57,7 +72,7 @@ def calculate_checksums(file_path):
     """Calculate both sha-1 and md5 checksums for a file, returned
     as blob_ids
     """
-    readsize = (1024 * 16)
+    readsize = (1024 * 1024)
     md5_calc = md5.new()
     sha1_calc = sha.new()
     input_file = open(file_path)
@@ -71,10 +86,164 @@ def calculate_checksums(file_path):
     return 'sha-1:' + sha1_calc.hexdigest(), \
            'md5:' + md5_calc.hexdigest()
 
+# Files kept in the cache alongside the blobs they describe.
+metadata_pattern = re.compile(r'\.(header|checksums|stanza-[0-9a-f]+)$')
+
+blob_id_pattern = re.compile(r'(sha-1|md5):[a-fA-F0-9]+$')
+
+class ChecksumWriter(object):
+    """Write to a file handle while calculating sha-1 and md5 checksums.
+
+    This lets a blob be checksummed while its bytes arrive instead of
+    reading the whole file back after it has been written.
+    """
+    def __init__(self, handle):
+        self.handle = handle
+        self.name = handle.name
+        self.md5_calc = md5.new()
+        self.sha1_calc = sha.new()
+
+    def write(self, block):
+        """Checksum the block and pass it on to the handle."""
+        self.md5_calc.update(block)
+        self.sha1_calc.update(block)
+        self.handle.write(block)
+
+    def close(self):
+        """Close the underlying handle."""
+        self.handle.close()
+
+    def get_blob_ids(self):
+        """Return the sha-1 and md5 blob_ids of the data written so far.
+        """
+        return 'sha-1:' + self.sha1_calc.hexdigest(), \
+               'md5:' + self.md5_calc.hexdigest()
+
 class CacheImportError(SemanticError):
     """Generic error for trouble importing to cache"""
     pass
 
+class BlobIndex(object):
+    """The set of blob_ids present in a cache, kept in a file.
+
+    The file holds one blob_id per line. rebuild sorts it, and
+    blob_ids added later are appended. The set is read into memory the
+    first time it is needed. If the file is missing, it is rebuilt.
+
+    The index is authoritative: blobs are only present if they are
+    listed. Appends and rebuilds are serialized with a lock on a file
+    beside the index, and a rebuild finds the blob_ids while holding
+    it, so a blob added during a rebuild is not lost. Files added to
+    or removed from the cache behind its back are only noticed by the
+    next rebuild.
+    """
+    def __init__(self, filename, find_blob_ids):
+        self.filename = filename
+        self.lock_filename = filename + '.lock'
+        self.find_blob_ids = find_blob_ids
+        self.blob_ids = None
+
+    def lock(self):
+        """Take the index lock, returning a handle to pass to unlock.
+
+        A cache we can't write to is not locked, and None is returned.
+        """
+        try:
+            handle = open(self.lock_filename, 'a')
+        except IOError, error:
+            if error.errno not in (errno.EACCES, errno.EROFS,
+                                   errno.ENOENT):
+                raise
+            return None
+        fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+        return handle
+
+    def unlock(self, handle):
+        """Release a lock taken by lock."""
+        if handle is not None:
+            handle.close()
+
+    def load(self):
+        """Return the set of blob_ids, reading the file if needed."""
+        if self.blob_ids is None:
+            try:
+                handle = open(self.filename)
+            except IOError, error:
+                if error.errno != errno.ENOENT:
+                    raise
+                self.rebuild()
+            else:
+                self.blob_ids = Set(handle.read().split())
+                handle.close()
+        return self.blob_ids
+
+    def __contains__(self, blob_id):
+        return blob_id in self.load()
+
+    def __iter__(self):
+        blob_ids = list(self.load())
+        blob_ids.sort()
+        return iter(blob_ids)
+
+    def add(self, blob_ids):
+        """Note blob_ids which were just added to the cache.
+
+        The file is not rebuilt here if it is missing.
+        """
+        if self.blob_ids is not None:
+            self.blob_ids.update(blob_ids)
+        lock = self.lock()
+        try:
+            if os.path.exists(self.filename):
+                text = ''.join([ blob_id + '\n' for blob_id in blob_ids ])
+                try:
+                    handle = open(self.filename, 'a')
+                    handle.write(text)
+                    handle.close()
+                except IOError, error:
+                    if error.errno not in (errno.EACCES, errno.EROFS):
+                        raise
+        finally:
+            self.unlock(lock)
+
+    def rebuild(self):
+        """Replace the index with the blob_ids found in the cache.
+
+        Returns the blob_ids found. A cache we can't write to keeps the
+        index in memory only.
+        """
+        lock = self.lock()
+        try:
+            blob_ids = self.find_blob_ids()
+            self.write(blob_ids)
+        finally:
+            self.unlock(lock)
+        return blob_ids
+
+    def write(self, blob_ids):
+        """Replace the index with the given blob_ids.
+
+        The caller should hold the index lock.
+        """
+        self.blob_ids = Set(blob_ids)
+        sorted_ids = list(self.blob_ids)
+        sorted_ids.sort()
+        temp_filename = '%s.%d' % (self.filename, os.getpid())
+        try:
+            try:
+                handle = open(temp_filename, 'w')
+                handle.write(''.join([ blob_id + '\n'
+                                       for blob_id in sorted_ids ]))
+                handle.close()
+                os.rename(temp_filename, self.filename)
+            except (IOError, OSError), error:
+                if error.errno not in (errno.EACCES, errno.EROFS,
+                                       errno.ENOENT):
+                    raise
+        finally:
+            if os.path.exists(temp_filename):
+                os.unlink(temp_filename)
+
 ########################################################################
 class SimpleCache(object):
     """A moderately dumb data structure representing a physical cache
@@ -97,6 +266,24 @@ class SimpleCache(object):
             self.backing = SimpleCache(backing_path)
         else:
             self.backing = None
+        self.levels = self.read_layout()
+        self.blob_index = BlobIndex(os.path.join(self.path, '.blob-index'),
+                                    self.find_blob_ids)
+
+    def get_layout_filename(self):
+        """Return the path to the file recording the directory levels.
+        """
+        return os.path.join(self.path, '.layout')
+
+    def read_layout(self):
+        """Return the number of directory levels blobs are kept under.
+        """
+        try:
+            return int(open(self.get_layout_filename()).read())
+        except IOError, error:
+            if error.errno == errno.ENOENT:
+                return 1
+            raise
 
     def make_relative_filename(self, filename):
         """Calculate where the file should exist within the cache"""
@@ -105,7 +292,9 @@ class SimpleCache(object):
         if ':' in filename:
             # md5 or sha-1 sum
             scheme, name = filename.split(':')
-            dirpath = os.path.join(scheme, name[:2])
+            parts = [ scheme ] + [ name[2 * level:2 * level + 2]
+                                   for level in range(self.levels) ]
+            dirpath = os.path.join(*parts)
         # Note: else path is just ./filename
         return os.path.join(dirpath, filename)
 
@@ -117,9 +306,16 @@ class SimpleCache(object):
             )
 
     def __contains__(self, filepath):
-        """Determine if the cache already contains a file"""
+        """Determine if the cache already contains a file
+
+        Blobs are looked up in the blob index only. Anything else is
+        looked for on disk.
+        """
         result = False
-        if filepath and not os.path.basename(filepath).startswith('.'):
+        filename = os.path.basename(filepath or '')
+        if filename and not filename.startswith('.'):
+            if blob_id_pattern.match(filename):
+                return filename in self.blob_index
             local_path =  self.file_path(filepath)
             result = os.path.exists(local_path)
         return result
@@ -145,7 +341,7 @@ class SimpleCache(object):
                     break
                 blob_id = first
                 local_filename = self.make_download_filename()
-                handle = open(local_filename, 'w')
+                handle = ChecksumWriter(open(local_filename, 'w'))
 
                 progress = mass_progress.get_single_progress(blob_id)
                 total = mass_progress.get_size(blob_id)
@@ -161,7 +357,8 @@ class SimpleCache(object):
                 framer.assert_end_of_stream()
                 if mtime != -1:
                     os.utime(local_filename, (mtime, mtime))
-                self.incorporate_file(local_filename, blob_id)
+                self.incorporate_file(local_filename, blob_id,
+                                      handle.get_blob_ids())
                 mass_progress.note_finished(blob_id)
                 mass_progress.write_progress()
             finally:
@@ -188,47 +385,135 @@ class SimpleCache(object):
                 source_file = parts[2]
                 try:
                     progress.start()
-                    copy2(source_file, local_filename)
+                    blob_ids = self._copy_local_file(source_file,
+                                                     local_filename)
                     progress.done()
-                    self.umask_permissions(local_filename)
-
-                except IOError, e:
+                except (IOError, OSError), e:
                     if e.errno == 2 and os.path.exists(local_filename):
                         raise CacheImportError('%s not found' % full_url)
                     else:
                         raise
             else:
+                handle = ChecksumWriter(LazyWriter(local_filename))
                 try:
                     get_remote_file(full_url, local_filename,
-                                    progress = progress)
+                                    progress = progress,
+                                    handle = handle)
                 except pycurl.error, msg:
                     raise CacheImportError('%s, %s' % (msg, full_url))
-            self.incorporate_file(local_filename, locator.blob_id)
+                blob_ids = handle.get_blob_ids()
+            self.incorporate_file(local_filename, locator.blob_id,
+                                  blob_ids)
             mass_progress.note_finished(locator.blob_id)
             mass_progress.write_progress()
         finally:
             if os.path.exists(local_filename):
                 os.unlink(local_filename)
 
+    def import_files(self, locators, mass_progress, max_connections = None):
+        '''Download and incorporate many potentially remote sources.
+
+        locators - FileLocators; blobs already in the cache are skipped.
+        max_connections - concurrent download limit, see MultiDownloader.
+
+        Remote files are downloaded concurrently. Local files are
+        imported one at a time via import_file. Each file is verified
+        and incorporated as soon as its download finishes.
+        '''
+        downloader = MultiDownloader(max_connections)
+        partial_filenames = []
+
+        def _incorporate(locator, handle):
+            '''Return a callback which incorporates a finished download.
+            '''
+            def _callback(full_url, local_filename, error):
+                '''Verify and incorporate a downloaded file.'''
+                if error is not None:
+                    raise CacheImportError('%s, %s' % (error, full_url))
+                self.incorporate_file(local_filename, locator.blob_id,
+                                      handle.get_blob_ids())
+                os.unlink(local_filename)
+                mass_progress.note_finished(locator.blob_id)
+                mass_progress.write_progress()
+            return _callback
+
+        try:
+            queued = {}
+            for locator in locators:
+                if locator.blob_id in self or locator.blob_id in queued:
+                    continue
+                full_url = locator.get_full_url()
+                scheme = urlparse(full_url)[0]
+                if scheme in ('file', ''):
+                    self.import_file(locator, mass_progress)
+                    continue
+                local_filename = self.make_download_filename()
+                partial_filenames.append(local_filename)
+                queued[locator.blob_id] = None
+                handle = ChecksumWriter(LazyWriter(local_filename))
+                downloader.add(full_url, local_filename,
+                               _incorporate(locator, handle), handle)
+            downloader.run()
+        finally:
+            for local_filename in partial_filenames:
+                if os.path.exists(local_filename):
+                    os.unlink(local_filename)
+
+    def _copy_local_file(self, source_file, local_filename):
+        '''Bring a local file into the cache under local_filename.
+
+        When the source is on the same filesystem as the cache it is
+        hard linked, and None is returned as nothing has been read yet.
+        Otherwise it is copied, and the blob_ids calculated during the
+        copy are returned.
+        '''
+        if os.stat(source_file)[ST_DEV] == os.stat(self.path)[ST_DEV]:
+            os.unlink(local_filename)
+            try:
+                os.link(source_file, local_filename)
+                return None
+            except OSError:
+                # Some filesystems can't hard link. Copy instead.
+                pass
+
+        handle = ChecksumWriter(open(local_filename, 'w'))
+        try:
+            for block in gen_file_fragments(source_file):
+                handle.write(block)
+        finally:
+            handle.close()
+        copystat(source_file, local_filename)
+        self.umask_permissions(local_filename)
+        return handle.get_blob_ids()
+
     def _add_links(self, source, blob_ids):
         '''Create visible links to the blob contained in source.
 
         Assume the blob_ids are correct.
+
+        The links are made directly to source. If source is on another
+        filesystem (as a backing cache may be) it is copied once into
+        this cache first.
         '''
-        seed = self.make_download_filename()
+        seed = None
         try:
-            # optimization opportunity
-            # we could attempt linking directly from source
-            # to visible link to save on a copy here.
-            copy2(source, seed)
             for blob_id in blob_ids:
                 filename = self.file_path(blob_id)
                 if os.path.exists(filename):
                     continue
                 make_path_to(filename)
-                os.link(seed, filename)
+                try:
+                    os.link(source, filename)
+                except OSError, error:
+                    if seed or error.errno != errno.EXDEV:
+                        raise
+                    seed = self.make_download_filename()
+                    copy2(source, seed)
+                    source = seed
+                    os.link(source, filename)
         finally:
-            os.unlink(seed)
+            if seed:
+                os.unlink(seed)
 
     def umask_permissions(self, filename):
         '''Set the filename permissions according to umask.'''
@@ -252,16 +537,22 @@ class SimpleCache(object):
 
         return temp_fname
 
-    def incorporate_file(self, filepath, blob_id):
+    def incorporate_file(self, filepath, blob_id, blob_ids = None):
         """Places a temp file in its final cache location,
         by md5 and sha1, and unlinks the original filepath.
+
+        Pass blob_ids when the checksums were already calculated while
+        the file was written (see ChecksumWriter); otherwise the file is
+        read to calculate them.
         """
         # Link it according to the given blob ids - note: does
         # not affect backing cache
         if self.backing:
-            blob_ids = self.backing.incorporate_file(filepath, blob_id)
+            blob_ids = self.backing.incorporate_file(filepath, blob_id,
+                                                     blob_ids)
         else:
-            blob_ids = calculate_checksums(filepath)
+            if blob_ids is None:
+                blob_ids = calculate_checksums(filepath)
             if blob_id:
                 if not blob_id in blob_ids:
                     message = 'Checksum mismatch: %s vs. %s.' \
@@ -269,13 +560,84 @@ class SimpleCache(object):
                     raise CacheImportError(message)
 
         self._add_links(filepath, blob_ids)
+        self.add_checksums(blob_ids)
+        self.blob_index.add(blob_ids)
+        return blob_ids
+
+    def is_metadata(self, filename):
+        """Is filename a file describing a blob, rather than a blob?"""
+        return bool(metadata_pattern.search(filename))
+
+    def _add_metadata(self, text, filename):
+        """Write a metadata file unless it is already present."""
+        # Always start with a temp file
+        temp_path = self.make_download_filename()
+        try:
+            # Fill it.
+            open(temp_path, 'w').write(text)
+            # Link it to the final name.
+            make_path_to(filename)
+            try:
+                os.link(temp_path, filename)
+            except OSError, msg:
+                # file exists
+                if msg.errno == 17:
+                    pass
+                else:
+                    raise
+        finally:
+            # Get rid of the temp file
+            os.unlink(temp_path)
+
+    def get_checksums_filename(self, blob_id):
+        "Return the filename of a blob's .checksums record"
+        return self.file_path(blob_id) + '.checksums'
+
+    def add_checksums(self, blob_ids):
+        """Record that all the blob_ids name the same blob.
+
+        The record is kept beside every blob_id but the md5 one, which
+        already carries its md5 digest.
+        """
+        text = ''.join([ blob_id + '\n' for blob_id in blob_ids ])
+        for blob_id in blob_ids:
+            if not blob_id.startswith('md5:'):
+                self._add_metadata(text,
+                                   self.get_checksums_filename(blob_id))
+
+    def get_blob_ids(self, blob_id):
+        """Return all the blob_ids of the blob named by blob_id.
+
+        Blobs added before .checksums records were kept are
+        checksummed once, and the record is added then.
+        """
+        filename = self.get_checksums_filename(blob_id)
+        if os.path.exists(filename):
+            return open(filename).read().split()
+        blob_ids = calculate_checksums(self.file_path(blob_id))
+        self.add_checksums(blob_ids)
         return blob_ids
 
+    def get_md5_digest(self, blob_id):
+        """Return the md5 hex digest of a blob without reading it."""
+        if not blob_id.startswith('md5:'):
+            for other_id in self.get_blob_ids(blob_id):
+                if other_id.startswith('md5:'):
+                    blob_id = other_id
+                    break
+        return blob_id[len('md5:'):]
+
     def __iter__(self):
+        """Iterate over the names of the files in the cache.
+
+        Hidden files, like the blob index and partial downloads, are
+        left out.
+        """
         for record in os.walk(self.path):
             filenames = record[2] # (dir, subdirs, filename)
             for filename in filenames:
-                yield filename
+                if not filename.startswith('.'):
+                    yield filename
 
     def get_inode(self, blob_id):
         """Return the inode of a file given blob_id"""
@@ -287,12 +649,16 @@ class SimpleCache(object):
         filepath = self.file_path(blob_id)
         return os.stat(filepath)[ST_SIZE]
 
+    def find_blob_ids(self):
+        """Return the blob_ids in the cache by looking at every file."""
+        return [ filename for filename in self
+                 if blob_id_pattern.match(filename) ]
+
     def iter_sha1_ids(self):
         """Iterate over the list of all the sha-1 ids in this cache."""
-        rexp = re.compile('sha-1:[a-fA-F0-9]+$')
-        for filename in self:
-            if rexp.match(filename):
-                yield filename
+        for blob_id in self.blob_index:
+            if blob_id.startswith('sha-1:'):
+                yield blob_id
 
     def get_index_file(self):
         '''Return a the path to the blob index file.'''
@@ -300,18 +666,233 @@ class SimpleCache(object):
         return index_file
 
     def write_index(self):
-        """Write an index file describing the contents of the cache."""
+        """Write an index file describing the contents of the cache.
+
+        The blob index is rebuilt at the same time.
+        """
         index_file = self.get_index_file()
         handle = gzip.open(index_file, 'w')
-        regex = re.compile('(sha-1:|md5:)[a-fA-F0-9]+$')
-        for filename in self:
-            if regex.match(filename):
-                path = self.make_relative_filename(filename)
-                size = self.get_size(filename)
-                handle.write('%s %s %d\n' % (filename, path, size))
+        blob_ids = self.blob_index.rebuild()
+        for filename in blob_ids:
+            path = self.make_relative_filename(filename)
+            size = self.get_size(filename)
+            handle.write('%s %s %d\n' % (filename, path, size))
         handle.flush()
         handle.close()
 
+    def set_layout(self, levels):
+        """Move the cache files under the given number of directory levels.
+
+        Files are renamed one at a time and the new layout is recorded
+        last, so an interrupted move can be finished by running it
+        again.
+        """
+        if levels < 1 or levels > 4:
+            raise InputError, \
+                  'Cache layouts have from 1 to 4 directory levels.'
+        self.levels = levels
+        moves = []
+        for dir_path, dir_names, file_names in os.walk(self.path):
+            if dir_path == self.path:
+                if '.backing' in dir_names:
+                    dir_names.remove('.backing')
+                continue
+            for filename in file_names:
+                if ':' not in filename or filename.startswith('.'):
+                    continue
+                path = os.path.join(dir_path, filename)
+                new_path = self.file_path(filename)
+                if path != new_path:
+                    moves.append((path, new_path))
+
+        old_dirs = Set()
+        for path, new_path in moves:
+            make_path_to(new_path)
+            os.rename(path, new_path)
+            old_dirs.add(os.path.dirname(path))
+        for old_dir in old_dirs:
+            while old_dir != self.path:
+                try:
+                    os.rmdir(old_dir)
+                except OSError:
+                    # Not empty, or still in use by the new layout.
+                    break
+                old_dir = os.path.dirname(old_dir)
+
+        layout_file = self.get_layout_filename()
+        open(layout_file + '.new', 'w').write('%d\n' % levels)
+        os.rename(layout_file + '.new', layout_file)
+        self.write_index()
+
+class HeaderPack(object):
+    """Package headers stored together in one append-only file.
+
+    The pack holds the raw headers back to back, and the index file
+    beside it has a "blob_id offset length" line for each of them.
+    Headers are written to the pack before they are indexed. An index
+    line cut short by an interrupted append is ignored, as is an entry
+    reaching past the end of the pack, so such an append only leaves
+    unused bytes behind.
+
+    Reads go through a memory map of the pack, which is remapped when
+    the index refers past its end.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.index_filename = filename + '-index'
+        self.entries = None
+        self.mapped = None
+
+    def read_index(self):
+        """Read the index file.
+
+        Returns ({ blob_id: (offset, length) }, complete), where
+        complete is false if the file ends in a partial line.
+        """
+        entries = {}
+        complete = True
+        try:
+            handle = open(self.index_filename)
+        except IOError, error:
+            if error.errno != errno.ENOENT:
+                raise
+            return entries, complete
+        for line in handle:
+            complete = line.endswith('\n')
+            fields = line.split()
+            if not complete or len(fields) != 3:
+                continue
+            blob_id, offset, length = fields
+            try:
+                entries[blob_id] = (int(offset), int(length))
+            except ValueError:
+                continue
+        handle.close()
+        return entries, complete
+
+    def load_index(self):
+        """Return { blob_id: (offset, length) }, reading it if needed."""
+        if self.entries is None:
+            self.entries = self.read_index()[0]
+        return self.entries
+
+    def __contains__(self, blob_id):
+        return blob_id in self.load_index()
+
+    def get(self, blob_id):
+        """Return the header for blob_id, or None if it isn't packed."""
+        entry = self.load_index().get(blob_id)
+        if not entry:
+            return None
+        offset, length = entry
+        if self.mapped is None or offset + length > len(self.mapped):
+            handle = open(self.filename)
+            try:
+                size = os.fstat(handle.fileno())[ST_SIZE]
+                if offset + length > size:
+                    return None
+                self.mapped = mmap.mmap(handle.fileno(), size,
+                                        access = mmap.ACCESS_READ)
+            finally:
+                handle.close()
+        return self.mapped[offset:offset + length]
+
+    def add(self, headers):
+        """Append (blob_id, header) pairs to the pack.
+
+        Appends from several processes are serialized with a lock on
+        the pack, and the index is read again once the lock is held.
+        """
+        handle = open(self.filename, 'ab')
+        try:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+            entries, complete = self.read_index()
+            self.entries = entries
+            offset = os.fstat(handle.fileno())[ST_SIZE]
+            lines = []
+            if not complete:
+                # End the partial line left by an interrupted append.
+                lines.append('\n')
+            for blob_id, header in headers:
+                if blob_id in entries:
+                    continue
+                handle.write(header)
+                entries[blob_id] = (offset, len(header))
+                lines.append('%s %d %d\n' % (blob_id, offset, len(header)))
+                offset += len(header)
+            handle.flush()
+            index_handle = open(self.index_filename, 'a')
+            index_handle.write(''.join(lines))
+            index_handle.close()
+        finally:
+            handle.close()
+
+class PackageMemo(object):
+    """Parsed packages kept for reuse, by (blob_id, format).
+
+    Callers always get a clone, so rules which change a loaded package
+    don't affect the package kept here. Once more than size packages
+    are held, the least recently used quarter is dropped.
+
+    hits and misses count the lookups answered with and without a
+    parse.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.packages = {}
+        self.last_used = {}
+        self.clock = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, parse):
+        """Return a clone of the package for key.
+
+        parse is called to make the package when it isn't held.
+        """
+        package = self.packages.get(key)
+        if package is None:
+            self.misses += 1
+            package = parse()
+            if self.size <= 0:
+                return package
+            self.packages[key] = package
+        else:
+            self.hits += 1
+        self.clock += 1
+        self.last_used[key] = self.clock
+        if len(self.packages) > self.size:
+            self.drop_least_used()
+        return package.clone()
+
+    def drop_least_used(self):
+        """Drop the least recently used packages."""
+        by_use = [ (used, key) for key, used in self.last_used.items() ]
+        by_use.sort()
+        for dummy, key in by_use[:len(by_use) - self.size * 3 / 4]:
+            del self.packages[key]
+            del self.last_used[key]
+
+    def clear(self):
+        """Drop all the packages and reset the counters."""
+        self.__init__(self.size)
+
+def get_package_memo_size():
+    """Return how many parsed packages are kept for reuse.
+
+    The count may be set with the PDK_PACKAGE_MEMO environment
+    variable. 0 turns the reuse off.
+    """
+    try:
+        return int(os.environ['PDK_PACKAGE_MEMO'])
+    except (KeyError, ValueError):
+        return 10000
+
+package_memo = PackageMemo(get_package_memo_size())
+
+# Headers extracted between appends to the header pack, per worker.
+headers_per_round = 256
+
 class Cache(SimpleCache):
     """Manage and report on the contents of the cache
 
@@ -320,6 +901,8 @@ class Cache(SimpleCache):
     def __init__(self, cache_path):
         SimpleCache.__init__(self, cache_path)
         ensure_directory_exists(self.path)
+        self.header_pack = HeaderPack(os.path.join(self.path,
+                                                   '.header-pack'))
 
 
     def get_header_filename(self, blob_id):
@@ -329,30 +912,86 @@ class Cache(SimpleCache):
 
     def add_header(self, header, blob_id):
         """ write a header to a file, identified by blob_id"""
-        # Always start with a temp file
-        temp_path = self.make_download_filename()
+        self._add_metadata(header, self.get_header_filename(blob_id))
+
+    def get_stanza_filename(self, blob_id, key):
+        "Return the filename of a rendered apt stanza for a blob"
+        return self.file_path(blob_id) + '.stanza-' + key
+
+    def load_stanza(self, blob_id, key):
+        """Return the apt stanza stored for blob_id under key, or None.
+
+        key should be a hex digest of everything which went into
+        rendering the stanza.
+        """
         try:
-            # Fill it.
-            open(temp_path, 'w').write(header)
-            # Link it to the appropriate blob_id.header file
-            filename = self.get_header_filename(blob_id)
-            try:
-                os.link(temp_path, filename)
-            except OSError, msg:
-                # file exists
-                if msg.errno == 17:
-                    pass
-                else:
-                    raise
-        finally:
-            # Get rid of the temp file
-            os.unlink(temp_path)
+            return open(self.get_stanza_filename(blob_id, key)).read()
+        except IOError, error:
+            if error.errno == errno.ENOENT:
+                return None
+            raise
+
+    def add_stanza(self, stanza, blob_id, key):
+        """Store a rendered apt stanza for blob_id under key."""
+        self._add_metadata(stanza, self.get_stanza_filename(blob_id, key))
+
 
+    def index_headers(self, packages, workers = 1):
+        """Add the headers of packages to the header pack.
+
+        packages - (blob_id, package_format) pairs.
+
+        Headers are extracted by worker processes, and appended to the
+        pack as each round of them is done. Existing .header files are
+        used as they are. Returns the number of headers added.
+        """
+        todo = []
+        seen = Set()
+        for blob_id, package_format in packages:
+            if blob_id in seen or blob_id in self.header_pack \
+                   or blob_id not in self:
+                continue
+            seen.add(blob_id)
+            todo.append((blob_id, package_format))
+
+        round_size = headers_per_round * max(workers, 1)
+        for start in range(0, len(todo), round_size):
+            headers = parallel_map(self.extract_header,
+                                   todo[start:start + round_size],
+                                   workers)
+            self.header_pack.add(headers)
+        return len(todo)
+
+    def extract_header(self, package):
+        """Return (blob_id, header) for a (blob_id, format) pair."""
+        blob_id, package_format = package
+        header_file = self.get_header_filename(blob_id)
+        if os.path.exists(header_file):
+            return blob_id, open(header_file).read()
+        package_type = get_package_type(format = package_format)
+        return blob_id, package_type.extract_header(self.file_path(blob_id))
 
     def load_package(self, blob_id, package_format):
         """Load the raw header data into memory from a package
+
+        Packages parsed earlier in this process are reused; see
+        PackageMemo.
+        """
+        def _parse():
+            '''Parse the package for the memo.'''
+            return self.parse_package(blob_id, package_format)
+        return package_memo.get((blob_id, package_format), _parse)
+
+    def parse_package(self, blob_id, package_format):
+        """Read and parse the header of a package.
+
+        The header pack is consulted before the .header files.
         """
         package_type = get_package_type(format = package_format)
+        header = self.header_pack.get(blob_id)
+        if header is not None:
+            return package_type.parse(header, blob_id)
+
         header_file = self.get_header_filename(blob_id)
 
         # check if the header file is already present
@@ -0,0 +1,240 @@
+# $Progeny$
+#
+#   Copyright 2006 Progeny Linux Systems, Inc.
+#
+#   This file is part of PDK.
+#
+#   PDK is free software; you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   PDK is distributed in the hope that it will be useful, but WITHOUT
+#   ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#   or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+#   License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with PDK; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""
+cache_gc
+
+Remove files which no component descriptor needs from the cache.
+
+A blob is reachable if a descriptor in the work area, or committed at
+HEAD or recently before, refers to it, or if it is an extra file of a
+referenced source package. All the names (md5, sha-1) of a reachable
+inode are kept, along with their .header and other metadata files.
+"""
+__revision__ = '$Progeny$'
+
+import os
+import time
+from sets import Set
+from cElementTree import iterparse
+import pdk.workspace as workspace
+from pdk.command_base import make_invokable
+from pdk.cache import metadata_pattern, blob_id_pattern
+from pdk.package import get_package_type, UnknownPackageTypeError
+from pdk.exceptions import SemanticError
+import pdk.log as log
+
+logger = log.get_logger()
+
+def gc(args):
+    """\\fB%prog\\fP [\\fIOPTIONS\\fP]
+.PP
+Remove files from the cache
+which are not needed by any component descriptor
+in the work area or committed at HEAD.
+.PP
+With --history N, descriptors committed in the N commits before HEAD
+are also considered. With --keep-days DAYS, files read in the last
+DAYS days are kept regardless. With --dry-run, only list what would
+be removed. A descriptor which does not parse stops the removal,
+since the blobs it refers to cannot be known; a dry run skips it.
+    """
+    ws = workspace.current_workspace()
+    cache = ws.cache
+    dry_run = not args.opts.save_component_changes
+    refs = find_references(ws, args.opts.history, dry_run)
+    reachable = find_reachable(cache, refs)
+
+    keep_since = None
+    if args.opts.keep_days is not None:
+        keep_since = time.time() - args.opts.keep_days * 24 * 60 * 60
+
+    collector = CacheCollector(cache)
+    garbage = collector.find_garbage(reachable, keep_since)
+    total_size = 0
+    for entry in garbage:
+        total_size += entry.size
+
+    if args.opts.save_component_changes:
+        collector.remove(garbage)
+        print 'Removed %d blobs, %d bytes.' % (len(garbage), total_size)
+    else:
+        for entry in garbage:
+            blob_ids = list(entry.blob_ids)
+            blob_ids.sort()
+            print '%s|%d' % (' '.join(blob_ids), entry.size)
+        print 'Would remove %d blobs, %d bytes.' \
+              % (len(garbage), total_size)
+
+gc = make_invokable(gc, 'dry-run', 'history', 'keep-days')
+
+def iter_descriptor_handles(ws, history):
+    """Yield (filename, handle) for candidate component descriptors.
+
+    These are the xml files in the work area, and those committed at
+    HEAD and in the history commits before it.
+    """
+    for dir_path, dir_names, file_names in os.walk(ws.location):
+        if dir_path == ws.location and 'etc' in dir_names:
+            dir_names.remove('etc')
+        for file_name in file_names:
+            if file_name.endswith('.xml'):
+                path = os.path.join(dir_path, file_name)
+                yield path, open(path)
+
+    for filename, blob_id in ws.vc.iter_committed_blobs(history):
+        if filename.endswith('.xml'):
+            yield filename, ws.vc.get_blob(blob_id)
+
+def scan_descriptor(handle):
+    """Yield (tag, blob_id) for each blob a descriptor refers to.
+
+    The descriptor is parsed as a stream and each element is cleared
+    once read, so no full component tree is built.
+    """
+    for dummy, element in iterparse(handle):
+        ref = element.get('ref')
+        if ref and blob_id_pattern.match(ref):
+            yield element.tag, ref
+        element.clear()
+
+def find_references(ws, history, skip_unparsable = False):
+    """Return the set of (tag, blob_id) referred to by descriptors.
+
+    A descriptor which does not parse raises SemanticError, unless
+    skip_unparsable is set, when it is skipped with a warning.
+    """
+    refs = Set()
+    for filename, handle in iter_descriptor_handles(ws, history):
+        try:
+            try:
+                refs.update(scan_descriptor(handle))
+            except SyntaxError:
+                if not skip_unparsable:
+                    raise SemanticError, \
+                          'Unparsable descriptor %s, not collecting ' \
+                          'garbage' % filename
+                logger.warn('Skipping unparsable descriptor %s'
+                            % filename)
+        finally:
+            handle.close()
+    return refs
+
+def find_reachable(cache, refs):
+    """Return the set of blob_ids needed for the given references.
+
+    Source packages bring in their extra files, which are found in
+    their headers.
+    """
+    reachable = Set()
+    for tag, blob_id in refs:
+        reachable.add(blob_id)
+        try:
+            package_type = get_package_type(format = tag)
+        except UnknownPackageTypeError:
+            continue
+        if package_type.role_string != 'source' or blob_id not in cache:
+            continue
+        try:
+            package = cache.load_package(blob_id, tag)
+        except SemanticError:
+            continue
+        for extra_blob_id, dummy, dummy in package.extra_files:
+            reachable.add(extra_blob_id)
+    return reachable
+
+class CacheEntry(object):
+    """All the files in the cache for a single inode.
+
+    blob_ids - the names of the inode in the cache
+    paths - the blob files and their metadata files
+    size - the space used by all of the paths
+    atime - when the blob was last read
+    """
+    __slots__ = ('blob_ids', 'paths', 'size', 'atime')
+
+    def __init__(self, size, atime):
+        self.blob_ids = Set()
+        self.paths = []
+        self.size = size
+        self.atime = atime
+
+class CacheCollector(object):
+    """Find and remove unreachable inodes in a cache."""
+    def __init__(self, cache):
+        self.cache = cache
+
+    def scan(self):
+        """Return a CacheEntry for each blob inode in the cache.
+
+        Files which are neither blobs nor blob metadata, like the
+        cache index, are left out.
+        """
+        by_inode = {}
+        metadata = {}
+        for dir_path, dummy, file_names in os.walk(self.cache.path):
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                match = metadata_pattern.search(file_name)
+                if match:
+                    blob_id = file_name[:match.start()]
+                    metadata.setdefault(blob_id, []).append(path)
+                    continue
+                if not blob_id_pattern.match(file_name):
+                    continue
+                stats = os.stat(path)
+                entry = by_inode.get(stats.st_ino)
+                if not entry:
+                    entry = CacheEntry(stats.st_size, stats.st_atime)
+                    by_inode[stats.st_ino] = entry
+                entry.blob_ids.add(file_name)
+                entry.paths.append(path)
+
+        entries = by_inode.values()
+        for entry in entries:
+            for blob_id in entry.blob_ids:
+                for path in metadata.get(blob_id, []):
+                    entry.paths.append(path)
+                    entry.size += os.stat(path).st_size
+        return entries
+
+    def find_garbage(self, reachable, keep_since = None):
+        """Return the CacheEntries which are no longer needed.
+
+        reachable - the set of blob_ids to keep.
+        keep_since - if given, keep entries read since this time.
+        """
+        garbage = []
+        for entry in self.scan():
+            if entry.blob_ids & reachable:
+                continue
+            if keep_since is not None and entry.atime >= keep_since:
+                continue
+            garbage.append(entry)
+        return garbage
+
+    def remove(self, entries):
+        """Remove the files of the given entries from the cache."""
+        for entry in entries:
+            for path in entry.paths:
+                os.unlink(path)
+        self.cache.write_index()
+
+# vim:set ai et sw=4 ts=4 tw=75:
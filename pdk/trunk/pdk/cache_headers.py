@@ -0,0 +1,67 @@
+# $Progeny$
+#
+#   Copyright 2006 Progeny Linux Systems, Inc.
+#
+#   This file is part of PDK.
+#
+#   PDK is free software; you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   PDK is distributed in the hope that it will be useful, but WITHOUT
+#   ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#   or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+#   License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with PDK; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""
+cache_headers
+
+Collect the headers of the packages used by the work area into the
+cache's header pack.
+"""
+__revision__ = '$Progeny$'
+
+import pdk.workspace as workspace
+from pdk.command_base import make_invokable
+from pdk.cache_gc import find_references
+from pdk.package import get_package_type, UnknownPackageTypeError
+
+def find_packages(refs):
+    """Return sorted (blob_id, format) pairs for packages in refs.
+
+    refs - (tag, blob_id) pairs, as found by find_references.
+    """
+    packages = []
+    for tag, blob_id in refs:
+        try:
+            package_type = get_package_type(format = tag)
+        except UnknownPackageTypeError:
+            continue
+        if hasattr(package_type, 'extract_header'):
+            packages.append((blob_id, tag))
+    packages.sort()
+    return packages
+
+def index_headers(args):
+    """\\fB%prog\\fP [\\fIOPTIONS\\fP]
+.PP
+Extract the headers of the packages
+referred to by component descriptors in the work area
+or committed at HEAD,
+and append them to the header pack in the cache.
+Later package loads read headers from the pack
+instead of from one file per package.
+    """
+    ws = workspace.current_workspace()
+    packages = find_packages(find_references(ws, 0))
+    count = ws.cache.index_headers(packages, args.opts.jobs)
+    print 'Indexed %d headers.' % count
+
+index_headers = make_invokable(index_headers, 'jobs')
+
+# vim:set ai et sw=4 ts=4 tw=75:
@@ -51,23 +51,74 @@ import re
 from urlparse import urlsplit
 from gzip import GzipFile
 from md5 import md5
-try:
-    import apt_pkg
-except ImportError:
-    pass
+import sha
+from cPickle import Pickler, Unpickler, UnpicklingError
 from xml.parsers.expat import ExpatError
 from pdk.exceptions import InputError, SemanticError
 from pdk.util import cpath, gen_file_fragments, get_remote_file, \
-     shell_command, Framer, cached_property, parse_xml
+     shell_command, Framer, cached_property, parse_xml, \
+     ensure_directory_exists, parallel_map, verify_protocol
 from pdk.yaxml import parse_yaxml_file
 from pdk.package import parse_rpm_header, deb, udeb, dsc, \
-     get_package_type, UnknownPackageTypeError
+     get_package_type, UnknownPackageTypeError, GhostPackage
 from pdk.progress import ConsoleMassProgress
-from pdk.index_file import IndexWriter, IndexFile, IndexFileMissingError
+from pdk.index_file import IndexWriter, IndexFile, IndexFileMissingError, \
+     IndexFormatError
+from pdk.query import get_index_values, plan_condition, explain_plan
 from pdk.log import get_logger
 
 logger = get_logger()
 
+# Keys which never collide with the channel data keys. Segments are
+# listed under segments_key in the main index file, and each segment
+# stores the stamp of its section under stamp_key.
+segments_key = ('segments',)
+stamp_key = ('segment-stamp',)
+fields_key = ('indexed-fields',)
+
+# Bumped whenever the layout of segment records changes, so that
+# segments in an older layout are rebuilt.
+segment_version = 2
+
+# Fields every segment is indexed on. The resolver relies on these.
+base_indexed_fields = (('pdk', 'name'), ('pdk', 'sp-name'),
+                       ('pdk', 'source-rpm'), ('pdk', 'filename'))
+
+# Fields indexed in addition to the base fields, unless the
+# PDK_INDEXED_FIELDS environment variable says otherwise.
+default_extra_indexed_fields = (('pdk', 'version'), ('deb', 'arch'),
+                                ('deb', 'Provides'), ('deb', 'Section'),
+                                ('rpm', 'arch'), ('rpm', 'provides'),
+                                ('rpm', 'group'))
+
+def get_indexed_fields():
+    '''Return the (domain, predicate) fields channel data is indexed on.
+
+    The extra fields may be set with the PDK_INDEXED_FIELDS environment
+    variable, as a comma separated list of fields written as in debish
+    conditions. (deb:Section,version)
+    '''
+    try:
+        raw_fields = os.environ['PDK_INDEXED_FIELDS']
+    except KeyError:
+        extra_fields = default_extra_indexed_fields
+    else:
+        extra_fields = []
+        for raw_field in raw_fields.split(','):
+            raw_field = raw_field.strip()
+            if not raw_field:
+                continue
+            if ':' in raw_field:
+                extra_fields.append(tuple(raw_field.split(':', 1)))
+            else:
+                extra_fields.append(('pdk', raw_field))
+
+    fields = list(base_indexed_fields)
+    for field in extra_fields:
+        if field not in fields:
+            fields.append(field)
+    return tuple(fields)
+
 def quote(raw):
     '''Create a valid filename which roughly resembles the raw string.'''
     return re.sub(r'[^A-Za-z0-9.-]+', '_', raw)
@@ -79,6 +130,20 @@ class MissingChannelDataError(SemanticError):
     '''
     pass
 
+def get_file_stamp(filename):
+    '''Return a (size, mtime, md5) stamp for a channel data file.
+
+    Returns None when the file does not exist.
+    '''
+    if not os.path.exists(filename):
+        return None
+    stats = os.stat(filename)
+    md5_digest = md5()
+    for block in gen_file_fragments(filename):
+        md5_digest.update(block)
+    return (stats[stat.ST_SIZE], stats[stat.ST_MTIME],
+            md5_digest.hexdigest())
+
 class LoaderFactory(tuple):
     '''Captures parameters to later create a cache loader.
 
@@ -99,9 +164,14 @@ class LoaderFactory(tuple):
 
 class URLCacheLoader(object):
     '''A cache loader which downloads raw files via curl or direct copy.
+
+    Remote files are downloaded concurrently, at most max_connections
+    at a time. When max_connections is None, the PDK_MAX_CONNECTIONS
+    environment variable or a built in default is used.
     '''
-    def __init__(self, locators):
+    def __init__(self, locators, max_connections = None):
         self.locators = locators
+        self.max_connections = max_connections
 
     def load(self, cache, mass_progress):
         '''Import assigned blobs into the cache.
@@ -109,9 +179,8 @@ class URLCacheLoader(object):
         Actually the framer strems zero blobs, as the "remote" side of
         the framer is downloading files directly into the cache.
         '''
-        for locator in self.locators:
-            if locator.blob_id not in cache:
-                cache.import_file(locator, mass_progress)
+        cache.import_files(self.locators, mass_progress,
+                           self.max_connections)
 
 class LocalWorkspaceCacheLoader(object):
     '''A cache loader for working with a remote workspace on this machine.
@@ -125,6 +194,7 @@ class LocalWorkspaceCacheLoader(object):
         blob_ids = [ l.blob_id for l in self.locators ]
         framer = Framer(*shell_command('pdk remote listen %s'
                                          % self.path))
+        verify_protocol(framer)
         framer.write_stream(['pull-blobs'])
         framer.write_stream(blob_ids)
         framer.write_stream(['done'])
@@ -143,6 +213,7 @@ class SshWorkspaceCacheLoader(object):
         blob_ids = [ l.blob_id for l in self.locators ]
         framer = Framer(*shell_command('ssh %s pdk remote listen %s'
                                          % (self.host, self.path)))
+        verify_protocol(framer)
         framer.write_stream(['pull-blobs'])
         framer.write_stream(blob_ids)
         framer.write_stream(['done'])
@@ -202,6 +273,7 @@ def make_comparable(cls, id_fields = None):
     def __repr__(self):
         return '<%s %r>' % (self.__class__.__name__, get_identity(self))
 
+    cls.get_identity = get_identity
     cls.__cmp__ = __cmp__
     cls.__hash__ = __hash__
     cls.__repr__ = __repr__
@@ -250,6 +322,17 @@ class RpmMdSection(object):
         primary_url = '/'.join([self.path, location])
         return primary_url, self.get_channel_file(primary_url)
 
+    def get_stamp(self):
+        '''Return a stamp which changes whenever the channel data does.'''
+        repomd_stamp = get_file_stamp(self.repomd_data)
+        if repomd_stamp is None:
+            return None
+        dummy, primary_data = self.get_primary_data()
+        primary_stamp = get_file_stamp(primary_data)
+        if primary_stamp is None:
+            return None
+        return (repomd_stamp, primary_stamp)
+
     def iter_package_info(self):
         '''Iterate over ghost_package, blob_id, locator for this section.
         '''
@@ -281,26 +364,80 @@ class RpmMdSection(object):
 
 make_comparable(RpmMdSection, ('path',))
 
+def iter_stanzas(handle):
+    '''Iterate over the raw text of blank line separated stanzas.
+
+    The handle is read a line at a time, so only one stanza is held in
+    memory.
+    '''
+    lines = []
+    for line in handle:
+        if line.strip():
+            lines.append(line)
+        elif lines:
+            yield ''.join(lines)
+            lines = []
+    if lines:
+        yield ''.join(lines)
+
+def parse_stanza(stanza, field_names = None, source = None):
+    '''Parse a raw control stanza into a dict of field name to value.
+
+    Field names keep their case. If field_names (a collection of lower
+    case names) is given, other fields are skipped. Continuation lines
+    are kept, joined by newlines, as apt does.
+
+    The source is used in error messages.
+    '''
+    fields = {}
+    current = None
+    for line in stanza.splitlines():
+        if line[:1] in (' ', '\t'):
+            if current:
+                fields[current] += '\n' + line
+            continue
+        if ':' not in line:
+            raise InputError('Malformed line in %s: %r' % (source, line))
+        name, value = line.split(':', 1)
+        if field_names is not None and name.lower() not in field_names:
+            current = None
+            continue
+        current = name
+        fields[name] = value.strip()
+    return fields
+
 class AptDebSection(object):
     '''Section for managing a single Packages or Sources file.
 
     Requires a strategy object which controls whether the url will
     be treated as Packages or Sources.
+
+    When index_fields_only is true, the ghost packages produced while
+    indexing hold only the fields named by strategy.index_fields and
+    the indexed deb fields. The
+    raw stanza text is stored as the header either way, so the full
+    package can be parsed from the index later.
     '''
 
-    def __init__(self, full_path, channel_file, strategy):
+    def __init__(self, full_path, channel_file, strategy,
+                 index_fields_only = True):
         self.full_path = full_path
         self.channel_file = channel_file
         self.strategy = strategy
+        self.index_fields_only = index_fields_only
 
     def get_identity(self):
         '''Return an identity tuple for this object.'''
-        return (self.strategy.package_type, self.full_path)
+        return (self.strategy.package_type.type_string, self.full_path)
 
     def update(self):
         '''Grab the remote file and store it locally.'''
         get_remote_file(self.full_path, self.channel_file, True)
 
+    def get_stamp(self):
+        '''Return a stamp which changes whenever the channel data does.'''
+        return get_file_stamp(self.channel_file)
+
     def iter_package_info(self):
         '''Iterate over ghost_package, blob_id, locator for this section.
         '''
@@ -321,20 +458,29 @@ class AptDebSection(object):
                 yield None, None, extra_blob_id, extra_locator
 
     def iter_apt_tags(self):
-        '''Iterate over apt tag section objects in self.channel_file.'''
-        handle = os.popen('gunzip <%s' % self.channel_file)
-        apt_iterator = apt_pkg.ParseTagFile(handle)
-        while apt_iterator.Step():
-            yield apt_iterator.Section
+        '''Iterate over raw stanza, fields dict pairs in self.channel_file.
+
+        The file is decompressed in process as it is read.
+        '''
+        if self.index_fields_only:
+            field_names = list(self.strategy.index_fields)
+            field_names.extend([ predicate.lower()
+                                 for domain, predicate
+                                 in get_indexed_fields()
+                                 if domain == 'deb' ])
+        else:
+            field_names = None
+        handle = GzipFile(self.channel_file)
+        for stanza in iter_stanzas(handle):
+            yield stanza, parse_stanza(stanza, field_names,
+                                       self.channel_file)
         handle.close()
 
     def iter_as_packages(self, tags_iterator):
         """For each control stanza, yield the stanza and a package object.
         """
-        for tags in tags_iterator:
-            control = str(tags)
-            yield control, self.strategy.package_type.parse_tags(tags,
-                                                                 None)
+        for stanza, tags in tags_iterator:
+            yield stanza, self.strategy.package_type.parse_tags(tags, None)
 
 make_comparable(AptDebSection, ('full_path', 'base_path'))
 
@@ -345,6 +491,8 @@ class AptDebBinaryStrategy(object):
     '''
     package_type = deb
     loader_factory = LoaderFactory.create(URLCacheLoader)
+    index_fields = ('package', 'source', 'version', 'architecture',
+                    'filename', 'size', 'md5sum')
 
     def __init__(self, base_path):
         self.base_path = base_path
@@ -369,6 +517,8 @@ class AptDebSourceStrategy(object):
     '''
     package_type = dsc
     loader_factory = LoaderFactory.create(URLCacheLoader)
+    index_fields = ('package', 'source', 'version', 'architecture',
+                    'directory', 'files')
 
     def __init__(self, base_path):
         self.base_path = base_path
@@ -382,58 +532,166 @@ class AptDebSourceStrategy(object):
         return FileLocator(base, package.pdk.raw_filename, package.blob_id,
                            package.size, self.loader_factory)
 
-def get_size(filename):
-    '''Get the size of the given filename.'''
-    return os.stat(filename)[stat.ST_SIZE]
+class FileScanCache(object):
+    '''Remember the blob_id and header of previously scanned files.
+
+    filename - where the cache is stored. None disables storage.
+
+    Entries are keyed by path and are valid only while the inode, size
+    and mtime of the file are unchanged. Only entries used since the
+    cache was loaded are written back, so files which have gone away
+    are forgotten.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.old_entries = {}
+        self.entries = {}
+        if filename and os.path.exists(filename):
+            try:
+                self.old_entries = Unpickler(open(filename)).load()
+            except (EOFError, UnpicklingError, ValueError):
+                logger.warn('Ignoring corrupt scan cache %s' % filename)
+
+    def get_stat_key(stats):
+        '''Return the validity key for a file from its stat result.'''
+        return (stats.st_ino, stats.st_size, stats.st_mtime)
+    get_stat_key = staticmethod(get_stat_key)
+
+    def get(self, path, stat_key):
+        '''Return (blob_id, header) for path, or None if unknown/stale.'''
+        entry = self.old_entries.get(path)
+        if entry is None or entry[0] != stat_key:
+            return None
+        self.entries[path] = entry
+        return entry[1:]
+
+    def set(self, path, stat_key, blob_id, header):
+        '''Note the blob_id and header for path.'''
+        self.entries[path] = (stat_key, blob_id, header)
+
+    def write(self):
+        '''Store the entries used or set since loading.'''
+        if not self.filename:
+            return
+        ensure_directory_exists(os.path.dirname(self.filename))
+        new_filename = self.filename + '.new'
+        handle = open(new_filename, 'w')
+        Pickler(handle, 2).dump(self.entries)
+        handle.close()
+        os.rename(new_filename, self.filename)
+
+def scan_package_file(item):
+    '''Return (blob_id, header) for a (package_type, path) pair.'''
+    package_type, full_path = item
+    control = package_type.extract_header(full_path)
+    md51_digest = md5()
+    for block in gen_file_fragments(full_path):
+        md51_digest.update(block)
+    return 'md5:' + md51_digest.hexdigest(), control
 
 class DirectorySection(object):
-    '''Section object for dealing with local directories as channels.'''
+    '''Section object for dealing with local directories as channels.
+
+    full_path - the directory.
+    channel_file - where to keep a FileScanCache for the directory.
+                   Optional.
+    '''
 
     loader_factory = LoaderFactory.create(URLCacheLoader)
 
-    def __init__(self, full_path):
+    def __init__(self, full_path, channel_file = None):
         self.full_path = full_path
+        self.channel_file = channel_file
 
     def update(self):
         """Since the files are local, don't bother storing workspace state.
         """
         pass
 
-    def iter_package_info(self):
-        '''Iterate over ghost_package, blob_id, locator for this section.
+    def get_stamp(self):
+        '''Return a stamp which changes whenever the directory does.
 
-        The directory is visited recursively and in a repeatable order.
+        The stamp covers the name, size and mtime of every file below
+        the directory, but does not read any file contents.
         '''
+        md5_digest = md5()
         for root, dirnames, files in os.walk(self.full_path,
                                              topdown = True):
             dirnames.sort()
             files.sort()
             for candidate in files:
                 full_path = pjoin(root, candidate)
+                stats = os.stat(full_path)
+                md5_digest.update('%s %d %d\n' % (full_path,
+                                                   stats[stat.ST_SIZE],
+                                                   stats[stat.ST_MTIME]))
+        return md5_digest.hexdigest()
+
+    def iter_candidates(self):
+        '''Iterate over root, filename, package_type, stats for files.
+
+        The directory is visited recursively and in a repeatable order.
+        Files which are not packages are skipped.
+        '''
+        for root, dirnames, files in os.walk(self.full_path,
+                                             topdown = True):
+            dirnames.sort()
+            files.sort()
+            for candidate in files:
                 try:
                     package_type = get_package_type(filename = candidate)
                 except UnknownPackageTypeError:
                     # if we don't know the the file is, we skip it.
                     continue
-                control = package_type.extract_header(full_path)
-                iterator = gen_file_fragments(full_path)
-                md51_digest = md5()
-                for block in iterator:
-                    md51_digest.update(block)
-                size = get_size(full_path)
-                blob_id = 'md5:' + md51_digest.hexdigest()
-                url = 'file://' + cpath(root)
-                locator = FileLocator(url, candidate, blob_id, size,
-                                      self.loader_factory)
-                package = package_type.parse(control, blob_id)
-                yield package, control, blob_id, locator
-                for extra_blob_id, extra_size, extra_filename \
-                        in package.extra_files:
-                    make_extra = locator.make_extra_file_locator
-                    extra_locator = make_extra(extra_filename,
-                                               extra_blob_id,
-                                               extra_size)
-                    yield None, None, extra_blob_id, extra_locator
+                stats = os.stat(pjoin(root, candidate))
+                yield root, candidate, package_type, stats
+
+    def iter_package_info(self):
+        '''Iterate over ghost_package, blob_id, locator for this section.
+
+        The directory is visited recursively and in a repeatable order.
+
+        Files unchanged since the last scan take their blob_id and
+        header from the scan cache. The rest are read by parallel
+        worker processes.
+        '''
+        scan_cache = FileScanCache(self.channel_file)
+        candidates = list(self.iter_candidates())
+        scanned = {}
+        stale = []
+        for root, candidate, package_type, stats in candidates:
+            full_path = pjoin(root, candidate)
+            stat_key = scan_cache.get_stat_key(stats)
+            entry = scan_cache.get(full_path, stat_key)
+            if entry is None:
+                stale.append((package_type, full_path, stat_key))
+            else:
+                scanned[full_path] = entry
+
+        results = parallel_map(scan_package_file,
+                               [ s[:2] for s in stale ])
+        for (dummy, full_path, stat_key), (blob_id, control) \
+                in zip(stale, results):
+            scan_cache.set(full_path, stat_key, blob_id, control)
+            scanned[full_path] = (blob_id, control)
+        scan_cache.write()
+
+        for root, candidate, package_type, stats in candidates:
+            full_path = pjoin(root, candidate)
+            blob_id, control = scanned[full_path]
+            size = stats[stat.ST_SIZE]
+            url = 'file://' + cpath(root)
+            locator = FileLocator(url, candidate, blob_id, size,
+                                  self.loader_factory)
+            package = package_type.parse(control, blob_id)
+            yield package, control, blob_id, locator
+            for extra_blob_id, extra_size, extra_filename \
+                    in package.extra_files:
+                make_extra = locator.make_extra_file_locator
+                extra_locator = make_extra(extra_filename,
+                                           extra_blob_id,
+                                           extra_size)
+                yield None, None, extra_blob_id, extra_locator
 
 
 make_comparable(DirectorySection, ('full_path',))
@@ -464,6 +722,10 @@ class RemoteWorkspaceSection(object):
         '''
         pass
 
+    def get_stamp(self):
+        '''Return a stamp which changes whenever the channel data does.'''
+        return get_file_stamp(self.channel_file)
+
     def iter_package_info(self):
         '''Iterate over blob_id, locator for this section.
 
@@ -609,7 +871,7 @@ class OutsideWorldFactory(object):
                         yield AptDebSection(full_path, channel_file,
                                             strategy)
             elif type_value == 'dir':
-                yield DirectorySection(path)
+                yield DirectorySection(path, self.get_channel_file(path))
             elif type_value == 'source':
                 yield RemoteWorkspaceSection(path,
                                              self.get_channel_file(path))
@@ -676,13 +938,13 @@ class OutsideWorld(object):
         return IndexedWorldData(self.store_file)
     index = cached_property('index', __create_index)
 
-    def get_limited_index(self, given_section_names):
+    def get_limited_index(self, given_section_names, explain = False):
         '''Return IndexedWorldData like object filtered by channel names.
         '''
         section_names = [ t[0]
                           for t in
                           self.iter_sections(given_section_names) ]
-        return LimitedWorldDataIndex(self.index, section_names)
+        return LimitedWorldDataIndex(self.index, section_names, explain)
 
     def iter_sections(self, section_names = None):
         '''Iterate over stored sections for the given section_names.'''
@@ -729,9 +991,27 @@ class IndexedWorldData(object):
 
     Provides a number of field indexes on an otherwise too large list
     of WorldDataItems.
+
+    Each section is indexed into its own segment file, kept in a
+    directory next to the main index file. The main index file only
+    lists the segments, in section order. A segment is reused by the
+    next build as long as the stamp of its section has not changed.
+
+    Main index files written before segments existed hold all the
+    channel data directly. They are still readable, and are replaced
+    by the next build.
+
+    indexed_fields - the fields to index packages on. Defaults to
+                     get_indexed_fields(). Segments record their
+                     fields, so a segment written with other fields is
+                     never mistaken for a current one.
     '''
-    def __init__(self, filename):
+    def __init__(self, filename, indexed_fields = None):
         self.filename = filename
+        self.segment_dir = filename + '.d'
+        if indexed_fields is None:
+            indexed_fields = get_indexed_fields()
+        self.indexed_fields = indexed_fields
 
     def __create_index_file(self):
         '''Get the index file object which underlies this object.'''
@@ -743,23 +1023,83 @@ class IndexedWorldData(object):
             raise IndexFileMissingError, message
     index_file = cached_property('index_file', __create_index_file)
 
+    def __create_segments(self):
+        '''Get (section_name, IndexFile) pairs for all segments.
+
+        The section_name is None for an old style unsegmented index.
+        '''
+        index_file = self.index_file
+        if index_file.count(segments_key) == 0:
+            return [ (None, index_file) ]
+        segments = []
+        for section_name, segment_name, dummy \
+                in index_file.get(segments_key, 0):
+            segment_file = pjoin(self.segment_dir, segment_name)
+            segments.append((section_name, IndexFile(segment_file)))
+        return segments
+    segments = cached_property('segments', __create_segments)
+
+    def get_segment_fields(index_file):
+        '''Get the fields a segment is indexed on.'''
+        for fields in index_file.get(fields_key, 0):
+            return fields
+        return base_indexed_fields
+    get_segment_fields = staticmethod(get_segment_fields)
+
+    def __create_available_fields(self):
+        '''Get the fields which every segment is indexed on.'''
+        available_fields = None
+        for dummy, index_file in self.segments:
+            fields = self.get_segment_fields(index_file)
+            if available_fields is None:
+                available_fields = list(fields)
+            else:
+                available_fields = [ f for f in available_fields
+                                     if f in fields ]
+        return tuple(available_fields or ())
+    available_fields = cached_property('available_fields',
+                                       __create_available_fields)
+
+    def iter_index_files(self, section_names = None):
+        '''Iterate over section_name, index_file for segments.
+
+        When section_names is given, limit the segments to those
+        sections, in the order given.
+        '''
+        if section_names is None:
+            for section_name, index_file in self.segments:
+                yield section_name, index_file
+            return
+
+        for wanted_name in section_names:
+            for section_name, index_file in self.segments:
+                if section_name in (None, wanted_name):
+                    yield wanted_name, index_file
+
     def has_blob_id(self, blob_id):
         '''Does the given blob id appear in the world?'''
-        return self.index_file.count(('ent-id', blob_id)) > 0
+        for dummy, index_file in self.iter_index_files():
+            if index_file.count(('ent-id', blob_id)) > 0:
+                return True
+        return False
 
     def get_package(self, blob_id, type_string):
         '''Get a (ghost) package object for the blob_id.'''
-        headers = self.index_file.get(('ent-id', blob_id), 1)
-        for header in headers:
-            if header is None:
-                continue
-            package_type = get_package_type(format = type_string)
-            return package_type.parse(header, blob_id)
+        for dummy, index_file in self.iter_index_files():
+            headers = index_file.get(('ent-id', blob_id), 1)
+            for header in headers:
+                if header is None:
+                    continue
+                package_type = get_package_type(format = type_string)
+                return package_type.parse(header, blob_id)
 
     def get_blob_ids(self, channel):
         '''Get a list of all blob_ids in the channel.'''
         try:
-            return list(self.index_file.get(channel, 2))
+            blob_ids = []
+            for dummy, index_file in self.iter_index_files([channel]):
+                blob_ids.extend(index_file.get(channel, 2))
+            return blob_ids
         except IndexFileMissingError:
             # It's expected that this method will sometimes be called
             # before channel data has been indexed.
@@ -767,8 +1107,10 @@ class IndexedWorldData(object):
 
     def get_locator(self, blob_id):
         '''Get a locator object for the blob_id.'''
-        locators = list(self.index_file.get(('ent-id', blob_id), 3))
-        return locators[0]
+        for dummy, index_file in self.iter_index_files():
+            for locator in index_file.get(('ent-id', blob_id), 3):
+                return locator
+        raise IndexError, blob_id
 
     def iter_candidates(self, field, value, section_names):
         '''Iterate over WorldDataItems.
@@ -776,26 +1118,85 @@ class IndexedWorldData(object):
         Use the index named by key_field, with the given key. Return
         only the items found by that key.
         '''
-        for section_name in section_names:
+        for section_name, index_file in \
+                self.iter_index_files(section_names):
             key = (section_name, field, value)
-            records = self.index_file.get_all(key)
-            for item in self.iter_world_items(records, section_name):
+            address_groups = index_file.iter_addresses(key)
+            for item in self.iter_world_items(index_file, address_groups,
+                                              section_name):
+                yield item
+
+    def plan(self, condition):
+        '''Get a pdk.query plan for finding candidates for the condition.
+
+        Returns None if the index can't narrow down the candidates.
+        '''
+        return plan_condition(condition, self.available_fields)
+
+    def iter_planned_candidates(self, plan, section_names):
+        '''Iterate over the WorldDataItems found by a plan.
+
+        Items are produced in index order, and only the items found
+        by the plan are loaded.
+        '''
+        for section_name, index_file in \
+                self.iter_index_files(section_names):
+            address_groups = list(plan.get_addresses(index_file,
+                                                     section_name))
+            address_groups.sort()
+            for item in self.iter_world_items(index_file, address_groups,
+                                              section_name):
                 yield item
 
+    def explain_plan(self, plan, section_names):
+        '''Return lines describing a plan and what it finds.'''
+        index_files = list(self.iter_index_files(section_names))
+        if plan:
+            return explain_plan(plan, index_files)
+        count = 0
+        for section_name, index_file in index_files:
+            count += index_file.count(section_name)
+        return [ 'full scan: %d candidates' % count ]
+
     def iter_channel_candidates(self, section_names):
         '''Get WorldItems for all the objects in the given channels.'''
-        for channel in section_names:
-            records = self.index_file.get_all(channel)
-            for item in self.iter_world_items(records, channel):
+        for channel, index_file in self.iter_index_files(section_names):
+            address_groups = index_file.iter_addresses(channel)
+            for item in self.iter_world_items(index_file, address_groups,
+                                              channel):
                 yield item
 
-    def iter_world_items(records, section_name):
-        '''Get WorldItems for all the objects in the given (one) channel.
+    def iter_world_items(index_file, address_groups, section_name):
+        '''Get WorldItems for the given records of one segment.
+
+        The packages are GhostPackages holding the indexed fields
+        stored with each record. The header is not even unpickled
+        until some other field is needed.
         '''
-        for type_string, header, blob_id, locator in records:
-            if type_string and header:
+        fields = IndexedWorldData.get_segment_fields(index_file)
+        for addresses in address_groups:
+            if len(addresses) < 5:
+                # Records written before segment_version 2
+                type_string, header, blob_id, locator = \
+                    index_file.load(addresses)
+                load_header = lambda header = header: header
+                summary = ()
+                known_fields = ()
+            else:
+                header_address = addresses[1]
+                type_string, blob_id, locator, summary = \
+                    index_file.load(addresses[:1] + addresses[2:])
+                load_header = make_header_loader(index_file,
+                                                 header_address)
+                known_fields = fields
+
+            if type_string:
                 package_type = get_package_type(format = type_string)
-                package = package_type.parse(header, blob_id)
+                ghost_fields = dict([ (fields[i], value)
+                                      for i, value in summary ])
+                package = GhostPackage(package_type, blob_id,
+                                       ghost_fields, known_fields,
+                                       load_header)
                 found_filename = os.path.basename(locator.filename)
                 package['pdk', 'found-filename'] = found_filename
             else:
@@ -804,60 +1205,155 @@ class IndexedWorldData(object):
             yield item
     iter_world_items = staticmethod(iter_world_items)
 
+    def get_segment_name(section_name, section, indexed_fields):
+        '''Get the filename (within segment_dir) for a section segment.
+
+        Section identities are made of strings, so the name is the same
+        in every process and an unchanged segment is found again.
+        '''
+        identity = (segment_version, section.__class__.__name__,
+                    section.get_identity(), indexed_fields)
+        identity = sha.new(repr(identity)).hexdigest()
+        return '%s-%s' % (quote(section_name), identity)
+    get_segment_name = staticmethod(get_segment_name)
+
+    def get_segment_stamp(segment_file):
+        '''Get the stamp stored in a segment file, or None.'''
+        try:
+            for stamp in IndexFile(segment_file).get(stamp_key, 0):
+                return stamp
+        except (IndexFileMissingError, IndexFormatError):
+            pass
+        return None
+    get_segment_stamp = staticmethod(get_segment_stamp)
+
     def build(self, sections_iterator, index_file):
         '''Build up IndexedWorldData from the data in the given sections.
+
+        Sections whose stamp matches the stamp stored in their existing
+        segment are not indexed again.
         '''
-        indexed_field_names = ('name', 'sp-name', 'source-rpm', 'filename')
-        indexed_fields = [ ('pdk', f) for f in indexed_field_names ]
+        segment_dir = index_file + '.d'
+        ensure_directory_exists(segment_dir)
+        segment_records = []
+        for section_name, section in sections_iterator:
+            segment_name = self.get_segment_name(section_name, section,
+                                                 self.indexed_fields)
+            segment_file = pjoin(segment_dir, segment_name)
+            stamp = section.get_stamp()
+            if stamp is None or \
+                    stamp != self.get_segment_stamp(segment_file):
+                logger.info('Indexing %s: %r' % (section_name, section))
+                self.build_segment(section_name, section, stamp,
+                                   segment_file)
+            segment_records.append((section_name, segment_name, stamp))
+
         index_writer = IndexWriter(index_file)
         index_writer.init()
+        for record in segment_records:
+            addresses = index_writer.add(record)
+            index_writer.index([ segments_key ], addresses)
+        index_writer.terminate()
+
+        current_names = [ r[1] for r in segment_records ]
+        for segment_name in os.listdir(segment_dir):
+            if segment_name not in current_names:
+                os.unlink(pjoin(segment_dir, segment_name))
+
+        # Next time index_file is accessed, it will be reloaded,
+        # therefore actually reading the new file we just wrote!
+        del self.index_file
+        del self.segments
+        del self.available_fields
+
+    def get_summary(self, ghost):
+        '''Get the compact form of the indexed fields of a ghost package.
+
+        The summary is a tuple of (position, value) pairs, where the
+        position refers to self.indexed_fields. Only fields the ghost
+        actually holds are included.
+        '''
+        if not ghost:
+            return ()
+        summary = []
+        for position, field in enumerate(self.indexed_fields):
+            if dict.__contains__(ghost, field):
+                summary.append((position, ghost[field]))
+        return tuple(summary)
+
+    def build_segment(self, section_name, section, stamp, segment_file):
+        '''Index a single section into the given segment file.
+
+        The segment is written aside and renamed into place, so an
+        interrupted build never leaves a segment which looks current.
+        '''
+        new_segment_file = segment_file + '.new'
+        index_writer = IndexWriter(new_segment_file)
+        index_writer.init()
         try:
-            for section_name, section in sections_iterator:
-                section_iterator = section.iter_package_info()
-                for ghost, header, blob_id, locator in section_iterator:
-                    if ghost:
-                        type_string = ghost.type
-                    else:
-                        type_string = None
-
-                    addresses = index_writer.add(type_string, header,
-                                                 blob_id, locator)
-                    if ghost:
-                        index_keys = []
-                        for field in indexed_fields:
-                            try:
-                                value = ghost[field]
-                            except KeyError:
-                                continue
-                            key = (section_name, field, value)
-                            index_keys.append(key)
-                        index_writer.index(index_keys, addresses)
-
-                    ent_id_key = ('ent-id', blob_id)
-                    channel_key = section_name
-                    index_writer.index([ ent_id_key, channel_key ],
-                                       addresses)
-            index_writer.terminate()
-            del index_writer
-            # Next time index_file is accessed, it will be reloaded,
-            # therefore actually reading the new file we just wrote!
-            del self.index_file
-
+            section_iterator = section.iter_package_info()
+            for ghost, header, blob_id, locator in section_iterator:
+                if ghost:
+                    type_string = ghost.type
+                else:
+                    type_string = None
+
+                summary = self.get_summary(ghost)
+                addresses = index_writer.add(type_string, header,
+                                             blob_id, locator, summary)
+                if ghost:
+                    index_keys = []
+                    for field in self.indexed_fields:
+                        try:
+                            value = ghost[field]
+                        except KeyError:
+                            continue
+                        for index_value in get_index_values(field, value):
+                            key = (section_name, field, index_value)
+                            if key not in index_keys:
+                                index_keys.append(key)
+                    index_writer.index(index_keys, addresses)
+
+                ent_id_key = ('ent-id', blob_id)
+                channel_key = section_name
+                index_writer.index([ ent_id_key, channel_key ],
+                                   addresses)
         except MissingChannelDataError:
+            index_writer.terminate()
+            os.unlink(new_segment_file)
             message = 'Missing cached data. ' + \
                       'Consider running pdk channel update. ' + \
                       '(%s)' % section_name
             raise SemanticError(message)
 
+        addresses = index_writer.add(tuple(self.indexed_fields))
+        index_writer.index([ fields_key ], addresses)
+        if stamp is not None:
+            addresses = index_writer.add(stamp)
+            index_writer.index([ stamp_key ], addresses)
+        index_writer.terminate()
+        os.rename(new_segment_file, segment_file)
+
+def make_header_loader(index_file, address):
+    '''Return a function which loads the header at address.'''
+    def _load_header():
+        '''Unpickle the header from the index file.'''
+        return index_file.load((address,))[0]
+    return _load_header
+
 class LimitedWorldDataIndex(object):
     '''Essentially impersonate IndexedWorldData but filter outputs.
 
     Does basically everything IndexedWorldData does, but all outputs are
     filtered by the given list of channel names.
+
+    explain - when true, users of this index should report the plans
+              they use to find candidates.
     '''
-    def __init__(self, data_index, channel_names):
+    def __init__(self, data_index, channel_names, explain = False):
         self.data_index = data_index
         self.channel_names = channel_names
+        self.explain = explain
 
     def iter_candidates(self, key_field, key):
         '''See IndexedWorldData.iter_candidates.
@@ -867,6 +1363,25 @@ class LimitedWorldDataIndex(object):
         return self.data_index.iter_candidates(key_field, key,
                                                self.channel_names)
 
+    def plan(self, condition):
+        '''See IndexedWorldData.plan.'''
+        return self.data_index.plan(condition)
+
+    def iter_planned_candidates(self, plan):
+        '''See IndexedWorldData.iter_planned_candidates.
+
+        Filters output by self.channel_names.
+        '''
+        return self.data_index.iter_planned_candidates(plan,
+                                                       self.channel_names)
+
+    def explain_plan(self, plan):
+        '''See IndexedWorldData.explain_plan.
+
+        Only candidates in self.channel_names are counted.
+        '''
+        return self.data_index.explain_plan(plan, self.channel_names)
+
     def iter_all_candidates(self):
         '''Iterate over all package candidates filtered by channel name.'''
         icc = self.data_index.iter_channel_candidates
@@ -874,6 +1389,51 @@ class LimitedWorldDataIndex(object):
             if item.package:
                 yield item
 
+class WorldIndexSession(object):
+    '''Share candidate lookups between many users of a world index.
+
+    Impersonates LimitedWorldDataIndex. The items found by each plan
+    are kept, so a candidate list used by many stanzas, possibly from
+    many components, is loaded and its ghost packages parsed only once.
+    '''
+    def __init__(self, world_index):
+        self.world_index = world_index
+        self.explain = world_index.explain
+        self.found = {}
+
+    def plan(self, condition):
+        '''See LimitedWorldDataIndex.plan.'''
+        return self.world_index.plan(condition)
+
+    def explain_plan(self, plan):
+        '''See LimitedWorldDataIndex.explain_plan.'''
+        return self.world_index.explain_plan(plan)
+
+    def get_candidates(self, plan):
+        '''Get the list of items found by the plan.
+
+        A plan of None finds all candidates.
+        '''
+        if plan not in self.found:
+            if plan is None:
+                items = self.world_index.iter_all_candidates()
+            else:
+                items = self.world_index.iter_planned_candidates(plan)
+            self.found[plan] = list(items)
+        return self.found[plan]
+
+    def iter_planned_candidates(self, plan):
+        '''See LimitedWorldDataIndex.iter_planned_candidates.'''
+        return iter(self.get_candidates(plan))
+
+    def iter_all_candidates(self):
+        '''See LimitedWorldDataIndex.iter_all_candidates.'''
+        return iter(self.get_candidates(None))
+
+    def iter_candidates(self, key_field, key):
+        '''See LimitedWorldDataIndex.iter_candidates.'''
+        return self.world_index.iter_candidates(key_field, key)
+
 class MassAcquirer(object):
     '''Acquire blob_ids from multiple sources with one method call.
 
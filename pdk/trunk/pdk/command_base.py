@@ -172,6 +172,61 @@ class CommandSpec(object):
                    default = False,
                    help = "Show unchanged items in report.")
 
+            elif item == 'explain':
+                op('--explain',
+                   action = "store_true",
+                   dest = 'explain',
+                   default = False,
+                   help = "Log how candidate packages are looked up.")
+
+            elif item == 'incremental':
+                op('--incremental',
+                   action = "store_true",
+                   dest = 'incremental',
+                   default = False,
+                   help = "Update the previous output instead of "
+                          "starting over.")
+
+            elif item == 'jobs':
+                op('-j', '--jobs',
+                   type = "int",
+                   dest = 'jobs',
+                   default = 1,
+                   metavar = 'N',
+                   help = "Spread the work over N processes.")
+
+            elif item == 'full':
+                op('--full',
+                   action = "store_true",
+                   dest = 'full',
+                   default = False,
+                   help = "Check everything, even if it was checked "
+                          "before.")
+
+            elif item == 'history':
+                op('--history',
+                   type = "int",
+                   dest = 'history',
+                   default = 0,
+                   metavar = 'N',
+                   help = "Also consider the N commits before HEAD.")
+
+            elif item == 'keep-days':
+                op('--keep-days',
+                   type = "int",
+                   dest = 'keep_days',
+                   default = None,
+                   metavar = 'DAYS',
+                   help = "Keep anything used in the last DAYS days.")
+
+            elif item == 'levels':
+                op('--levels',
+                   type = "int",
+                   dest = 'levels',
+                   default = 2,
+                   metavar = 'N',
+                   help = "Keep blobs under N directory levels.")
+
             elif item == 'force':
                 op('-f', '--force',
                    action = "store_true",
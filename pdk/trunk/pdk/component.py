@@ -27,10 +27,9 @@ machine modifying components.
 """
 import os
 from operator import lt, le, gt, ge, eq
-from itertools import chain
 from sets import Set
 from pdk.util import write_pretty_xml, parse_xml, parse_domain, \
-     string_domain
+     string_domain, parallel_map
 from cElementTree import ElementTree, Element, SubElement
 from pdk.rules import Rule, RuleSystem, CompositeAction, make_comparable
 from pdk import rules
@@ -40,7 +39,7 @@ from pdk.meta import Entity, Entities
 from xml.parsers.expat import ExpatError
 from pdk.log import get_logger
 from pdk.semdiff import print_report
-from pdk.channels import PackageNotFoundError
+from pdk.channels import PackageNotFoundError, WorldIndexSession
 from pdk.debish_condition import compile_debish
 
 class ComponentDescriptor(object):
@@ -383,10 +382,8 @@ class ComponentDescriptor(object):
         abstract_constraint -
                        whether stanzas must be resolved or unresolved.
         """
-        if ('pdk', 'no-resolve', '1') in self.meta:
-            return
-        for stanza in self.iter_package_refs(abstract_constraint):
-            stanza.resolve(find_package, cache, world_index)
+        resolve_descriptors([ self ], find_package, cache, world_index,
+                            abstract_constraint)
 
     def note_download_info(self, acquirer, extended_cache):
         '''Recursively traverse and note blob ids in the acquirer.'''
@@ -997,11 +994,36 @@ class PackageStanza(object):
         return Rule(condition, action)
     rule = property(get_rule)
 
+    def _iter_candidates(self, world_index, condition, warn = False):
+        '''Iterate over world items which may match the condition.
+
+        The index lookups are planned from the condition. Without a
+        plan, every package in the world is produced.
+
+        warn         - log a warning when no plan could be made.
+        '''
+        plan = world_index.plan(condition)
+        if world_index.explain:
+            lines = world_index.explain_plan(plan)
+            message = 'Plan for %s %r:\n  ' % (self.name, condition) + \
+                      '\n  '.join(lines)
+            get_logger().info(message)
+        if plan:
+            return world_index.iter_planned_candidates(plan)
+
+        if warn:
+            message = 'Using unoptimized package list. ' + \
+                      'This operation may take a long time.\n' + \
+                      ' condition = %r' % condition
+            logger = get_logger()
+            logger.warn(message)
+        return world_index.iter_all_candidates()
+
     def _get_parent_match(self, find_package, cache, world_index):
         '''Find a package which represents a match for this stanza.
 
         The world index is searched. It is only efficient if this stanza
-        has a name condition.
+        requires a value for some indexed field, such as the name.
 
         find_package - a function we can call to pick the right package
                        out of a world_items iterator.
@@ -1012,17 +1034,8 @@ class PackageStanza(object):
                        whether stanzas must be resolved or unresolved.
         '''
 
-        if self.name:
-            item_list = world_index.iter_candidates(('pdk', 'name'),
-                                                    self.name)
-        else:
-            item_list = world_index.iter_all_candidates()
-            message = 'Using unoptimized package list. ' + \
-                      'This operation may take a long time.\n' + \
-                      ' condition = %r' % self.rule.condition
-            logger = get_logger()
-            logger.warn(message)
-
+        item_list = self._iter_candidates(world_index,
+                                          self.rule.condition, True)
         found_package = find_package(cache, self, item_list)
         if found_package:
             return found_package
@@ -1032,25 +1045,11 @@ class PackageStanza(object):
     def _get_child_condition(self, world_index, parent_match):
         '''Find a condition which represents parent and child packages.
 
-        Also returns an iterator over potential package matches. Some
-        optimization has been done to prevent this interator from covering
-        the whole world.
+        Also returns an iterator over potential package matches, planned
+        from the condition so it does not cover the whole world.
         '''
-        child_condition, candidate_key_info = \
-            get_child_condition(parent_match, self)
-
-        if self.name:
-            item_list = world_index.iter_candidates(('pdk', 'name'),
-                                                    self.name)
-        else:
-            item_list = world_index.iter_all_candidates()
-        parent_candidates = item_list
-
-        key_domain, key_field, key_value = candidate_key_info
-        candidate_key = (key_domain, key_field)
-        child_candidates = world_index.iter_candidates(candidate_key,
-                                                       key_value)
-        candidates = chain(parent_candidates, child_candidates)
+        child_condition, dummy = get_child_condition(parent_match, self)
+        candidates = self._iter_candidates(world_index, child_condition)
         return (child_condition, candidates)
 
     def resolve(self, find_package, cache, world_index):
@@ -1066,6 +1065,15 @@ class PackageStanza(object):
                                               world_index)
         if not parent_match:
             return
+        self.resolve_children(world_index, parent_match)
+
+    def resolve_children(self, world_index, parent_match):
+        """Replace the children of this stanza given its parent match.
+
+        world_index  - a world index we will use to search for candidate
+                       packages.
+        parent_match - the package found for this stanza.
+        """
         child_condition, candidate_items = \
             self._get_child_condition(world_index, parent_match)
 
@@ -1107,6 +1115,52 @@ class PackageStanza(object):
     def __hash__(self):
         return hash(self.__identity_tuple())
 
+def resolve_descriptors(descriptors, find_package, cache, world_index,
+                        abstract_constraint, workers = 1):
+    """Resolve abstract references in many descriptors at once.
+
+    All the stanzas to resolve are collected first and grouped by the
+    plan used to find their candidates. Each group's candidates are
+    loaded once, and the lookups share a WorldIndexSession, so
+    packages common to many descriptors are only parsed once.
+
+    Searching for parent matches may be spread over worker processes
+    with pdk.util.parallel_map. The children are then filled in by
+    this process.
+
+    See ComponentDescriptor.resolve for the other parameters.
+    workers      - number of worker processes to use.
+    """
+    session = WorldIndexSession(world_index)
+    groups = {}
+    jobs = []
+    for descriptor in descriptors:
+        if ('pdk', 'no-resolve', '1') in descriptor.meta:
+            continue
+        for stanza in descriptor.iter_package_refs(abstract_constraint):
+            condition = stanza.rule.condition
+            plan = session.plan(condition)
+            if plan not in groups:
+                groups[plan] = \
+                    list(stanza._iter_candidates(session, condition, True))
+            jobs.append((stanza, groups[plan]))
+
+    def _find_position(job):
+        '''Return the position of the parent match in the candidates.'''
+        stanza, candidates = job
+        found_package = find_package(cache, stanza, iter(candidates))
+        if found_package:
+            for position, item in enumerate(candidates):
+                if item.package is found_package:
+                    return position
+        return None
+
+    positions = parallel_map(_find_position, jobs, workers)
+    for (stanza, candidates), position in zip(jobs, positions):
+        if position is not None:
+            parent_match = candidates[position].package
+            stanza.resolve_children(session, parent_match)
+
 class ComponentReference(object):
     '''Represents a component reference.
 
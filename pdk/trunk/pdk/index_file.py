@@ -25,13 +25,32 @@ objects. The objects cannot refer to one another, however, the objects
 can themselves be small trees of objects, so long as there are no
 inter-object-tree relationships (at least direct ones).
 
+Two versions of the format exist. Both start with the magic bytes
+"pdko", a big endian version number and the offset of the key table.
+
+Version 1 stores the key table as a single pickled dict, which must be
+loaded in full before any lookup can happen.
+
+Version 2 stores the key table as a sorted array of fixed width
+records (key digest, address list offset) followed by the record
+count. The table is memory mapped and binary searched, so opening an
+index costs the same no matter how many keys it holds.
 '''
 
 import os
+import mmap
 import struct
-from cPickle import Pickler, Unpickler
+import sha
+from cPickle import Pickler, Unpickler, dumps
 from pdk.exceptions import SemanticError, InputError
 
+current_version = 2
+supported_versions = (1, 2)
+
+key_record_format = '>20sQ'
+key_record_size = struct.calcsize(key_record_format)
+digest_size = 20
+
 def pack_offset(number):
     '''Pack the number into an 8 byte string.'''
     return struct.pack('Q', number)
@@ -44,10 +63,36 @@ def read_offset(handle):
     '''Read an 8 byte number from a file handle.'''
     return unpack_offset(handle.read(8), 0)
 
+def make_magic(version):
+    '''Return the 8 magic bytes which start an index of version.'''
+    return 'pdko' + struct.pack('>I', version)
+
+def canonical_key(key):
+    '''Return a string which uniquely represents an index key.
+
+    Keys which compare equal as dictionary keys ('a' and u'a', for
+    instance) must produce the same string here.
+    '''
+    if isinstance(key, unicode):
+        return 's' + key.encode('utf-8')
+    elif isinstance(key, str):
+        return 's' + key
+    elif isinstance(key, tuple):
+        parts = [ canonical_key(part) for part in key ]
+        return 't%d:' % len(parts) + \
+               ''.join([ '%d:%s' % (len(p), p) for p in parts ])
+    else:
+        return 'p' + dumps(key, 2)
+
+def digest_key(key):
+    '''Return the fixed width digest stored in the version 2 key table.'''
+    return sha.new(canonical_key(key)).digest()
+
 class IndexWriter(object):
     '''Build up a persitent index containing individually pickled objects.
 
     filename - filename containing the index
+    version - file format version to write, defaults to current_version
 
     To use:
     writer = IndexWriter(filename)
@@ -58,8 +103,11 @@ class IndexWriter(object):
         writer.index([ more, keys], addresses)
     writer.terminate()
     '''
-    def __init__(self, filename):
+    def __init__(self, filename, version = current_version):
+        if version not in supported_versions:
+            raise SemanticError('Unsupported index version %r' % version)
         self.filename = filename
+        self.version = version
         self.index_table = {}
         self.handle = None
         self.pickler = None
@@ -67,27 +115,52 @@ class IndexWriter(object):
     def init(self):
         '''Actually open (truncate) the file and write header.'''
         self.handle = open(self.filename, 'w')
-        self.handle.write('pdko' + struct.pack('>I', 1))
+        self.handle.write(make_magic(self.version))
         self.handle.write(pack_offset(0))
         self.pickler = Pickler(self.handle, 2)
 
     def terminate(self):
         '''Writes object indexes and closes the file.'''
-        key_dict = {}
+        if self.version == 1:
+            table_offset = self.write_key_dict()
+        else:
+            table_offset = self.write_key_table()
 
+        self.handle.seek(8)
+        self.handle.write(pack_offset(table_offset))
+        self.handle.close()
+
+    def write_address_lists(self):
+        '''Pickle each address list and yield key, offset pairs.'''
         for key, address_list in self.index_table.iteritems():
             list_offset = self.handle.tell()
-            key_dict[key] = list_offset
             self.pickler.clear_memo()
             self.pickler.dump(address_list)
+            yield key, list_offset
+
+    def write_key_dict(self):
+        '''Write the version 1 pickled key dict. Return its offset.'''
+        key_dict = {}
+        for key, list_offset in self.write_address_lists():
+            key_dict[key] = list_offset
 
         table_offset = self.handle.tell()
         self.pickler.clear_memo()
         self.pickler.dump(key_dict)
+        return table_offset
 
-        self.handle.seek(8)
-        self.handle.write(pack_offset(table_offset))
-        self.handle.close()
+    def write_key_table(self):
+        '''Write the version 2 sorted key table. Return its offset.'''
+        records = [ (digest_key(key), list_offset)
+                    for key, list_offset in self.write_address_lists() ]
+        records.sort()
+
+        table_offset = self.handle.tell()
+        for digest, list_offset in records:
+            self.handle.write(struct.pack(key_record_format, digest,
+                                          list_offset))
+        self.handle.write(pack_offset(len(records)))
+        return table_offset
 
     def add(self, *objects):
         '''Add a group objects.
@@ -117,55 +190,130 @@ class IndexFormatError(InputError):
     '''Indicates that the magic bytes of an IndexFile are incorrect.'''
     pass
 
+class KeyDictTable(object):
+    '''Look up address list offsets in a version 1 index.
+
+    The whole pickled key dict is loaded up front.
+    '''
+    def __init__(self, handle, unpickler, table_offset):
+        handle.seek(table_offset)
+        self.key_dict = unpickler.load()
+
+    def find(self, key):
+        '''Return the address list offset for key, or None.'''
+        return self.key_dict.get(key)
+
+class MappedKeyTable(object):
+    '''Look up address list offsets in a version 2 index.
+
+    The sorted key table is memory mapped and binary searched.
+    '''
+    def __init__(self, handle, table_offset):
+        size = os.fstat(handle.fileno()).st_size
+        self.map = mmap.mmap(handle.fileno(), size,
+                             access = mmap.ACCESS_READ)
+        self.table_offset = table_offset
+        self.length = unpack_offset(self.map, size - 8)
+        table_end = table_offset + self.length * key_record_size
+        if table_end != size - 8:
+            message = 'Key table of %s is truncated.' % handle.name
+            raise IndexFormatError, message
+
+    def get_record(self, position):
+        '''Return the (digest, offset) record at the table position.'''
+        start = self.table_offset + position * key_record_size
+        return struct.unpack(key_record_format,
+                             self.map[start:start + key_record_size])
+
+    def find(self, key):
+        '''Return the address list offset for key, or None.'''
+        digest = digest_key(key)
+        low, high = 0, self.length
+        while low < high:
+            middle = (low + high) // 2
+            start = self.table_offset + middle * key_record_size
+            if self.map[start:start + digest_size] < digest:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.length:
+            found_digest, list_offset = self.get_record(low)
+            if found_digest == digest:
+                return list_offset
+        return None
+
 class IndexFile(object):
     '''Open an index file for reading.
 
     filename - the file containing the index.
 
     Use the get and get_all method to return objects in the index.
+
+    The file is reopened when used from a forked process, so parent
+    and child never move each other's file position.
     '''
     def __init__(self, filename):
         if not os.path.exists(filename):
             raise IndexFileMissingError(filename)
         self.filename = filename
-        self.handle = open(self.filename)
-        self.unpickler = Unpickler(self.handle)
+        self.open_handle()
         magic = self.handle.read(8)
-        expected_magic = 'pdko\x00\x00\x00\x01'
-        if magic != expected_magic:
+        for version in supported_versions:
+            if magic == make_magic(version):
+                self.version = version
+                break
+        else:
             message = 'Magic bytes incorrect. Is %s really a pdko file?' \
                       % self.filename
             raise IndexFormatError, message
         table_offset = read_offset(self.handle)
-        self.handle.seek(table_offset)
-        self.key_dict = self.unpickler.load()
+        if self.version == 1:
+            self.key_table = KeyDictTable(self.handle, self.unpickler,
+                                          table_offset)
+        else:
+            self.key_table = MappedKeyTable(self.handle, table_offset)
+
+    def open_handle(self):
+        '''Open the handle and unpickler used to read objects.'''
+        self.handle = open(self.filename)
+        self.unpickler = Unpickler(self.handle)
+        self.pid = os.getpid()
+
+    def seek(self, offset):
+        '''Seek to offset, first reopening the file after a fork.'''
+        if self.pid != os.getpid():
+            self.open_handle()
+        self.handle.seek(offset)
 
     def iter_addresses(self, key):
         '''Get a list of pickle addresses for the given key.'''
-        try:
-            list_offset = self.key_dict[key]
-            self.handle.seek(list_offset)
-            address_list = self.unpickler.load()
-            for addresses in address_list:
-                yield addresses
-        except KeyError:
+        list_offset = self.key_table.find(key)
+        if list_offset is None:
             return
+        self.seek(list_offset)
+        address_list = self.unpickler.load()
+        for addresses in address_list:
+            yield addresses
 
     def get(self, key, column):
         '''The columnth object for all object groups under they key.'''
         for addresses in self.iter_addresses(key):
             offset = addresses[column]
-            self.handle.seek(offset)
+            self.seek(offset)
             yield self.unpickler.load()
 
+    def load(self, addresses):
+        '''Get the object group stored at the given addresses.'''
+        objects = []
+        for offset in addresses:
+            self.seek(offset)
+            objects.append(self.unpickler.load())
+        return tuple(objects)
+
     def get_all(self, key):
         '''Get the full object group count for the key.'''
         for addresses in self.iter_addresses(key):
-            objects = []
-            for offset in addresses:
-                self.handle.seek(offset)
-                objects.append(self.unpickler.load())
-            yield tuple(objects)
+            yield self.load(addresses)
 
     def count(self, key):
         '''Get the object group count for the given key.'''
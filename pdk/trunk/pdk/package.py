@@ -187,9 +187,86 @@ class Package(Entity):
         return self.ent_type == other.ent_type \
                and self.ent_id == other.ent_id
 
+    def clone(self):
+        """Return a copy of this package which may be changed freely.
+
+        Field values are shared, as they are replaced, never changed in
+        place.
+        """
+        package = Package(self.package_type, self.blob_id)
+        package.update(self)
+        package.links = list(self.links)
+        package.complement = list(self.complement)
+        return package
+
 # evil hack so that getattr and hasattr will work for blob DASH id
 setattr(Package, 'blob-id', property(lambda self: self.blob_id))
 
+class GhostPackage(Package):
+    '''A package which parses its header only when it has to.
+
+    The package starts out with a few pre-decoded fields. Every field
+    in known_fields is authoritative: when it is missing from fields,
+    it is missing from the package as well. Looking at any other field
+    calls load_header() and parses the result to fill in the rest of
+    the package.
+    '''
+    # Package works these out itself, parsing never stores them.
+    computed_fields = (('pdk', 'type'), ('pdk', 'role'),
+                       ('pdk', 'format'), ('pdk', 'blob-id'))
+
+    def __init__(self, package_type, blob_id, fields, known_fields,
+                 load_header):
+        super(GhostPackage, self).__init__(package_type, blob_id)
+        dict.update(self, fields)
+        self.known_fields = known_fields
+        self.load_header = load_header
+
+    def materialize(self):
+        '''Parse the header, if that hasn't happened yet.'''
+        if not self.load_header:
+            return
+        load_header = self.load_header
+        self.load_header = None
+        package = self.package_type.parse(load_header(), self.blob_id)
+        for key, value in dict.iteritems(package):
+            if not dict.__contains__(self, key):
+                dict.__setitem__(self, key, value)
+
+    def is_known(self, key):
+        '''Can the field be looked up without parsing the header?'''
+        return not self.load_header or dict.__contains__(self, key) \
+               or key in self.known_fields or key in self.computed_fields
+
+    def __contains__(self, key):
+        if not self.is_known(key):
+            self.materialize()
+        return dict.__contains__(self, key)
+    has_key = __contains__
+
+    def get(self, key, default = None):
+        if not self.is_known(key):
+            self.materialize()
+        return dict.get(self, key, default)
+
+    def __nonzero__(self):
+        # A ghost always has fields. Don't let truth testing fall back
+        # on __len__, which would parse the header.
+        return True
+
+def materializing(method):
+    """Wrap a dict method so the ghost is parsed before it is called."""
+    def _materialize_and_call(self, *args):
+        '''Materialize the ghost and call the dict method.'''
+        self.materialize()
+        return method(self, *args)
+    return _materialize_and_call
+
+for _name in ('keys', 'items', 'values', 'iterkeys', 'iteritems',
+              'itervalues', '__iter__', '__len__', 'copy'):
+    setattr(GhostPackage, _name, materializing(getattr(dict, _name)))
+del _name
+
 def split_deb_version(raw_version):
     """Break a debian version string into it's component parts."""
     return re.match(debver.VERRE, raw_version).groups()
@@ -449,6 +526,9 @@ def parse_rpm_header(raw_header, blob_id = None, package_type = None):
         rpm_prefix = 'http://linux.duke.edu/metadata/rpm'
         prefii = { 'common': common_prefix, 'rpm': rpm_prefix }
         srpm_path = '{%(common)s}format/{%(rpm)s}sourcerpm' % prefii
+        group_path = '{%(common)s}format/{%(rpm)s}group' % prefii
+        provides_path = '{%(common)s}format/{%(rpm)s}provides/' \
+                        '{%(rpm)s}entry' % prefii
         def get_element(tag):
             '''Try to find an element
 
@@ -502,6 +582,14 @@ def parse_rpm_header(raw_header, blob_id = None, package_type = None):
             package_type = rpm
         pdk_dict['pdk', 'source-rpm'] = source_rpm
 
+        group_element = package_element.find(group_path)
+        if group_element is not None:
+            pdk_dict['rpm', 'group'] = group_element.text
+        provides = [ e.get('name')
+                     for e in package_element.findall(provides_path) ]
+        if provides:
+            pdk_dict['rpm', 'provides'] = ', '.join(provides)
+
         version_string = '%(epoch)s-%(ver)s-%(rel)s' % version_info
         pdk_dict['pdk', 'version'] = \
             package_type.version_class(version_string = version_string)
@@ -535,6 +623,10 @@ def parse_rpm_header(raw_header, blob_id = None, package_type = None):
         package[('pdk', 'version')] = RPMVersion(header)
         package[('rpm', 'arch')] = header[rpm_api.RPMTAG_ARCH]
         package[('pdk', 'source-rpm')] = source_rpm
+        package[('rpm', 'group')] = header[rpm_api.RPMTAG_GROUP]
+        provides = header[rpm_api.RPMTAG_PROVIDENAME]
+        if provides:
+            package[('rpm', 'provides')] = ', '.join(provides)
 
         # note the nosource and/or nopatch attributes
         keys = header.keys()
@@ -81,5 +81,9 @@ commands.alias(['create', 'workspace'], ['workspace', 'create'])
 commands.map(('workspace', 'create'), Command(ws, 'create'))
 commands.map(('channel', 'update'), Command(ws, 'world_update'))
 commands.map(('remote', 'listen'), Command(ws, 'listen'))
+commands.map(('cache', 'gc'), Command('pdk.cache_gc', 'gc'))
+commands.map(('cache', 'layout'), Command(ws, 'cache_layout'))
+commands.map(('cache', 'index-headers'),
+             Command('pdk.cache_headers', 'index_headers'))
 
 # vim:set ai et sw=4 ts=4 tw=75:
@@ -0,0 +1,234 @@
+# $Progeny$
+#
+#   Copyright 2006 Progeny Linux Systems, Inc.
+#
+#   This file is part of PDK.
+#
+#   PDK is free software; you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   PDK is distributed in the hope that it will be useful, but WITHOUT
+#   ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#   or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+#   License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with PDK; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+'''
+Plan channel index lookups for rule conditions.
+
+plan_condition walks a condition from pdk.rules and finds the parts
+of it which the channel index can answer:
+
+Equality relations on indexed fields become index scans.
+The members of an and condition which can be planned are intersected.
+An or condition is a union, if every member can be planned.
+
+Anything else, including range relations such as version >> 1.0, is
+not planned. The full condition is still evaluated against every
+package a plan produces, so a plan only needs to find a superset of
+the matches.
+
+Plans work on the address groups found in one index file at a time,
+so only the packages which can possibly match are ever unpickled and
+parsed.
+'''
+
+import re
+from operator import eq
+from sets import Set
+from pdk.rules import RelationCondition, AndCondition, OrCondition, \
+     make_comparable
+from pdk.util import string_domain
+
+# Fields holding a list of relationships, indexed by each bare name.
+relation_fields = (('deb', 'Provides'), ('rpm', 'provides'))
+
+def split_relation_names(value):
+    '''Get the bare package names from a Provides style field.'''
+    names = []
+    for relation in re.split(r'[,|]', value):
+        words = relation.split('(')[0].split()
+        if words:
+            names.append(words[0])
+    return names
+
+def get_index_values(field, value):
+    '''Return the values under which a field value is indexed.
+
+    Most values are indexed as they are. Relationship fields are
+    indexed under each name they contain, and versions are indexed
+    without their epoch. Either way, a package whose field equals the
+    value is always found under each of the returned values.
+
+    Returns an empty list for values which can't be indexed.
+    '''
+    if field in relation_fields:
+        return split_relation_names(value)
+    elif field == ('pdk', 'version'):
+        if hasattr(value, 'string_without_epoch'):
+            return [ value.string_without_epoch ]
+        return []
+    else:
+        return [ value ]
+
+def plan_condition(condition, indexed_fields):
+    '''Return a plan for finding candidates for the condition.
+
+    indexed_fields - the (domain, predicate) fields which may be
+                     looked up in the index.
+
+    Returns None if the index can't narrow down the candidates.
+    '''
+    # Wrappers which evaluate through another condition, like
+    # pdk.component.PhantomConditionWrapper, are planned from it.
+    condition = getattr(condition, 'phantom_wrapper', condition)
+
+    if isinstance(condition, RelationCondition):
+        return plan_relation(condition, indexed_fields)
+
+    elif isinstance(condition, AndCondition):
+        plans = []
+        for member in condition.conditions:
+            plan = plan_condition(member, indexed_fields)
+            if plan:
+                plans.append(plan)
+        if not plans:
+            return None
+        return make_plan(IntersectPlan, plans)
+
+    elif isinstance(condition, OrCondition):
+        plans = []
+        for member in condition.conditions:
+            plan = plan_condition(member, indexed_fields)
+            if not plan:
+                return None
+            plans.append(plan)
+        return make_plan(UnionPlan, plans)
+
+    return None
+
+def plan_relation(condition, indexed_fields):
+    '''Return a plan for a single relation, or None.'''
+    if condition.condition is not eq:
+        return None
+    field = (condition.domain, condition.predicate)
+    if field not in indexed_fields:
+        return None
+    plans = [ IndexScan(field, value)
+              for value in get_index_values(field, condition.target) ]
+    if not plans:
+        return None
+    return make_plan(IntersectPlan, plans)
+
+def make_plan(plan_class, plans):
+    '''Combine plans with plan_class, unless there is just one.'''
+    if len(plans) == 1:
+        return plans[0]
+    return plan_class(plans)
+
+class IndexScan(object):
+    '''Find the packages indexed under a value of a field.'''
+    def __init__(self, field, value):
+        self.field = field
+        self.value = value
+
+    def get_addresses(self, index_file, section_name):
+        '''Get the set of address groups for this plan in an index file.
+        '''
+        key = (section_name, self.field, self.value)
+        return Set(index_file.iter_addresses(key))
+
+    def describe(self):
+        '''Return a one line description of this plan.'''
+        return 'index %s = %r' % (string_domain(*self.field), self.value)
+
+    def get_children(self):
+        '''Return the plans this plan combines.'''
+        return []
+
+    def get_identity(self):
+        '''Return the comparable identity for this object.'''
+        return (self.field, self.value)
+
+make_comparable(IndexScan)
+
+class IntersectPlan(object):
+    '''Find the packages found by all the given plans.'''
+    def __init__(self, plans):
+        self.plans = plans
+
+    def get_addresses(self, index_file, section_name):
+        '''Get the set of address groups for this plan in an index file.
+        '''
+        found = None
+        for plan in self.plans:
+            addresses = plan.get_addresses(index_file, section_name)
+            if found is None:
+                found = addresses
+            else:
+                found = found & addresses
+            if not found:
+                break
+        return found
+
+    def describe(self):
+        '''Return a one line description of this plan.'''
+        return 'intersect'
+
+    def get_children(self):
+        '''Return the plans this plan combines.'''
+        return self.plans
+
+    def get_identity(self):
+        '''Return the comparable identity for this object.'''
+        return tuple(self.plans)
+
+make_comparable(IntersectPlan)
+
+class UnionPlan(object):
+    '''Find the packages found by any of the given plans.'''
+    def __init__(self, plans):
+        self.plans = plans
+
+    def get_addresses(self, index_file, section_name):
+        '''Get the set of address groups for this plan in an index file.
+        '''
+        found = Set()
+        for plan in self.plans:
+            found = found | plan.get_addresses(index_file, section_name)
+        return found
+
+    def describe(self):
+        '''Return a one line description of this plan.'''
+        return 'union'
+
+    def get_children(self):
+        '''Return the plans this plan combines.'''
+        return self.plans
+
+    def get_identity(self):
+        '''Return the comparable identity for this object.'''
+        return tuple(self.plans)
+
+make_comparable(UnionPlan)
+
+def explain_plan(plan, index_files, depth = 0):
+    '''Return lines describing the plan and the candidates it finds.
+
+    index_files - (section_name, index_file) pairs the plan is run on.
+    '''
+    count = 0
+    for section_name, index_file in index_files:
+        count += len(plan.get_addresses(index_file, section_name))
+    lines = [ '%s%s: %d candidates' % ('  ' * depth, plan.describe(),
+                                       count) ]
+    for child in plan.get_children():
+        lines.extend(explain_plan(child, index_files, depth + 1))
+    return lines
+
+# vim:set ai et sw=4 ts=4 tw=75:
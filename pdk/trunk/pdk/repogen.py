@@ -28,15 +28,27 @@ import os.path
 from time import strftime, gmtime
 import re
 import md5
+import sha
+import shutil
+import struct
+import zlib
+import bz2
 from sets import Set
 from itertools import chain
 from commands import mkarg
-from pdk.exceptions import SemanticError, InputError, IntegrityFault
+from cPickle import Pickler, Unpickler, UnpicklingError
+from pdk.exceptions import InputError, IntegrityFault
 import pdk.log as log
 from pdk.util import ensure_directory_exists, pjoin, LazyWriter, \
-     parse_domain
+     parse_domain, gen_file_fragments, cached_property, parallel_map
 from pdk.package import udeb
 
+try:
+    # sha256 is only available from python 2.5 on.
+    import hashlib
+except ImportError:
+    hashlib = None
+
 logger = log.get_logger()
 
 __revision__ = "$Progeny$"
@@ -85,7 +97,8 @@ def make_deb_field_comparator(field_order):
 deb_source_field_cmp = make_deb_field_comparator(deb_source_field_order)
 deb_binary_field_cmp = make_deb_field_comparator(deb_binary_field_order)
 
-def compile_product(component_name, cache, repo_dir, get_desc):
+def compile_product(component_name, cache, repo_dir, get_desc,
+                    incremental = False, workers = 1):
     """Compile the product described by the component.
 
     component_name is a component to load and compile a repo from.
@@ -94,13 +107,13 @@ def compile_product(component_name, cache, repo_dir, get_desc):
 
     repo_dir should be an absolute directory were the repo will be
     created.
-    """
 
-    compiler = Compiler(cache)
+    incremental - update an apt-deb repo left in repo_dir by a previous
+    run, instead of building it again from scratch.
 
-    repo_types = { 'report': compiler.dump_report,
-                   'apt-deb': compiler.create_debian_pool_repo,
-                   'raw': compiler.create_raw_package_dump_repo }
+    workers - the number of processes used to write an apt-deb repo.
+    """
+    repo_type_names = ('report', 'apt-deb', 'raw')
 
     product = get_desc(component_name).load(cache)
     contents = product.meta
@@ -119,16 +132,291 @@ def compile_product(component_name, cache, repo_dir, get_desc):
         else:
             repo_type_string = 'raw'
 
-    if repo_type_string not in repo_types:
+    if repo_type_string not in repo_type_names:
         message = 'invalid repo-type given for %s' % component_name
         raise InputError, message
-    repo_type = repo_types[repo_type_string]
 
-    if os.path.exists(repo_dir):
+    previous = None
+    if incremental and repo_type_string == 'apt-deb':
+        previous = RepoManifest.load(repo_dir)
+
+    if os.path.exists(repo_dir) and not previous:
         os.system('rm -rf %s' % mkarg(repo_dir))
 
+    compiler = Compiler(cache, previous, workers)
+    repo_types = { 'report': compiler.dump_report,
+                   'apt-deb': compiler.create_debian_pool_repo,
+                   'raw': compiler.create_raw_package_dump_repo }
+    repo_type = repo_types[repo_type_string]
     repo_type(product, contents, repo_dir)
 
+class Summer(object):
+    """Calculate the size and the Release checksums of a stream.
+
+    The sums are (size, md5, sha1, sha256). sha256 is None when the
+    python in use can't calculate it.
+    """
+    def __init__(self):
+        self.size = 0
+        self.calcs = [ md5.new(), sha.new() ]
+        if hashlib:
+            self.calcs.append(hashlib.sha256())
+
+    def update(self, block):
+        """Add a block of the stream."""
+        self.size += len(block)
+        for calc in self.calcs:
+            calc.update(block)
+
+    def get_sums(self):
+        """Return the sums of the stream so far."""
+        digests = [ calc.hexdigest() for calc in self.calcs ]
+        if not hashlib:
+            digests.append(None)
+        return tuple([self.size] + digests)
+
+def get_file_sums(filename):
+    """Return (size, md5, sha1, sha256) for an existing file."""
+    summer = Summer()
+    for block in gen_file_fragments(filename):
+        summer.update(block)
+    return summer.get_sums()
+
+class SummingFile(object):
+    """A file being written which is checksummed on the way."""
+    def __init__(self, filename):
+        self.name = filename
+        self.handle = open(filename, 'w')
+        self.summer = Summer()
+
+    def write(self, block):
+        """Checksum the block and write it."""
+        if block:
+            self.summer.update(block)
+            self.handle.write(block)
+
+    def close(self):
+        """Close the file and return its sums."""
+        self.handle.close()
+        return self.summer.get_sums()
+
+class GzipCompressor(object):
+    """Produce a gzip stream like gzip -n does.
+
+    No file name or timestamp is stored, so the same input always
+    gives the same bytes.
+    """
+    header = '\037\213\010\000\000\000\000\000\002\377'
+
+    def __init__(self):
+        self.deflater = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                         zlib.DEF_MEM_LEVEL, 0)
+        self.crc = zlib.crc32('')
+        self.size = 0
+        self.started = False
+
+    def compress(self, block):
+        """Return compressed data for the block, and maybe earlier ones.
+        """
+        self.crc = zlib.crc32(block, self.crc)
+        self.size += len(block)
+        data = self.deflater.compress(block)
+        if not self.started:
+            self.started = True
+            data = self.header + data
+        return data
+
+    def flush(self):
+        """Return the rest of the compressed stream."""
+        data = self.deflater.flush()
+        if not self.started:
+            self.started = True
+            data = self.header + data
+        trailer = struct.pack('<LL', self.crc & 0xffffffffL,
+                              self.size & 0xffffffffL)
+        return data + trailer
+
+class IndexWriter(object):
+    """Write a package index and its compressed forms in one pass.
+
+    The plain, .gz and .bz2 files are written and checksummed as the
+    index is written, so none of them are read again afterwards. Like
+    LazyWriter, nothing is created until something is written.
+    """
+    def __init__(self, filename):
+        self.name = filename
+        self.outputs = None
+
+    def open_if_needed(self):
+        """Create the files if it hasn't been done yet."""
+        if self.outputs is None:
+            ensure_directory_exists(os.path.dirname(self.name))
+            self.outputs = [ ('', None, SummingFile(self.name)),
+                             ('.gz', GzipCompressor(),
+                              SummingFile(self.name + '.gz')),
+                             ('.bz2', bz2.BZ2Compressor(9),
+                              SummingFile(self.name + '.bz2')) ]
+
+    def write(self, block):
+        """Write a block to the index and its compressed forms."""
+        self.open_if_needed()
+        for dummy, compressor, handle in self.outputs:
+            if compressor:
+                handle.write(compressor.compress(block))
+            else:
+                handle.write(block)
+
+    def close(self):
+        """Finish the files.
+
+        Returns { suffix: (size, md5, sha1, sha256) } for the files
+        written.
+        """
+        sums = {}
+        if self.is_started():
+            for suffix, compressor, handle in self.outputs:
+                if compressor:
+                    handle.write(compressor.flush())
+                sums[suffix] = handle.close()
+            self.outputs = None
+        return sums
+
+    def is_started(self):
+        """Have we started writing to the files yet?"""
+        return self.outputs is not None
+
+def get_stanza_key(injector):
+    """Return the stanza key of an injector. Used with parallel_map."""
+    return injector.stanza_key
+
+def cache_apt_header(injector):
+    """Make sure the apt header of an injector is in the cache.
+
+    Used with parallel_map, so the header is not sent back.
+    """
+    injector.get_apt_header()
+
+def get_index_stamp(injectors):
+    """Sum up the apt headers written to a single index file."""
+    keys = [ injector.stanza_key for injector in injectors ]
+    return md5.new('\n'.join(keys)).hexdigest()
+
+# Change this when the way apt headers are rendered changes, so that
+# headers stored in the cache are rendered again.
+stanza_version = 1
+
+# Suffixes of the files written for each package index.
+index_suffixes = ('', '.gz', '.bz2')
+
+# Suffix of a pool file linked to replace a file from an earlier run.
+replacement_suffix = '.pdk-new'
+
+class RepoManifest(object):
+    """Record what repogen put into a repository.
+
+    An incremental run compares itself against the manifest of the
+    previous run to find the pool links and index files it can keep.
+
+    links - { pool file path: blob_id }
+    indexes - { index file path: stamp of the packages in the index }
+    sums - { index or Release file path: (size, md5, sha1, sha256) }
+
+    All paths are relative to repo_dir.
+    """
+    file_name = '.pdk-manifest'
+    format_version = 3
+
+    def __init__(self, repo_dir):
+        self.repo_dir = repo_dir
+        self.links = {}
+        self.indexes = {}
+        self.sums = {}
+
+    def get_manifest_path(repo_dir):
+        """Return the path of the manifest kept in a repository."""
+        return pjoin(repo_dir, RepoManifest.file_name)
+    get_manifest_path = staticmethod(get_manifest_path)
+
+    def load(repo_dir):
+        """Load the manifest written to repo_dir by a previous run.
+
+        Returns None if there is no usable manifest.
+        """
+        manifest_path = RepoManifest.get_manifest_path(repo_dir)
+        if not os.path.exists(manifest_path):
+            return None
+        handle = open(manifest_path)
+        try:
+            try:
+                version, links, indexes, sums = Unpickler(handle).load()
+            except (EOFError, UnpicklingError, ValueError, TypeError):
+                return None
+        finally:
+            handle.close()
+        if version != RepoManifest.format_version:
+            return None
+        manifest = RepoManifest(repo_dir)
+        manifest.links = links
+        manifest.indexes = indexes
+        manifest.sums = sums
+        return manifest
+    load = staticmethod(load)
+
+    def remove(repo_dir):
+        """Remove the manifest from repo_dir, if there is one.
+
+        This is done before the repository is changed, so that a run
+        which is interrupted can't leave a manifest which no longer
+        matches the repository behind.
+        """
+        manifest_path = RepoManifest.get_manifest_path(repo_dir)
+        if os.path.exists(manifest_path):
+            os.unlink(manifest_path)
+    remove = staticmethod(remove)
+
+    def write(self):
+        """Write the manifest to the repository."""
+        manifest_path = self.get_manifest_path(self.repo_dir)
+        new_path = manifest_path + '.new'
+        handle = open(new_path, 'w')
+        record = (self.format_version, self.links, self.indexes,
+                  self.sums)
+        Pickler(handle, 2).dump(record)
+        handle.close()
+        os.rename(new_path, manifest_path)
+
+    def get_path(self, relative_path):
+        """Return the absolute path of a file in the repository."""
+        return pjoin(self.repo_dir, relative_path)
+
+    def has_index(self, index_path, stamp):
+        """Can the files of the index from the previous run be reused?
+        """
+        if self.indexes.get(index_path) != stamp:
+            return False
+        for suffix in index_suffixes:
+            path = index_path + suffix
+            if path not in self.sums or \
+                   not os.path.exists(self.get_path(path)):
+                return False
+        return True
+
+def swap_directory(new_dir, target_dir):
+    """Replace target_dir with new_dir.
+
+    Both directories must be on the same file system, so that each
+    step is a single rename.
+    """
+    if os.path.exists(target_dir):
+        old_dir = target_dir + '.old'
+        if os.path.exists(old_dir):
+            shutil.rmtree(old_dir)
+        os.rename(target_dir, old_dir)
+        os.rename(new_dir, target_dir)
+        shutil.rmtree(old_dir)
+    else:
+        os.rename(new_dir, target_dir)
+
 class DebianPoolInjector(object):
     """This class handles the details of putting a package into a
     traditional Debian-style pool.  It also creates apt-style headers
@@ -213,17 +501,13 @@ class DebianPoolInjector(object):
 
 
     def get_file_size_and_hash(self):
-        """Return (size, md5) for the main package file."""
+        """Return (size, md5) for the main package file.
 
-        fn = self.cache.file_path(self.package.blob_id)
-        size = os.stat(fn).st_size
-
-        f = open(fn)
-        m = md5.new(f.read())
-        digest = m.hexdigest()
-        f.close()
-
-        return (size, digest)
+        Both come from the cache, so the file is not read.
+        """
+        blob_id = self.package.blob_id
+        return (self.cache.get_size(blob_id),
+                self.cache.get_md5_digest(blob_id))
 
     def get_source_file_line(self, blob_id, filename):
         """Return a line appropriate for a single Sources 'Files:' entry.
@@ -232,9 +516,8 @@ class DebianPoolInjector(object):
         return ' %s %d %s' \
                % (md5sum, self.cache.get_size(blob_id), filename)
 
-    def get_apt_header(self):
-        """Return the full apt header for the package the object
-        handles.
+    def get_package_fields(self):
+        """Return the apt fields which are taken from the package itself.
         """
         apt_fields = {}
         # I'm not entirely sure about this, as we are tangling apt
@@ -247,12 +530,7 @@ class DebianPoolInjector(object):
                 continue
             apt_fields[predicate] = value
 
-        pool_path_dir = self.get_relative_pool_path()
-        (size, md5_digest) = self.get_file_size_and_hash()
         if self.package.role == 'binary':
-            field_cmp = deb_binary_field_cmp
-            pool_path = os.path.join(pool_path_dir, self.package.filename)
-
             sp_name_str = self.package.pdk.sp_name
             if self.package.pdk.sp_version != self.package.version:
                 sp_version_str = self.package.pdk.sp_version.full_version
@@ -260,7 +538,43 @@ class DebianPoolInjector(object):
             else:
                 source_value = sp_name_str
             apt_fields['Source'] = source_value
+        return apt_fields
+
+    def __create_stanza_key(self):
+        """A digest of everything the apt header depends on.
+
+        Besides the blob, section and pool path, this covers the
+        package fields, since component metadata may override them.
+        """
+        fields = self.get_package_fields().items()
+        fields.sort()
+        key = (stanza_version, self.package.blob_id, self.section,
+               self.get_relative_pool_path(), fields)
+        return md5.new(repr(key)).hexdigest()
+    stanza_key = cached_property('stanza_key', __create_stanza_key)
 
+    def get_apt_header(self):
+        """Return the full apt header for the package the object
+        handles.
+
+        Rendered headers are kept in the cache under stanza_key, so
+        each one is only rendered once.
+        """
+        blob_id = self.package.blob_id
+        stanza = self.cache.load_stanza(blob_id, self.stanza_key)
+        if stanza is None:
+            stanza = ''.join(self.render_apt_header())
+            self.cache.add_stanza(stanza, blob_id, self.stanza_key)
+        return stanza.splitlines(True)
+
+    def render_apt_header(self):
+        """Build the full apt header as a list of lines."""
+        apt_fields = self.get_package_fields()
+        pool_path_dir = self.get_relative_pool_path()
+        if self.package.role == 'binary':
+            field_cmp = deb_binary_field_cmp
+            pool_path = os.path.join(pool_path_dir, self.package.filename)
+            (size, md5_digest) = self.get_file_size_and_hash()
             apt_fields["Size"] = str(size)
             apt_fields["Filename"] = pool_path
             apt_fields["MD5Sum"] = md5_digest
@@ -305,14 +619,19 @@ class DebianPoolInjector(object):
         return arches
 
 
-    def link_to_cache(self):
+    def link_to_cache(self, replaced = ()):
         """Hard-link the cache file into the proper location in the
         pool.
+
+        Locations in replaced are still in use, so they are linked
+        under replacement_suffix beside the file they will replace.
         """
 
         pexist = os.path.exists
         locations = self.get_links()
         for link_dest, blob_id in locations.items():
+            if link_dest in replaced:
+                link_dest += replacement_suffix
             link_src = self.cache.file_path(blob_id)
             if pexist(link_dest):
                 if os.path.samefile(link_src, link_dest):
@@ -331,6 +650,101 @@ class DebianPoolInjector(object):
                     % (message, link_src,link_dest)
                     )
 
+class DebianPoolLinks(object):
+    """Keep the pool of a repository in step with its packages.
+
+    Pool files linked by a previous run are left alone. Files which
+    the previous run linked but are no longer needed are removed by
+    remove_stale, after the new indexes stop referring to them. Files
+    which now hold a different blob are linked beside the old ones and
+    renamed over them by replace_changed, once the new indexes are in
+    place.
+    """
+    def __init__(self, repo_dir, previous = None):
+        self.repo_dir = pjoin(repo_dir)
+        self.previous = previous
+        self.links = {}
+        self.replaced = Set()
+        self.pending = {}
+
+    def get_relative_path(self, location):
+        """Return the path of a pool location relative to repo_dir."""
+        return location[len(self.repo_dir):].lstrip(os.path.sep)
+
+    def add(self, injector):
+        """Note the files of the injector's package for the pool.
+
+        Files which are not already in place are linked by
+        link_pending.
+        """
+        if self.previous:
+            old_links = self.previous.links
+        else:
+            old_links = {}
+        changed = False
+        for location, blob_id in injector.get_links().items():
+            path = self.get_relative_path(location)
+            self.links[path] = blob_id
+            old_blob_id = old_links.get(path)
+            if old_blob_id == blob_id:
+                continue
+            changed = True
+            # A file from the previous run is in the way.
+            if old_blob_id and location not in self.replaced \
+                   and os.path.exists(location):
+                self.replaced.add(location)
+                new_location = location + replacement_suffix
+                if os.path.exists(new_location):
+                    os.unlink(new_location)
+        if changed:
+            pool_dir = injector.get_pool_dir()
+            self.pending.setdefault(pool_dir, []).append(injector)
+
+    def link_pending(self, workers = 1):
+        """Link the files noted by add into the pool.
+
+        The work is split up by pool directory, so files which may
+        conflict are always linked by the same process.
+        """
+        replaced = self.replaced
+        def _link_pool_dir(injectors):
+            """Link the files for the packages of one pool directory."""
+            for injector in injectors:
+                injector.link_to_cache(replaced)
+        pool_dirs = self.pending.keys()
+        pool_dirs.sort()
+        parallel_map(_link_pool_dir,
+                     [ self.pending[pool_dir] for pool_dir in pool_dirs ],
+                     workers)
+        self.pending = {}
+
+    def replace_changed(self):
+        """Move the files linked by link_pending over the files they
+        replace."""
+        for location in self.replaced:
+            new_location = location + replacement_suffix
+            if os.path.samefile(new_location, location):
+                # rename does nothing for two links to one file.
+                os.unlink(new_location)
+            else:
+                os.rename(new_location, location)
+        self.replaced = Set()
+
+    def remove_stale(self):
+        """Remove pool files which are no longer in the repository."""
+        if not self.previous:
+            return
+        for path in self.previous.links:
+            if path in self.links:
+                continue
+            location = pjoin(self.repo_dir, path)
+            if os.path.exists(location):
+                os.unlink(location)
+            try:
+                os.removedirs(os.path.dirname(location))
+            except OSError:
+                pass
+
 class DebianPoolRepo(object):
     """Create a full repository from a Debian pool, using
     apt-ftparchive to do the actual work.  Injectors are used to write
@@ -463,7 +877,21 @@ class DebianPoolRepo(object):
 
 class DebianDirectPoolRepo(DebianPoolRepo):
     """Create a full repository from a Debian pool.  Use injectors
-    both to create the pool on the fly and to write the indexes."""
+    both to create the pool on the fly and to write the indexes.
+
+    previous is the RepoManifest of the repository built by an earlier
+    run. Index files listing the same packages as before are linked
+    from that repository instead of being written again.
+    """
+
+    def __init__(self, work_dir, dist, arches, sections, repo_dir,
+                 previous = None):
+        self.previous = previous
+        self.members = {}
+        self.indexes = {}
+        self.sums = {}
+        super(DebianDirectPoolRepo, self).__init__(work_dir, dist, arches,
+                                                   sections, repo_dir)
 
     def _iter_file_list_keys(self):
         '''Yield a series of keys suitable for use as file_list keys.
@@ -479,7 +907,7 @@ class DebianDirectPoolRepo(DebianPoolRepo):
                         yield (section, subsection, arch)
 
     def get_file_lists(self):
-        """Get a dictionary of LazyWriters keyed by section and arch.
+        """Get a dictionary of IndexWriters keyed by section and arch.
 
         Key format is (section, subsection, arch)
 
@@ -487,21 +915,24 @@ class DebianDirectPoolRepo(DebianPoolRepo):
         """
         lists = {}
         for key in self._iter_file_list_keys():
-            section, subsection, arch = key
-            if arch == "source":
-                file_name = "%s/%s/source/Sources" \
-                            % (self.dist, section)
-            else:
-                if subsection:
-                    file_name = "%s/%s/%s/binary-%s/Packages" \
-                                % (self.dist, section, subsection, arch)
-                else:
-                    file_name = "%s/%s/binary-%s/Packages" \
-                                % (self.dist, section, arch)
-            full_name = pjoin(self.repo_dir, file_name)
-            lists[key] = LazyWriter(full_name)
+            full_name = pjoin(self.repo_dir, self.get_index_path(key))
+            lists[key] = IndexWriter(full_name)
         return lists
 
+    def get_index_path(self, key):
+        """Return the path of an index file relative to repo_dir.
+
+        See get_file_lists for the key format.
+        """
+        section, subsection, arch = key
+        if arch == "source":
+            return "%s/%s/source/Sources" % (self.dist, section)
+        elif subsection:
+            return "%s/%s/%s/binary-%s/Packages" \
+                   % (self.dist, section, subsection, arch)
+        else:
+            return "%s/%s/binary-%s/Packages" % (self.dist, section, arch)
+
 
     def get_file_list(self, arch, section):
         """Return the package indexes for a single section and
@@ -516,20 +947,118 @@ class DebianDirectPoolRepo(DebianPoolRepo):
 
 
     def write_to_lists(self, injector):
-        """Record this package in the appropriate file lists."""
+        """Record this package in the appropriate file lists.
+
+        The lists are written out by write_repo.
+        """
+        subsection = injector.get_subsection()
         for arch in injector.get_architectures(self.arches):
-            subsection = injector.get_subsection()
-            handle = self.file_lists[(injector.section, subsection, arch)]
-            handle.write("".join(injector.get_apt_header()))
+            key = (injector.section, subsection, arch)
+            self.members.setdefault(key, []).append(injector)
 
 
-    def write_repo(self):
-        """Write the repository index files."""
-        self.flush_lists()
-        for file_list in self.file_lists.values():
-            if file_list.is_started():
-                os.system("gzip -n < %s > %s.gz"
-                          % (file_list.name, file_list.name))
+    def get_injectors(self):
+        """Return each injector in the file lists once, in list order.
+        """
+        injectors = []
+        seen = Set()
+        keys = self.members.keys()
+        keys.sort()
+        for key in keys:
+            for injector in self.members[key]:
+                if id(injector) not in seen:
+                    seen.add(id(injector))
+                    injectors.append(injector)
+        return injectors
+
+    def write_repo(self, workers = 1):
+        """Write the repository index files.
+
+        The stanza keys of all the packages are worked out by workers
+        processes, package by package, so the work is even however the
+        packages fall into sections and architectures. Stanzas which
+        are not yet in the cache are rendered the same way before the
+        index files are written.
+
+        The index files are then shared out among the workers. Each
+        file only depends on its own packages, so the files come out
+        the same however the work is divided.
+        """
+        injectors = self.get_injectors()
+        stanza_keys = parallel_map(get_stanza_key, injectors, workers)
+        for injector, stanza_key in zip(injectors, stanza_keys):
+            injector.stanza_key = stanza_key
+
+        work = []
+        for key, injectors in self.members.items():
+            index_path = self.get_index_path(key)
+            stamp = get_index_stamp(injectors)
+            self.indexes[index_path] = stamp
+            if self.previous and self.previous.has_index(index_path, stamp):
+                self.link_previous_index(index_path)
+                continue
+            work.append((-len(injectors), key))
+
+        # Start the biggest indexes first to keep the workers even.
+        work.sort()
+        keys = [ key for dummy, key in work ]
+        if workers > 1:
+            stale = Set([ id(injector) for key in keys
+                          for injector in self.members[key] ])
+            parallel_map(cache_apt_header,
+                         [ injector for injector in injectors
+                           if id(injector) in stale ],
+                         workers)
+        all_sums = parallel_map(self.write_index, keys, workers)
+        for key, sums in zip(keys, all_sums):
+            index_path = self.get_index_path(key)
+            for suffix, file_sums in sums.items():
+                self.sums[index_path + suffix] = file_sums
+
+    def write_index(self, key):
+        """Write a single index file.
+
+        Returns the sums of the files written, keyed by suffix.
+        """
+        file_list = self.file_lists[key]
+        for injector in self.members[key]:
+            file_list.write("".join(injector.get_apt_header()))
+        return file_list.close()
+
+    def link_previous_index(self, index_path):
+        """Link the files of an index from the previous repository."""
+        for suffix in index_suffixes:
+            path = index_path + suffix
+            full_path = pjoin(self.repo_dir, path)
+            ensure_directory_exists(os.path.dirname(full_path))
+            os.link(self.previous.get_path(path), full_path)
+            self.sums[path] = self.previous.sums[path]
+
+    def write_releases(self, writer):
+        """Write all Release files for the repository.
+
+        The toplevel Release file is built from the sums recorded
+        while writing the other files, so no index is read again.
+        """
+        for section in self.sections:
+            for arch in self.arches:
+                release_path = pjoin(self.get_one_dir(section, arch),
+                                     'Release')
+                handle = LazyWriter(release_path)
+                writer.write(handle, section, arch)
+                handle.close()
+                path = release_path[len(pjoin(self.repo_dir)) + 1:]
+                self.sums[path] = get_file_sums(release_path)
+
+        dist_prefix = self.dist + '/'
+        dist_sums = [ (path[len(dist_prefix):], sums)
+                      for path, sums in self.sums.items()
+                      if path.startswith(dist_prefix) ]
+        dist_sums.sort()
+        release_path = pjoin(self.repo_dir, self.dist, 'Release')
+        handle = LazyWriter(release_path)
+        writer.write_outer(handle, dist_sums)
+        handle.close()
 
 
 class DebianReleaseWriter(object):
@@ -577,16 +1106,18 @@ class DebianReleaseWriter(object):
         handle.flush()
 
 
-    def write_outer(self, handle):
-        """Write the toplevel Release file."""
-        apt_handle = os.popen('apt-ftparchive release %s | grep -v ^Date'
-                              % str(self.search_path))
-        sums = apt_handle.read()
-        status = apt_handle.close()
+    def write_outer(self, handle, file_sums = None):
+        """Write the toplevel Release file.
 
-        if status:
-            print status
-            raise SemanticError, 'archiver returned %d' % status
+        file_sums is a sorted list of (path, sums) for the files under
+        the search path, as recorded while writing them. Without it,
+        the files are found and checksummed here.
+        """
+        if file_sums is None:
+            file_sums = [ (path, get_file_sums(pjoin(self.search_path,
+                                                     path)))
+                          for path in find_release_files(self.search_path) ]
+        sums = format_release_sums(file_sums)
 
         print >> handle, 'Origin: %s' % self.origin
         print >> handle, 'Label: %s' % self.label
@@ -600,6 +1131,41 @@ class DebianReleaseWriter(object):
         handle.write(sums)
 
 
+# Files under a dist which are listed in its toplevel Release file.
+release_file_pattern = re.compile(r'^(Packages|Sources|Release|Contents)')
+
+def find_release_files(search_path):
+    """Return the sorted paths, relative to search_path, of the files
+    to list in a toplevel Release file.
+    """
+    found = []
+    for dir_path, dummy, file_names in os.walk(search_path):
+        relative_dir = dir_path[len(search_path):].lstrip(os.path.sep)
+        for file_name in file_names:
+            if not release_file_pattern.match(file_name):
+                continue
+            if not relative_dir and file_name == 'Release':
+                continue
+            found.append(pjoin(relative_dir, file_name))
+    found.sort()
+    return found
+
+def format_release_sums(file_sums):
+    """Format the checksum sections of a toplevel Release file.
+
+    file_sums is a list of (path, (size, md5, sha1, sha256)). The
+    SHA256 section is left out if any sha256 is missing.
+    """
+    sections = [ (1, 'MD5Sum:'), (2, 'SHA1:') ]
+    if None not in [ sums[3] for dummy, sums in file_sums ]:
+        sections.append((3, 'SHA256:'))
+    lines = []
+    for index, title in sections:
+        lines.append(title)
+        for path, sums in file_sums:
+            lines.append(' %s %16d %s' % (sums[index], sums[0], path))
+    return '\n'.join(lines) + '\n'
+
 def get_apt_component_name(ref):
     """Extract an apt-component name from a component reference"""
     return os.path.basename(ref[:-4])
@@ -609,8 +1175,10 @@ class Compiler:
     needed to create a repository from a product.
     """
 
-    def __init__(self, cache):
+    def __init__(self, cache, previous = None, workers = 1):
         self.cache = cache
+        self.previous = previous
+        self.workers = workers
 
 
     def deb_scan_arches(self, packages):
@@ -665,30 +1233,45 @@ class Compiler:
         sections = packages_dict.keys()
         all_packages = Set(chain(*packages_dict.values()))
         arches = self.deb_scan_arches(all_packages)
-        # Set True to use apt-ftparchive, False to use the direct version.
+
+        # The dists tree is built to the side and swapped in whole,
+        # so the indexes in repo_dir never refer to missing files.
+        RepoManifest.remove(repo_dir)
+        stage_dir = pjoin(repo_dir, '.pdk-stage')
+        if os.path.exists(stage_dir):
+            shutil.rmtree(stage_dir)
         cwd = os.getcwd()
         suitepath = pjoin('dists', suite)
-        if False:
-            repo = DebianPoolRepo(cwd, suitepath, arches, sections,
-                                  repo_dir)
-        else:
-            repo = DebianDirectPoolRepo(cwd, suitepath, arches, sections,
-                                        repo_dir)
+        repo = DebianDirectPoolRepo(cwd, suitepath, arches, sections,
+                                    stage_dir, self.previous)
 
         search_path = pjoin(repo.repo_dir, repo.dist)
         contents['apt-deb', 'archive'] = suite
         writer = DebianReleaseWriter(contents, arches, sections,
                                      search_path)
         repo.make_all_dirs()
+        pool = DebianPoolLinks(repo_dir, self.previous)
         for section, packages in packages_dict.items():
             for package in packages:
                 injector = DebianPoolInjector(self.cache, package, section,
-                                              repo.repo_dir)
+                                              repo_dir)
                 repo.write_to_lists(injector)
-                injector.link_to_cache()
-        repo.write_repo()
+                pool.add(injector)
+        pool.link_pending(self.workers)
+        repo.write_repo(self.workers)
         repo.write_releases(writer)
 
+        swap_directory(pjoin(stage_dir, 'dists'), pjoin(repo_dir, 'dists'))
+        shutil.rmtree(stage_dir)
+        pool.replace_changed()
+        pool.remove_stale()
+
+        manifest = RepoManifest(repo_dir)
+        manifest.links = pool.links
+        manifest.indexes = repo.indexes
+        manifest.sums = repo.sums
+        manifest.write()
+
     def create_raw_package_dump_repo(self, component, dummy, repo_dir):
         """Link all the packages in the product to the repository."""
         os.mkdir(repo_dir)
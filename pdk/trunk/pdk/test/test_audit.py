@@ -18,10 +18,13 @@
 #   along with PDK; if not, write to the Free Software Foundation,
 #   Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
+import os
 from sets import Set
-from pdk.test.utest_util import Test
+from pdk.test.utest_util import Test, TempDirTest
+from pdk.cache import Cache
+from pdk.util import pjoin
 
-from pdk.audit import Arbiter
+from pdk.audit import Arbiter, AuditLedger, verify_inodes
 
 __revision__ = "$Progeny$"
 
@@ -67,4 +70,45 @@ class TestAudit(Test):
                                 None, 'no warrant')]),
                           found)
 
+class TestAuditLedger(TempDirTest):
+    def set_up(self):
+        super(TestAuditLedger, self).set_up()
+        self.cache = Cache(pjoin(self.work_dir, 'cache'))
+        self.ledger_file = pjoin(self.work_dir, 'etc', 'audit-ledger')
+        self.found_by_inode = {}
+        for text in ('hello', 'goodbye'):
+            filename = self.cache.make_download_filename()
+            open(filename, 'w').write(text)
+            blob_ids = self.cache.incorporate_file(filename, None)
+            os.unlink(filename)
+            inode = self.cache.get_inode(blob_ids[0])
+            self.found_by_inode[inode] = Set(blob_ids)
+
+    def test_verify_inodes(self):
+        ledger = AuditLedger(self.ledger_file)
+        checksums = verify_inodes(self.cache, self.found_by_inode, ledger,
+                                  2)
+        for inode, blob_ids in self.found_by_inode.items():
+            self.assert_equal(blob_ids, Set(checksums[inode]))
+        self.fail_unless(os.path.exists(self.ledger_file))
+
+    def test_ledger_skips_verified_files(self):
+        verify_inodes(self.cache, self.found_by_inode,
+                      AuditLedger(self.ledger_file))
+
+        # Fake a ledger entry to prove the file is not read again.
+        ledger = AuditLedger(self.ledger_file)
+        stat_key = ledger.old_entries.keys()[0]
+        ledger.old_entries[stat_key] = ('sha-1:fake', 'md5:fake')
+        checksums = verify_inodes(self.cache, self.found_by_inode, ledger)
+        self.assert_equal(('sha-1:fake', 'md5:fake'),
+                          checksums[stat_key[0]])
+
+        full_ledger = AuditLedger(self.ledger_file, False)
+        self.assert_equal({}, full_ledger.old_entries)
+        checksums = verify_inodes(self.cache, self.found_by_inode,
+                                  full_ledger)
+        self.fail_unless(checksums[stat_key[0]][0].startswith('sha-1:'))
+        self.fail_if(checksums[stat_key[0]][0] == 'sha-1:fake')
+
 # vim:set ai et sw=4 ts=4 tw=75:
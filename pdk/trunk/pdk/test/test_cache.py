@@ -20,11 +20,17 @@
 
 import os
 import os.path
+import sha
+import threading
+from urllib import urlopen
 from sets import Set
-from pdk.test.utest_util import TempDirTest
+from BaseHTTPServer import HTTPServer
+from SimpleHTTPServer import SimpleHTTPRequestHandler
+from pdk.test.utest_util import Test, TempDirTest
 from pdk.channels import FileLocator
 from pdk.util import make_path_to
 from pdk.progress import NullMassProgress
+from pdk.package import Package, deb
 import pdk.cache
 
 __revision__ = "$Progeny$"
@@ -122,6 +128,24 @@ class TestCache(TempDirTest):
         inodes = Set([ cache.get_inode(i) for i in expected_ids ])
         self.assert_equals(1, len(inodes))
 
+    def test_import_local_file_links(self):
+        """Local files on the cache filesystem are linked, not copied."""
+        open('test', 'w').write('hello')
+        cache = pdk.cache.Cache(os.path.join(self.work_dir, 'cache'))
+        cache.import_file(FileLocator('', 'test', None, None, None),
+                          NullMassProgress())
+        blob_id = 'sha-1:aaf4c61ddcc5e8a2dabede0f3b482cd9aea9434d'
+        self.assert_equal(os.stat('test').st_ino, cache.get_inode(blob_id))
+
+    def test_checksum_writer(self):
+        handle = pdk.cache.ChecksumWriter(open('test', 'w'))
+        handle.write('hel')
+        handle.write('lo')
+        handle.close()
+        self.assert_equal(pdk.cache.calculate_checksums('test'),
+                          handle.get_blob_ids())
+        self.assert_equal('hello', open('test').read())
+
     def test_get_header_filename(self):
         """header filename is blob_id + .header"""
         cache = pdk.cache.Cache(os.path.join(self.work_dir, 'cache'))
@@ -130,4 +154,276 @@ class TestCache(TempDirTest):
             os.path.abspath(cache.get_header_filename('sha-1:a'))
             )
 
+    def test_md5_digest_from_checksums(self):
+        """Importing records the md5 beside the sha-1 blob."""
+        open('test', 'w').write('hello')
+        cache = pdk.cache.Cache(os.path.join(self.work_dir, 'cache'))
+        cache.import_file(FileLocator('', 'test', None, None, None),
+                          NullMassProgress())
+        blob_id = 'sha-1:aaf4c61ddcc5e8a2dabede0f3b482cd9aea9434d'
+        checksums_file = cache.get_checksums_filename(blob_id)
+        self.fail_unless(os.path.exists(checksums_file))
+        self.fail_unless(cache.is_metadata(checksums_file))
+        self.fail_if(cache.is_metadata(blob_id))
+
+        # The digest comes from the record, not from the blob.
+        open(cache.file_path(blob_id), 'w').write('changed')
+        self.assert_equal('5d41402abc4b2a76b9719d911017c592',
+                          cache.get_md5_digest(blob_id))
+        self.assert_equal('abc', cache.get_md5_digest('md5:abc'))
+
+    def test_md5_digest_without_checksums(self):
+        """Blobs without a record are checksummed once."""
+        cache = pdk.cache.Cache(os.path.join(self.work_dir, 'cache'))
+        blob_id = 'sha-1:aaf4c61ddcc5e8a2dabede0f3b482cd9aea9434d'
+        make_path_to(cache.file_path(blob_id))
+        open(cache.file_path(blob_id), 'w').write('hello')
+        self.assert_equal('5d41402abc4b2a76b9719d911017c592',
+                          cache.get_md5_digest(blob_id))
+        self.fail_unless(
+            os.path.exists(cache.get_checksums_filename(blob_id)))
+
+    def test_stanzas(self):
+        cache = pdk.cache.Cache(os.path.join(self.work_dir, 'cache'))
+        self.assert_equal(None, cache.load_stanza('sha-1:a', 'abc'))
+        cache.add_stanza('Package: a\n\n', 'sha-1:a', 'abc')
+        self.assert_equal('Package: a\n\n',
+                          cache.load_stanza('sha-1:a', 'abc'))
+        self.assert_equal(None, cache.load_stanza('sha-1:a', 'def'))
+        self.fail_unless(
+            cache.is_metadata(cache.get_stanza_filename('sha-1:a', 'abc')))
+
+    def test_blob_index(self):
+        """Membership of blobs is answered from the blob index."""
+        open('test', 'w').write('hello')
+        cache = pdk.cache.Cache(os.path.join(self.work_dir, 'cache'))
+        cache.write_index()
+        cache.import_file(FileLocator('', 'test', None, None, None),
+                          NullMassProgress())
+        blob_ids = ['md5:5d41402abc4b2a76b9719d911017c592',
+                    'sha-1:aaf4c61ddcc5e8a2dabede0f3b482cd9aea9434d']
+        self.assert_equal(Set(blob_ids),
+                          Set(open('cache/.blob-index').read().split()))
+        self.assert_equal(blob_ids[1:], list(cache.iter_sha1_ids()))
+
+        # A fresh cache object reads the index, not the blobs.
+        os.unlink(cache.file_path(blob_ids[1]))
+        cache = pdk.cache.Cache(os.path.join(self.work_dir, 'cache'))
+        self.fail_unless(blob_ids[1] in cache)
+        cache.write_index()
+        self.fail_if(blob_ids[1] in cache)
+        self.fail_unless(blob_ids[0] in cache)
+
+    def test_blob_index_rebuilt(self):
+        """A missing blob index is rebuilt, and is then authoritative."""
+        cache = pdk.cache.Cache(os.path.join(self.work_dir, 'cache'))
+        blob_id = 'sha-1:aaf4c61ddcc5e8a2dabede0f3b482cd9aea9434d'
+        make_path_to(cache.file_path(blob_id))
+        open(cache.file_path(blob_id), 'w').write('hello')
+        self.fail_unless(blob_id in cache)
+        self.assert_equal([blob_id],
+                          open('cache/.blob-index').read().split())
+
+        other_id = 'md5:5d41402abc4b2a76b9719d911017c592'
+        make_path_to(cache.file_path(other_id))
+        open(cache.file_path(other_id), 'w').write('hello')
+        self.fail_if(other_id in cache)
+        cache.write_index()
+        self.fail_unless(other_id in cache)
+        self.assert_equal([other_id, blob_id],
+                          open('cache/.blob-index').read().split())
+
+    def test_set_layout(self):
+        open('test', 'w').write('hello')
+        cache = pdk.cache.Cache(os.path.join(self.work_dir, 'cache'))
+        cache.import_file(FileLocator('', 'test', None, None, None),
+                          NullMassProgress())
+        blob_id = 'sha-1:aaf4c61ddcc5e8a2dabede0f3b482cd9aea9434d'
+        cache.add_header('header', blob_id)
+
+        cache.set_layout(2)
+        cache = pdk.cache.Cache(os.path.join(self.work_dir, 'cache'))
+        self.assert_equal(
+            os.path.abspath('cache/sha-1/aa/f4/' + blob_id),
+            cache.file_path(blob_id))
+        self.assert_equal('hello', open(cache.file_path(blob_id)).read())
+        self.assert_equal('header',
+                          open(cache.get_header_filename(blob_id)).read())
+        self.fail_if(os.path.exists('cache/md5/5d/' +
+                                    'md5:5d41402abc4b2a76b9719d911017c592'))
+
+        cache.set_layout(1)
+        self.assert_equal('hello', open(cache.file_path(blob_id)).read())
+        self.fail_if(os.path.exists('cache/sha-1/aa/f4'))
+        self.fail_if(os.path.exists('cache/md5/5d/41'))
+
+    def test_header_pack(self):
+        pack = pdk.cache.HeaderPack('pack')
+        self.assert_equal(None, pack.get('sha-1:a'))
+        pack.add([('sha-1:a', 'header a'), ('sha-1:b', 'header b')])
+        self.assert_equal('header a', pack.get('sha-1:a'))
+
+        # Appends from another pack object are found after remapping.
+        other = pdk.cache.HeaderPack('pack')
+        other.add([('sha-1:a', 'ignored'), ('sha-1:c', 'header c')])
+        pack.add([('sha-1:c', 'ignored')])
+        pack.entries = None
+        self.assert_equal('header c', pack.get('sha-1:c'))
+        self.assert_equal('header b', pack.get('sha-1:b'))
+        self.assert_equal('header aheader bheader c', open('pack').read())
+
+    def test_header_pack_torn_index(self):
+        pack = pdk.cache.HeaderPack('pack')
+        pack.add([('sha-1:a', 'header a')])
+
+        # An entry reaching past the end of the pack.
+        open('pack-index', 'a').write('sha-1:b 100 8\n')
+        pack = pdk.cache.HeaderPack('pack')
+        self.assert_equal(None, pack.get('sha-1:b'))
+
+        # An append interrupted inside the length of its index line.
+        open('pack', 'a').write('header c')
+        open('pack-index', 'a').write('sha-1:c 8 4')
+        pack = pdk.cache.HeaderPack('pack')
+        self.assert_equal('header a', pack.get('sha-1:a'))
+        self.assert_equal(None, pack.get('sha-1:c'))
+
+        # The next append starts on a line of its own.
+        pack.add([('sha-1:c', 'header c')])
+        pack = pdk.cache.HeaderPack('pack')
+        self.assert_equal('header a', pack.get('sha-1:a'))
+        self.assert_equal('header c', pack.get('sha-1:c'))
+
+    def test_index_headers(self):
+        cache = pdk.cache.Cache(os.path.join(self.work_dir, 'cache'))
+        packages = []
+        for index in range(5):
+            blob_id = 'sha-1:%040d' % index
+            make_path_to(cache.file_path(blob_id))
+            open(cache.file_path(blob_id), 'w').write('blob')
+            cache.add_header('header %d' % index, blob_id)
+            packages.append((blob_id, 'deb'))
+        packages.append(('sha-1:missing', 'deb'))
+
+        self.assert_equal(1, cache.index_headers(packages[:1], 0))
+        self.assert_equal(4, cache.index_headers(packages, 2))
+        self.assert_equal(0, cache.index_headers(packages, 2))
+        cache = pdk.cache.Cache(os.path.join(self.work_dir, 'cache'))
+        for index in range(5):
+            self.assert_equal('header %d' % index,
+                              cache.header_pack.get('sha-1:%040d' % index))
+        self.assert_equal(None, cache.header_pack.get('sha-1:missing'))
+
+class TestPackageMemo(Test):
+    def make_parse(self, blob_id):
+        def _parse():
+            self.parsed.append(blob_id)
+            return Package(deb, blob_id)
+        return _parse
+
+    def set_up(self):
+        self.parsed = []
+
+    def test_reuse(self):
+        memo = pdk.cache.PackageMemo(10)
+        key = ('sha-1:a', 'deb')
+        package = memo.get(key, self.make_parse('sha-1:a'))
+        package[('pdk', 'name')] = 'changed'
+        package.links.append(('deb', 'sha-1:b'))
+        again = memo.get(key, self.make_parse('sha-1:a'))
+        self.assert_equal(['sha-1:a'], self.parsed)
+        self.assert_equal((1, 1), (memo.hits, memo.misses))
+        self.fail_if(('pdk', 'name') in again)
+        self.assert_equal([], again.links)
+        self.assert_equal('sha-1:a', again.blob_id)
+
+    def test_least_used_dropped(self):
+        memo = pdk.cache.PackageMemo(4)
+        for name in 'abcd':
+            memo.get(name, self.make_parse(name))
+        memo.get('a', self.make_parse('a'))
+        memo.get('e', self.make_parse('e'))
+        self.assert_equal(['a', 'd', 'e'], sorted(memo.packages.keys()))
+        memo.get('b', self.make_parse('b'))
+        self.assert_equal(list('abcdeb'), self.parsed)
+
+    def test_disabled(self):
+        memo = pdk.cache.PackageMemo(0)
+        memo.get('a', self.make_parse('a'))
+        memo.get('a', self.make_parse('a'))
+        self.assert_equal(['a', 'a'], self.parsed)
+        self.assert_equal({}, memo.packages)
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *dummy):
+        pass
+
+class TestMultiImport(TempDirTest):
+    """Download from a throwaway http server serving the work dir."""
+    def set_up(self):
+        super(TestMultiImport, self).set_up()
+        self.server = HTTPServer(('127.0.0.1', 0), QuietHandler)
+        self.base_uri = 'http://127.0.0.1:%d' % self.server.server_port
+        self.running = True
+        self.thread = threading.Thread(target = self.serve)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def serve(self):
+        while self.running:
+            self.server.handle_request()
+
+    def tear_down(self):
+        self.running = False
+        try:
+            # wake the server so it notices it should stop
+            urlopen(self.make_locator('', None).get_full_url()).read()
+        except IOError:
+            pass
+        self.thread.join()
+        self.server.server_close()
+        super(TestMultiImport, self).tear_down()
+
+    def make_locator(self, filename, blob_id):
+        return FileLocator(self.base_uri, filename, blob_id, None, None)
+
+    def test_import_files(self):
+        locators = []
+        for index in range(7):
+            content = 'content %d' % index
+            filename = 'file%d' % index
+            open(filename, 'w').write(content)
+            blob_id = 'sha-1:' + sha.new(content).hexdigest()
+            locators.append(self.make_locator(filename, blob_id))
+
+        cache = pdk.cache.Cache(os.path.join(self.work_dir, 'cache'))
+        cache.import_files(locators, NullMassProgress(), 3)
+        for locator in locators:
+            assert locator.blob_id in cache
+            self.assert_equal(open(locator.filename).read(),
+                              open(cache.file_path(locator.blob_id)).read())
+        self.assert_equal([], [ f for f in os.listdir('cache')
+                                if f.endswith('.partial') ])
+
+    def test_import_files_checksum_mismatch(self):
+        open('good', 'w').write('good')
+        locator = self.make_locator('good', 'sha-1:bad')
+        cache = pdk.cache.Cache(os.path.join(self.work_dir, 'cache'))
+        try:
+            cache.import_files([locator], NullMassProgress(), 2)
+            self.fail('checksum mismatch should raise an error')
+        except pdk.cache.CacheImportError:
+            pass
+        self.assert_equal([], [ f for f in os.listdir('cache')
+                                if f.endswith('.partial') ])
+
+    def test_import_files_missing(self):
+        locator = self.make_locator('missing', 'sha-1:bad')
+        cache = pdk.cache.Cache(os.path.join(self.work_dir, 'cache'))
+        try:
+            cache.import_files([locator], NullMassProgress(), 2)
+            self.fail('missing file should raise an error')
+        except pdk.cache.CacheImportError:
+            pass
+
 # vim:set ai et sw=4 ts=4 tw=75:
@@ -0,0 +1,174 @@
+# $Progeny$
+#
+#   Copyright 2006 Progeny Linux Systems, Inc.
+#
+#   This file is part of PDK.
+#
+#   PDK is free software; you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   PDK is distributed in the hope that it will be useful, but WITHOUT
+#   ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#   or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+#   License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with PDK; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import os
+import sys
+import time
+from cStringIO import StringIO
+from sets import Set
+from pdk.test.utest_util import TempDirTest
+from pdk.cache import Cache
+from pdk.channels import FileLocator
+from pdk.progress import NullMassProgress
+from pdk.command_base import CommandArgs
+from pdk.exceptions import SemanticError
+import pdk.cache_gc
+from pdk.cache_gc import scan_descriptor, find_references, \
+     find_reachable, CacheCollector
+
+__revision__ = "$Progeny$"
+
+hello_ids = ('sha-1:aaf4c61ddcc5e8a2dabede0f3b482cd9aea9434d',
+             'md5:5d41402abc4b2a76b9719d911017c592')
+world_ids = ('sha-1:7c211433f02071597741e6ff5a8ea34789abbf43',
+             'md5:7d793037a0760186574b0282f2f435e7')
+
+class TestCacheGC(TempDirTest):
+    def set_up(self):
+        super(TestCacheGC, self).set_up()
+        self.cache = Cache(os.path.join(self.work_dir, 'cache'))
+        for name in ('hello', 'world'):
+            open(name, 'w').write(name)
+            self.cache.import_file(FileLocator('', name, None, None, None),
+                                   NullMassProgress())
+        self.cache.add_header('header', hello_ids[0])
+        self.cache.add_header('header', world_ids[0])
+
+    def test_scan_descriptor(self):
+        descriptor = StringIO('''<?xml version="1.0"?>
+<component>
+  <contents>
+    <deb ref="sha-1:aaa"/>
+    <deb>
+      <name>a</name>
+      <dsc ref="md5:bbb"/>
+    </deb>
+    <component>other.xml</component>
+    <component ref="not-a-blob"/>
+  </contents>
+</component>
+''')
+        self.assert_equal(Set([('deb', 'sha-1:aaa'), ('dsc', 'md5:bbb')]),
+                          Set(scan_descriptor(descriptor)))
+
+    def test_find_reachable(self):
+        refs = [('deb', 'sha-1:aaa'), ('file', 'md5:bbb')]
+        self.assert_equal(Set(['sha-1:aaa', 'md5:bbb']),
+                          find_reachable(self.cache, refs))
+
+    def test_find_garbage(self):
+        collector = CacheCollector(self.cache)
+        # Either name of an inode keeps all of its names.
+        garbage = collector.find_garbage(Set([hello_ids[1]]))
+        self.assert_equal(1, len(garbage))
+        entry = garbage[0]
+        self.assert_equal(Set(world_ids), entry.blob_ids)
+        paths = Set([ self.cache.file_path(blob_id)
+                      for blob_id in world_ids ])
+        paths.add(self.cache.get_header_filename(world_ids[0]))
+        paths.add(self.cache.get_checksums_filename(world_ids[0]))
+        self.assert_equal(paths, Set(entry.paths))
+        self.assert_equal(len('world') + len('header') +
+                          os.stat(self.cache.get_checksums_filename(
+                              world_ids[0])).st_size,
+                          entry.size)
+
+        collector.remove(garbage)
+        for blob_id in world_ids:
+            self.fail_if(blob_id in self.cache)
+        for blob_id in hello_ids:
+            self.fail_unless(blob_id in self.cache)
+        self.fail_unless(
+            os.path.exists(self.cache.get_header_filename(hello_ids[0])))
+        self.assert_equal([], collector.find_garbage(Set([hello_ids[0]])))
+
+    def test_keep_recent(self):
+        old = time.time() - 10 * 24 * 60 * 60
+        os.utime(self.cache.file_path(world_ids[0]), (old, old))
+        collector = CacheCollector(self.cache)
+        garbage = collector.find_garbage(Set(), old + 60)
+        self.assert_equal([Set(world_ids)],
+                          [ entry.blob_ids for entry in garbage ])
+
+class MockVC(object):
+    def iter_committed_blobs(self, history):
+        return iter([])
+
+class MockWorkspace(object):
+    def __init__(self, location, cache):
+        self.location = location
+        self.cache = cache
+        self.vc = MockVC()
+
+class MockOpts(object):
+    def __init__(self, save_component_changes):
+        self.history = 0
+        self.keep_days = None
+        self.save_component_changes = save_component_changes
+
+class TestUnparsableDescriptor(TempDirTest):
+    def set_up(self):
+        super(TestUnparsableDescriptor, self).set_up()
+        self.cache = Cache(os.path.join(self.work_dir, 'cache'))
+        open('hello', 'w').write('hello')
+        self.cache.import_file(FileLocator('', 'hello', None, None, None),
+                               NullMassProgress())
+        os.mkdir('ws')
+        self.ws = MockWorkspace(os.path.join(self.work_dir, 'ws'),
+                                self.cache)
+        open(os.path.join('ws', 'broken.xml'), 'w').write('''\
+<?xml version="1.0"?>
+<component>
+  <contents>
+<<<<<<< HEAD
+    <deb ref="%s"/>
+''' % hello_ids[1])
+
+        self.current_workspace = pdk.cache_gc.workspace.current_workspace
+        pdk.cache_gc.workspace.current_workspace = lambda: self.ws
+
+    def tear_down(self):
+        pdk.cache_gc.workspace.current_workspace = self.current_workspace
+        super(TestUnparsableDescriptor, self).tear_down()
+
+    def test_find_references(self):
+        self.assert_raises(SemanticError, find_references, self.ws, 0)
+        self.assert_equal(Set(), find_references(self.ws, 0, True))
+
+    def test_blob_survives(self):
+        args = CommandArgs(MockOpts(True), [])
+        self.assert_raises(SemanticError, pdk.cache_gc.gc.function, args)
+        for blob_id in hello_ids:
+            self.fail_unless(blob_id in self.cache)
+
+        # A dry run skips the descriptor and only lists the blob.
+        args = CommandArgs(MockOpts(False), [])
+        output = StringIO()
+        stdout = sys.stdout
+        sys.stdout = output
+        try:
+            pdk.cache_gc.gc.function(args)
+        finally:
+            sys.stdout = stdout
+        self.fail_unless(hello_ids[1] in output.getvalue())
+        for blob_id in hello_ids:
+            self.fail_unless(blob_id in self.cache)
+
+# vim:set ai et sw=4 ts=4 tw=75:
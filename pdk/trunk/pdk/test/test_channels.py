@@ -18,11 +18,19 @@
 #   along with PDK; if not, write to the Free Software Foundation,
 #   Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
-from pdk.test.utest_util import Test
+import os
+from operator import eq, gt
+from StringIO import StringIO as stringio
+from pdk.test.utest_util import Test, TempDirTest
+from pdk.package import rpm, RPMVersion
+from pdk.rules import ac, rc
 
 from pdk.channels import \
      DirectorySection, AptDebBinaryStrategy, AptDebSourceStrategy, \
-     AptDebSection, OutsideWorldFactory, WorldData, quote
+     AptDebSection, OutsideWorldFactory, WorldData, quote, \
+     IndexedWorldData, FileLocator, make_comparable, FileScanCache, \
+     iter_stanzas, parse_stanza, base_indexed_fields, \
+     LimitedWorldDataIndex, WorldIndexSession
 
 class MockPackage(object):
     def __init__(self, blob_id):
@@ -77,4 +85,245 @@ class TestChannelFilenames(Test):
 
         self.assert_equals_long(quoted_path, quote(path))
 
+class TestStanzas(Test):
+    def test_iter_stanzas(self):
+        handle = stringio('\nPackage: a\nVersion: 1\n\n\n'
+                          'Package: b\nFiles:\n x 1 b.dsc\n')
+        self.assert_equal(['Package: a\nVersion: 1\n',
+                           'Package: b\nFiles:\n x 1 b.dsc\n'],
+                          list(iter_stanzas(handle)))
+
+    def test_parse_stanza(self):
+        stanza = 'Package: b\nFiles:\n x 1 b.dsc\n y 2 b.tar.gz\n' \
+                 'Description: some\n more\nVersion: 1.0-1\n'
+        expected = { 'Package': 'b',
+                     'Files': '\n x 1 b.dsc\n y 2 b.tar.gz',
+                     'Description': 'some\n more',
+                     'Version': '1.0-1' }
+        self.assert_equal(expected, parse_stanza(stanza))
+        expected = { 'Package': 'b',
+                     'Files': '\n x 1 b.dsc\n y 2 b.tar.gz',
+                     'Version': '1.0-1' }
+        self.assert_equal(expected,
+                          parse_stanza(stanza, ('package', 'files',
+                                                'version')))
+
+class TestFileScanCache(TempDirTest):
+    def test_scan_cache(self):
+        cache = FileScanCache('scan/cache')
+        self.assert_equal(None, cache.get('a', (1, 2, 3)))
+        cache.set('a', (1, 2, 3), 'md5:a', 'header a')
+        cache.set('b', (4, 5, 6), 'md5:b', 'header b')
+        cache.write()
+
+        cache = FileScanCache('scan/cache')
+        self.assert_equal(('md5:a', 'header a'), cache.get('a', (1, 2, 3)))
+        self.assert_equal(None, cache.get('b', (4, 5, 7)))
+        cache.write()
+
+        cache = FileScanCache('scan/cache')
+        self.assert_equal(('md5:a', 'header a'), cache.get('a', (1, 2, 3)))
+        self.assert_equal(None, cache.get('b', (4, 5, 6)))
+
+    def test_no_file(self):
+        cache = FileScanCache(None)
+        cache.set('a', (1, 2, 3), 'md5:a', 'header a')
+        cache.write()
+        self.assert_equal([], os.listdir('.'))
+
+class MockSection(object):
+    def __init__(self, name, blob_ids):
+        self.name = name
+        self.blob_ids = blob_ids
+        self.stamp = 1
+        self.iterations = 0
+
+    def get_stamp(self):
+        return self.stamp
+
+    def iter_package_info(self):
+        self.iterations += 1
+        for blob_id in self.blob_ids:
+            locator = FileLocator('http://x/' + self.name, blob_id,
+                                  blob_id, 1, None)
+            yield None, None, blob_id, locator
+
+make_comparable(MockSection, ('name',))
+
+class MockRpmSection(MockSection):
+    def __init__(self, name, headers):
+        MockSection.__init__(self, name, [ h[0] for h in headers ])
+        self.headers = headers
+
+    def iter_package_info(self):
+        self.iterations += 1
+        for blob_id, header in self.headers:
+            ghost = rpm.parse(header, blob_id)
+            locator = FileLocator('http://x/' + self.name, blob_id,
+                                  blob_id, 1, None)
+            yield ghost, header, blob_id, locator
+
+def make_rpm_header(name, version, arch, provides = None):
+    header = { ('pdk', 'name'): name,
+               ('pdk', 'version'): RPMVersion(version_string = version),
+               ('pdk', 'source-rpm'): name + '.src.rpm',
+               ('rpm', 'arch'): arch }
+    if provides:
+        header[('rpm', 'provides')] = provides
+    return header
+
+class TestIndexedWorldData(TempDirTest):
+    def test_segment_name_stable(self):
+        url = 'http://x/dists/a/main/binary-i386/Packages.gz'
+        first = AptDebSection(url, 'a', AptDebBinaryStrategy('http://x/'))
+        second = AptDebSection(url, 'b', AptDebBinaryStrategy('http://x/'))
+        # A package type object from another process is another object.
+        second.strategy.package_type = \
+            first.strategy.package_type.__class__()
+        self.assert_equal(
+            IndexedWorldData.get_segment_name('a', first,
+                                              base_indexed_fields),
+            IndexedWorldData.get_segment_name('a', second,
+                                              base_indexed_fields))
+
+    def test_segments_reused(self):
+        section_a = MockSection('a', ['md5:1', 'md5:2'])
+        section_b = MockSection('b', ['md5:3'])
+        sections = [ ('one', section_a), ('two', section_b) ]
+
+        index = IndexedWorldData('index')
+        index.build(iter(sections), 'index')
+        self.assert_equal(['md5:1', 'md5:2'], index.get_blob_ids('one'))
+        self.assert_equal(['md5:3'], index.get_blob_ids('two'))
+        self.assert_equal(2, len(os.listdir('index.d')))
+
+        section_b.stamp = 2
+        section_b.blob_ids = ['md5:4']
+        index.build(iter(sections), 'index')
+        self.assert_equal(1, section_a.iterations)
+        self.assert_equal(2, section_b.iterations)
+        self.assert_equal(['md5:4'], index.get_blob_ids('two'))
+        self.assert_equal(['md5:1', 'md5:2'], index.get_blob_ids('one'))
+        self.fail_unless(index.has_blob_id('md5:4'))
+        self.fail_if(index.has_blob_id('md5:3'))
+        self.assert_equal('http://x/a/md5:2',
+                          index.get_locator('md5:2').get_full_url())
+
+        index.build(iter(sections[:1]), 'index')
+        self.assert_equal(1, section_a.iterations)
+        self.assert_equal([], index.get_blob_ids('two'))
+        self.assert_equal(1, len(os.listdir('index.d')))
+
+    def test_merge_by_section_name(self):
+        section_a = MockSection('a', ['md5:1'])
+        section_b = MockSection('b', ['md5:2'])
+        section_c = MockSection('c', ['md5:3'])
+        sections = [ ('one', section_a), ('one', section_b),
+                     ('two', section_c) ]
+
+        index = IndexedWorldData('index')
+        index.build(iter(sections), 'index')
+        blob_ids = [ i.blob_id
+                     for i in index.iter_channel_candidates(['two', 'one']) ]
+        self.assert_equal(['md5:3', 'md5:1', 'md5:2'], blob_ids)
+
+    def test_field_indexes(self):
+        headers = [ ('md5:1', make_rpm_header('a', '1-1', 'i386', 'mta')),
+                    ('md5:2', make_rpm_header('b', '1-1', 'i386')),
+                    ('md5:3', make_rpm_header('c', '2-1', 'i386')),
+                    ('md5:4', make_rpm_header('d', '2-1', 'x86_64',
+                                              'mta, smtp')) ]
+        section = MockRpmSection('a', headers)
+
+        index = IndexedWorldData('index')
+        index.build(iter([ ('one', section) ]), 'index')
+        self.fail_unless(('rpm', 'provides') in index.available_fields)
+
+        condition = ac([ rc(eq, 'rpm', 'arch', 'i386'),
+                         rc(eq, 'rpm', 'provides', 'mta') ])
+        plan = index.plan(condition)
+        blob_ids = [ i.blob_id
+                     for i in index.iter_planned_candidates(plan, ['one']) ]
+        self.assert_equal(['md5:1'], blob_ids)
+        self.assert_equal([ 'intersect: 1 candidates',
+                            "  index rpm.arch = 'i386': 3 candidates",
+                            "  index rpm.provides = 'mta': 2 candidates" ],
+                          index.explain_plan(plan, ['one']))
+
+        version = RPMVersion(version_string = '2-1')
+        condition = ac([ rc(eq, 'pdk', 'version', version) ])
+        plan = index.plan(condition)
+        blob_ids = [ i.blob_id
+                     for i in index.iter_planned_candidates(plan, ['one']) ]
+        self.assert_equal(['md5:3', 'md5:4'], blob_ids)
+
+        condition = ac([ rc(gt, 'pdk', 'version', version) ])
+        plan = index.plan(condition)
+        self.assert_equal(None, plan)
+        self.assert_equal(['full scan: 4 candidates'],
+                          index.explain_plan(plan, ['one']))
+
+    def test_lazy_ghosts(self):
+        header = make_rpm_header('a', '1-1', 'i386')
+        header[('rpm', 'summary')] = 'an a'
+        section = MockRpmSection('a', [ ('md5:1', header) ])
+
+        index = IndexedWorldData('index')
+        index.build(iter([ ('one', section) ]), 'index')
+        items = list(index.iter_channel_candidates(['one']))
+        self.assert_equal(1, len(items))
+        ghost = items[0].package
+        self.fail_unless(ghost)
+        self.assert_equal('a', ghost.name)
+        self.assert_equal('1-1', str(ghost.version))
+        self.assert_equal('i386', ghost.arch)
+        self.assert_equal('rpm', ghost[('pdk', 'type')])
+        self.fail_if(('rpm', 'group') in ghost)
+        self.assert_equal('md5:1', ghost[('pdk', 'found-filename')])
+        self.fail_unless(ghost.load_header)
+
+        self.assert_equal('an a', ghost[('rpm', 'summary')])
+        self.fail_if(ghost.load_header)
+        self.assert_equal('a.src.rpm', ghost[('pdk', 'source-rpm')])
+        self.assert_equal(6, len(ghost))
+
+    def test_session(self):
+        headers = [ ('md5:1', make_rpm_header('a', '1-1', 'i386')),
+                    ('md5:2', make_rpm_header('b', '1-1', 'i386')) ]
+        section = MockRpmSection('a', headers)
+        index = IndexedWorldData('index')
+        index.build(iter([ ('one', section) ]), 'index')
+
+        session = WorldIndexSession(LimitedWorldDataIndex(index, ['one']))
+        plan = session.plan(rc(eq, 'pdk', 'name', 'b'))
+        first = list(session.iter_planned_candidates(plan))
+        self.assert_equal(['md5:2'], [ i.blob_id for i in first ])
+        plan = session.plan(ac([ rc(eq, 'pdk', 'name', 'b') ]))
+        second = list(session.iter_planned_candidates(plan))
+        self.fail_unless(first[0] is second[0])
+
+        all_items = list(session.iter_all_candidates())
+        self.assert_equal(['md5:1', 'md5:2'],
+                          [ i.blob_id for i in all_items ])
+        self.fail_unless(all_items[0] is
+                         list(session.iter_all_candidates())[0])
+
+    def test_indexed_fields_change(self):
+        headers = [ ('md5:1', make_rpm_header('a', '1-1', 'i386')) ]
+        section = MockRpmSection('a', headers)
+        condition = rc(eq, 'rpm', 'arch', 'i386')
+
+        index = IndexedWorldData('index', base_indexed_fields)
+        index.build(iter([ ('one', section) ]), 'index')
+        self.assert_equal(base_indexed_fields, index.available_fields)
+        self.assert_equal(None, index.plan(condition))
+
+        index = IndexedWorldData('index')
+        index.build(iter([ ('one', section) ]), 'index')
+        self.assert_equal(2, section.iterations)
+        self.assert_equal(["index rpm.arch = 'i386': 1 candidates"],
+                          index.explain_plan(index.plan(condition),
+                                             ['one']))
+        self.assert_equal(1, len(os.listdir('index.d')))
+
 # vim:set ai et sw=4 ts=4 tw=75:
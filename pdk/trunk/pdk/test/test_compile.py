@@ -19,13 +19,21 @@
 #   Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
 import os
+import gzip
+import bz2
+import sha
 from sets import Set
-from pdk.test.utest_util import TempDirTest
+from pdk.test.utest_util import TempDirTest, MockPackage
 from pdk.cache import Cache
+from pdk.channels import FileLocator
+from pdk.progress import NullMassProgress
+from pdk.package import deb, DebianVersion
+from pdk.exceptions import IntegrityFault
 from pdk.util import pjoin, cpath
 
 from pdk.repogen import DebianReleaseWriter, LazyWriter, \
-     DebianDirectPoolRepo, DebianPoolInjector, Compiler
+     DebianDirectPoolRepo, DebianPoolInjector, Compiler, RepoManifest, \
+     DebianPoolLinks, get_file_sums, IndexWriter, compile_product
 
 __revision__ = "$Progeny$"
 
@@ -134,9 +142,11 @@ class TestDebianPoolRepo(DebianPoolFixture):
         class MockWriter(object):
             def write(self, handle, section, arch):
                 calls.add((handle.name, section, arch))
+                print >> handle, section, arch
 
-            def write_outer(self, handle):
+            def write_outer(self, handle, file_sums):
                 outer.add(handle.name)
+                self.file_sums = file_sums
 
         writer = MockWriter()
 
@@ -161,6 +171,13 @@ class TestDebianPoolRepo(DebianPoolFixture):
         expected = Set([release_path])
         self.assert_equal(expected, outer)
 
+        main_release = pjoin(self.repo.get_one_dir('main', 'i386'),
+                             'Release')
+        self.assert_equal(6, len(writer.file_sums))
+        self.fail_unless(('main/binary-i386/Release',
+                          get_file_sums(main_release))
+                         in writer.file_sums)
+
 class TestDebianPoolInjector(DebianPoolFixture):
     def set_up(self):
         super(TestDebianPoolInjector, self).set_up()
@@ -214,6 +231,18 @@ class TestDebianPoolInjector(DebianPoolFixture):
         actual = self.src_injector.get_links()
         self.assert_equals_long(expected, actual)
 
+    def test_apt_header_is_cached(self):
+        header = self.bin_injector.get_apt_header()
+        self.assert_equal(self.bin_injector.render_apt_header(), header)
+        blob_id = self.bin.blob_id
+        key = self.bin_injector.stanza_key
+        self.assert_equal(''.join(header),
+                          self.cache.load_stanza(blob_id, key))
+
+        other_injector = DebianPoolInjector(self.cache, self.bin,
+                                            'contrib', self.repo.repo_dir)
+        self.fail_if(key == other_injector.stanza_key)
+
 class TestReleaseWriter(TempDirTest):
     def set_up(self):
         super(self.__class__, self).set_up()
@@ -270,9 +299,239 @@ SHA1:
  e3dc8362c1586e4d9702ad862f29b6bef869afde               11 data/Release
 """
         actual_release = self.read_file(release_path)
-        # Newer versions of apt-ftparchive put more sums after the file.
-        # We'll overlook these for now, for compatibility purposes.
+        # SHA256 sums follow when python can calculate them.
         edited_release = ''.join(actual_release.splitlines(True)[:13])
         self.assert_equals_long(expected_release, edited_release)
 
+    def test_writer_outer_release_from_sums(self):
+        release_path = pjoin(self.search_path, 'Release')
+        release_handle = LazyWriter(release_path)
+        sums = (11, 'bad9425ff652b1bd52b49720abecf0ba',
+                'e3dc8362c1586e4d9702ad862f29b6bef869afde', None)
+        self.writer.write_outer(release_handle, [('data/Release', sums)])
+        release_handle.close()
+
+        expected_release = """Origin: Debian
+Label: Debian2
+Suite: happy
+Version: 3.0r4
+Codename: woody
+Date: Wed, 22 Mar 2005 21:20:00 UTC
+Architectures: alpha i386
+Components: main contrib
+Description: Hello World!
+MD5Sum:
+ bad9425ff652b1bd52b49720abecf0ba               11 data/Release
+SHA1:
+ e3dc8362c1586e4d9702ad862f29b6bef869afde               11 data/Release
+"""
+        self.assert_equals_long(expected_release,
+                                self.read_file(release_path))
+
+class TestIndexWriter(TempDirTest):
+    def test_write(self):
+        index_path = pjoin(self.work_dir, 'binary-i386', 'Packages')
+        writer = IndexWriter(index_path)
+        self.fail_if(writer.is_started())
+        self.assert_equal({}, writer.close())
+        self.fail_if(os.path.exists(index_path))
+
+        text = 'Package: a\n\n' * 1000
+        writer.write(text[:5000])
+        writer.write(text[5000:])
+        sums = writer.close()
+
+        self.assert_equal(text, self.read_file(index_path))
+        self.assert_equal(text, gzip.open(index_path + '.gz').read())
+        self.assert_equal(text, bz2.BZ2File(index_path + '.bz2').read())
+        self.assert_equal(Set(['', '.gz', '.bz2']), Set(sums.keys()))
+        for suffix, file_sums in sums.items():
+            self.assert_equal(get_file_sums(index_path + suffix),
+                              file_sums)
+
+    def test_gzip_is_reproducible(self):
+        first = IndexWriter(pjoin(self.work_dir, 'a', 'Packages'))
+        first.write('Package: a\n\n')
+        second = IndexWriter(pjoin(self.work_dir, 'b', 'Packages'))
+        second.write('Package: a\n\n')
+        self.assert_equal(first.close()['.gz'], second.close()['.gz'])
+
+class MockProduct(object):
+    def __init__(self, packages):
+        self.ref = 'happy.xml'
+        self.meta = {}
+        self.packages = packages
+
+    def iter_packages(self):
+        return iter(self.packages)
+    iter_direct_packages = iter_packages
+
+    def iter_direct_components(self):
+        return iter([])
+
+class MockDescriptor(object):
+    def __init__(self, product):
+        self.product = product
+
+    def load(self, dummy):
+        return self.product
+
+class TestIncrementalRepo(TempDirTest):
+    def set_up(self):
+        super(TestIncrementalRepo, self).set_up()
+        self.cache = Cache(pjoin(self.work_dir, 'cache'))
+        self.repo_dir = pjoin(self.work_dir, 'repo')
+
+    def make_package(self, name, arch = 'i386', content = None):
+        """Put a deb for name in the cache and return its package."""
+        if content is None:
+            content = name
+        digest = sha.new(content).hexdigest()
+        # The cache may hard link the file, so it is never reused.
+        filename = 'blob-' + digest
+        open(filename, 'w').write(content)
+        blob_id = 'sha-1:' + digest
+        self.cache.import_file(FileLocator('', filename, blob_id, None,
+                                           None),
+                               NullMassProgress())
+        version = DebianVersion('1')
+        extras = { ('pdk', 'sp-name'): name,
+                   ('pdk', 'sp-version'): version,
+                   ('pdk', 'filename'): '%s_1_%s.deb' % (name, arch) }
+        return MockPackage(name, version, deb, blob_id, extras,
+                           arch = arch)
+
+    def build(self, packages, incremental = True, workers = 1):
+        """Compile a product of the given packages into repo_dir."""
+        def _get_desc(dummy):
+            return MockDescriptor(MockProduct(packages))
+        compile_product('happy.xml', self.cache, self.repo_dir, _get_desc,
+                        incremental, workers)
+        return RepoManifest.load(self.repo_dir)
+
+    def get_inode(self, path):
+        return os.stat(pjoin(self.repo_dir, path)).st_ino
+
+    def test_manifest_round_trip(self):
+        self.assert_equal(None, RepoManifest.load(self.repo_dir))
+        a = self.make_package('a')
+        manifest = self.build([a])
+        self.assert_equal({'pool/main/a/a/a_1_i386.deb': a.blob_id},
+                          manifest.links)
+        index_path = 'dists/happy/main/binary-i386/Packages'
+        self.assert_equal([index_path], manifest.indexes.keys())
+        for path in (index_path, index_path + '.gz', index_path + '.bz2',
+                     'dists/happy/main/binary-i386/Release'):
+            self.assert_equal(get_file_sums(pjoin(self.repo_dir, path)),
+                              manifest.sums[path])
+        self.fail_if(os.path.exists(pjoin(self.repo_dir, '.pdk-stage')))
+
+    def test_unchanged_index_is_reused(self):
+        packages = [ self.make_package('a'), self.make_package('b') ]
+        self.build(packages)
+        index_path = 'dists/happy/main/binary-i386/Packages'
+        inode = self.get_inode(index_path)
+        pool_inode = self.get_inode('pool/main/a/a/a_1_i386.deb')
+
+        self.build(packages)
+        self.assert_equal(inode, self.get_inode(index_path))
+        self.assert_equal(pool_inode,
+                          self.get_inode('pool/main/a/a/a_1_i386.deb'))
+        release = self.read_file(pjoin(self.repo_dir, 'dists', 'happy',
+                                       'Release'))
+        md5sum = get_file_sums(pjoin(self.repo_dir, index_path))[1]
+        self.fail_unless(md5sum in release)
+
+    def test_changed_index_is_rewritten(self):
+        a = self.make_package('a')
+        self.build([a, self.make_package('b')])
+        manifest = self.build([a, self.make_package('c')])
+        packages = self.read_file(pjoin(self.repo_dir, 'dists', 'happy',
+                                        'main', 'binary-i386',
+                                        'Packages'))
+        self.fail_unless('Package: a\n' in packages)
+        self.fail_unless('Package: c\n' in packages)
+        self.fail_if('Package: b\n' in packages)
+        pool_dir = pjoin(self.repo_dir, 'pool', 'main')
+        self.fail_unless(os.path.exists(pjoin(pool_dir, 'c')))
+        self.fail_if(os.path.exists(pjoin(pool_dir, 'b')))
+        self.assert_equal(Set(['pool/main/a/a/a_1_i386.deb',
+                               'pool/main/c/c/c_1_i386.deb']),
+                          Set(manifest.links.keys()))
+        release = self.read_file(pjoin(self.repo_dir, 'dists', 'happy',
+                                       'Release'))
+        md5sum = manifest.sums['dists/happy/main/binary-i386/Packages'][1]
+        self.fail_unless(md5sum in release)
+
+    def test_changed_pool_file(self):
+        a = self.make_package('a')
+        manifest = self.build([a])
+        pool_path = 'pool/main/a/a/a_1_i386.deb'
+        new_a = self.make_package('a', content = 'new a')
+
+        # The old file stays in place until the new indexes are.
+        pool = DebianPoolLinks(self.repo_dir, manifest)
+        pool.add(DebianPoolInjector(self.cache, new_a, 'main',
+                                    self.repo_dir))
+        pool.link_pending()
+        self.assert_equal('a', self.read_file(pjoin(self.repo_dir,
+                                                    pool_path)))
+        pool.replace_changed()
+        self.assert_equal('new a', self.read_file(pjoin(self.repo_dir,
+                                                        pool_path)))
+
+        manifest = self.build([new_a])
+        self.assert_equal('new a', self.read_file(pjoin(self.repo_dir,
+                                                        pool_path)))
+        self.assert_equal({pool_path: new_a.blob_id}, manifest.links)
+        self.assert_equal(['a_1_i386.deb'],
+                          os.listdir(pjoin(self.repo_dir, 'pool', 'main',
+                                           'a', 'a')))
+
+    def test_incremental_keeps_repo(self):
+        a = self.make_package('a')
+        self.build([a])
+        open(pjoin(self.repo_dir, 'extra'), 'w').write('extra')
+        self.build([a])
+        self.fail_unless(os.path.exists(pjoin(self.repo_dir, 'extra')))
+
+        self.build([a], False)
+        self.fail_if(os.path.exists(pjoin(self.repo_dir, 'extra')))
+
+    def test_failed_build_drops_manifest(self):
+        a = self.make_package('a')
+        self.build([a])
+        missing = self.make_package('missing')
+        os.unlink(self.cache.file_path(missing.blob_id))
+        try:
+            self.build([a, missing])
+            self.fail('missing blob should raise an error')
+        except (IntegrityFault, OSError):
+            pass
+        self.assert_equal(None, RepoManifest.load(self.repo_dir))
+
+    def test_parallel_build(self):
+        packages = [ self.make_package('p%03d' % index,
+                                       ('i386', 'sparc', 'all')[index % 3])
+                     for index in range(60) ]
+        serial = self.build(packages, False, 1)
+        os.rename('repo', 'serial')
+
+        parallel = self.build(packages, False, 4)
+        self.assert_equal(serial.sums, parallel.sums)
+        self.assert_equal(serial.links, parallel.links)
+        for arch in ('i386', 'sparc'):
+            path = pjoin('dists', 'happy', 'main', 'binary-%s' % arch,
+                         'Packages')
+            self.assert_equal(self.read_file(pjoin('serial', path)),
+                              self.read_file(pjoin('repo', path)))
+        for path in parallel.links:
+            self.fail_unless(os.path.exists(pjoin(self.repo_dir, path)))
+        for package in packages:
+            injector = DebianPoolInjector(self.cache, package, 'main',
+                                          self.repo_dir)
+            self.fail_if(self.cache.load_stanza(package.blob_id,
+                                                injector.stanza_key)
+                         is None)
+
 # vim:set ai et sw=4 ts=4 tw=75:
@@ -19,8 +19,9 @@
 #   Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
 from pdk.test.utest_util import TempDirTest
+from pdk.util import parallel_map
 from pdk.index_file import IndexWriter, IndexFile, IndexFileMissingError, \
-     IndexFormatError
+     IndexFormatError, digest_key
 
 
 
@@ -29,7 +30,7 @@ class TestIndexFile(TempDirTest):
         '''Make sure magic plus table address are present in files.'''
         open('a', 'w').write('as;dlfkja;ldskfjasd;lfkj')
 
-        writer = IndexWriter('a')
+        writer = IndexWriter('a', 1)
         writer.init()
         writer.terminate()
 
@@ -37,6 +38,14 @@ class TestIndexFile(TempDirTest):
 
         self.assert_equals('pdko\x00\x00\x00\x01', header)
 
+        writer = IndexWriter('a')
+        writer.init()
+        writer.terminate()
+
+        header = open('a').read(8)
+
+        self.assert_equals('pdko\x00\x00\x00\x02', header)
+
     def test_bad_magic(self):
         open('a', 'w').write('as;dlfkja;ldskfjasd;lfkj')
         try:
@@ -45,7 +54,11 @@ class TestIndexFile(TempDirTest):
             pass
 
     def test_write_then_read(self):
-        writer = IndexWriter('a')
+        self.do_write_then_read(1)
+        self.do_write_then_read(2)
+
+    def do_write_then_read(self, version):
+        writer = IndexWriter('a', version)
         writer.init()
 
         address = writer.add('full', 'time', 3)
@@ -69,6 +82,42 @@ class TestIndexFile(TempDirTest):
         self.assert_equal(1, reader.count(('z', 'c')))
         self.assert_equal(0, reader.count(('l', 'm')))
 
+    def test_many_keys(self):
+        writer = IndexWriter('a')
+        writer.init()
+        for number in range(500):
+            address = writer.add(number)
+            writer.index([ ('n', str(number)), ('mod', number % 7) ],
+                         address)
+        writer.terminate()
+
+        reader = IndexFile('a')
+        for number in range(500):
+            self.assert_equal([number],
+                              list(reader.get(('n', str(number)), 0)))
+        self.assert_equal(range(3, 500, 7), list(reader.get(('mod', 3), 0)))
+        self.assert_equal(0, reader.count(('n', '500')))
+
+    def test_read_after_fork(self):
+        writer = IndexWriter('a')
+        writer.init()
+        for number in range(200):
+            address = writer.add(number, str(number))
+            writer.index([ number ], address)
+        writer.terminate()
+
+        reader = IndexFile('a')
+        def _read(number):
+            return list(reader.get_all(number))
+        expected = [ [ (n, str(n)) ] for n in range(200) ]
+        self.assert_equal(expected, parallel_map(_read, range(200), 4))
+        self.assert_equal(expected, [ _read(n) for n in range(200) ])
+
+    def test_digest_key_unicode(self):
+        self.assert_equal(digest_key(('a', 'b')), digest_key((u'a', 'b')))
+        self.assert_not_equal(digest_key(('ab', 'c')),
+                              digest_key(('a', 'bc')))
+
     def test_read_nonexistent(self):
         try:
             IndexFile('a')
@@ -0,0 +1,115 @@
+# $Progeny$
+#
+#   Copyright 2006 Progeny Linux Systems, Inc.
+#
+#   This file is part of PDK.
+#
+#   PDK is free software; you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   PDK is distributed in the hope that it will be useful, but WITHOUT
+#   ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#   or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+#   License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with PDK; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+from operator import eq, gt
+from pdk.test.utest_util import Test, TempDirTest
+from pdk.package import RPMVersion
+from pdk.rules import ac, oc, rc, relrc, notc
+from pdk.index_file import IndexWriter, IndexFile
+from pdk.query import get_index_values, plan_condition, explain_plan
+
+fields = (('pdk', 'name'), ('deb', 'arch'), ('deb', 'Provides'),
+          ('pdk', 'version'))
+
+class TestIndexValues(Test):
+    def test_get_index_values(self):
+        self.assert_equal(['a', 'b', 'c'],
+                          get_index_values(('deb', 'Provides'),
+                                           'a, b (= 1.0) | c'))
+        version = RPMVersion(version_string = '1-2-3')
+        self.assert_equal(['2-3'],
+                          get_index_values(('pdk', 'version'), version))
+        self.assert_equal([], get_index_values(('pdk', 'version'), '2-3'))
+        self.assert_equal(['i386'],
+                          get_index_values(('deb', 'arch'), 'i386'))
+
+class TestPlanCondition(Test):
+    def describe(self, plan, depth = 0):
+        lines = [ '  ' * depth + plan.describe() ]
+        for child in plan.get_children():
+            lines.extend(self.describe(child, depth + 1))
+        return lines
+
+    def test_relation(self):
+        plan = plan_condition(rc(eq, 'pdk', 'name', 'a'), fields)
+        self.assert_equal(["index name = 'a'"], self.describe(plan))
+
+        plan = plan_condition(rc(eq, 'deb', 'Provides', 'x, y'), fields)
+        self.assert_equal([ 'intersect',
+                            "  index deb.Provides = 'x'",
+                            "  index deb.Provides = 'y'" ],
+                          self.describe(plan))
+
+    def test_unplannable(self):
+        conditions = [ rc(gt, 'pdk', 'version', '1'),
+                       rc(eq, 'pdk', 'type', 'deb'),
+                       relrc(eq, 'pdk', 'name', 'a'),
+                       notc(rc(eq, 'pdk', 'name', 'a')),
+                       oc([ rc(eq, 'pdk', 'name', 'a'),
+                            rc(eq, 'pdk', 'type', 'deb') ]),
+                       ac([ rc(eq, 'pdk', 'type', 'deb') ]) ]
+        for condition in conditions:
+            self.assert_equal(None, plan_condition(condition, fields))
+
+    def test_and_or(self):
+        condition = ac([ rc(eq, 'pdk', 'type', 'deb'),
+                         rc(gt, 'pdk', 'version', '1'),
+                         oc([ rc(eq, 'pdk', 'name', 'a'),
+                              rc(eq, 'pdk', 'name', 'b') ]),
+                         ac([ oc([ rc(eq, 'deb', 'arch', 'i386') ]) ]) ])
+        plan = plan_condition(condition, fields)
+        self.assert_equal([ 'intersect',
+                            '  union',
+                            "    index name = 'a'",
+                            "    index name = 'b'",
+                            "  index deb.arch = 'i386'" ],
+                          self.describe(plan))
+
+class TestRunPlan(TempDirTest):
+    def test_addresses(self):
+        writer = IndexWriter('index')
+        writer.init()
+        records = {}
+        for name, arch in (('a', 'i386'), ('a', 'amd64'), ('b', 'i386'),
+                           ('c', 'i386')):
+            addresses = writer.add(name, arch)
+            records[addresses] = (name, arch)
+            writer.index([ ('s', ('pdk', 'name'), name),
+                           ('s', ('deb', 'arch'), arch) ], addresses)
+        writer.terminate()
+        index_file = IndexFile('index')
+
+        condition = ac([ oc([ rc(eq, 'pdk', 'name', 'a'),
+                              rc(eq, 'pdk', 'name', 'b') ]),
+                         rc(eq, 'deb', 'arch', 'i386') ])
+        plan = plan_condition(condition, fields)
+        found = [ index_file.load(a)
+                  for a in plan.get_addresses(index_file, 's') ]
+        found.sort()
+        self.assert_equal([ ('a', 'i386'), ('b', 'i386') ], found)
+
+        self.assert_equal([ 'intersect: 2 candidates',
+                            '  union: 3 candidates',
+                            "    index name = 'a': 2 candidates",
+                            "    index name = 'b': 1 candidates",
+                            "  index deb.arch = 'i386': 3 candidates" ],
+                          explain_plan(plan, [ ('s', index_file) ]))
+
+# vim:set ai et sw=4 ts=4 tw=75:
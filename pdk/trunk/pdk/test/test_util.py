@@ -18,6 +18,7 @@
 #   along with PDK; if not, write to the Free Software Foundation,
 #   Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
+import os
 from StringIO import StringIO as stringio
 from pdk.test.utest_util import Test
 from cElementTree import ElementTree, Element, SubElement, Comment, \
@@ -25,7 +26,9 @@ from cElementTree import ElementTree, Element, SubElement, Comment, \
 
 from pdk.util import split_pipe, gen_fragments, default_block_size, \
      write_pretty_xml, parse_xml, NullTerminated, parse_domain, \
-     string_domain
+     string_domain, parallel_map, Framer, noop, verify_protocol, \
+     answer_verify_protocol, answer_set_framing
+from pdk.exceptions import InputError
 
 __revision__ = "$Progeny$"
 
@@ -127,6 +130,117 @@ expected_xml_output = '''<?xml version="1.0" encoding="utf-8"?>
 </a>
 '''
 
+def square(number):
+    return number * number
+
+def fail_on_three(number):
+    if number == 3:
+        raise InputError('three')
+    return number
+
+class TestParallelMap(Test):
+    def test_order(self):
+        items = range(50)
+        expected = [ square(i) for i in items ]
+        self.assert_equal(expected, parallel_map(square, items, 4))
+        self.assert_equal(expected, parallel_map(square, items, 1))
+        self.assert_equal([], parallel_map(square, [], 4))
+
+    def test_error(self):
+        try:
+            parallel_map(fail_on_three, range(10), 3)
+            self.fail('error in a worker should be raised')
+        except InputError, error:
+            self.assert_equal('three', str(error))
+
+def serve_framer(framer):
+    """Answer framer requests the way pdk remote listen does."""
+    while 1:
+        request = framer.read_frame()
+        framer.assert_end_of_stream()
+        if request == 'verify-protocol':
+            answer_verify_protocol(framer)
+        elif request == 'set-framing':
+            answer_set_framing(framer)
+        elif request == 'echo':
+            frames = list(framer.iter_stream())
+            framer.write_stream(frames + [str(framer.version)])
+        else:
+            break
+
+class TestFramer(Test):
+    def make_pipe_framer(self):
+        read_fd, write_fd = os.pipe()
+        return Framer(os.fdopen(write_fd, 'w'), os.fdopen(read_fd), noop)
+
+    def test_round_trip(self):
+        data = ['a', '\n\n', '\0\xff' * 100]
+        for version in (1, 2):
+            framer = self.make_pipe_framer()
+            framer.set_version(version)
+            framer.write_stream(data)
+            framer.write_handle(stringio('x' * 5000))
+            framer.remote_in.flush()
+            self.assert_equal(data, list(framer.iter_stream()))
+            self.assert_equal('x' * 5000, ''.join(framer.iter_stream()))
+            framer.close()
+
+    def test_frame_size(self):
+        os.environ['PDK_FRAME_SIZE'] = '1000'
+        try:
+            framer = self.make_pipe_framer()
+            framer.set_version(2)
+            framer.write_handle(stringio('x' * 2500))
+            framer.remote_in.flush()
+            self.assert_equal([1000, 1000, 500],
+                              [ len(f) for f in framer.iter_stream() ])
+            framer.close()
+        finally:
+            del os.environ['PDK_FRAME_SIZE']
+
+    def converse(self, client_framing, server_framing = None):
+        """Verify the protocol with a forked server and echo a stream.
+
+        The framings are given as PDK_FRAMING values for each end.
+        Returns the framing versions used by the client and the server.
+        """
+        to_server, from_client = os.pipe()
+        to_client, from_server = os.pipe()
+        if server_framing:
+            os.environ['PDK_FRAMING'] = server_framing
+        pid = os.fork()
+        if not pid:
+            try:
+                os.close(from_client)
+                os.close(to_client)
+                serve_framer(Framer(os.fdopen(from_server, 'w'),
+                                    os.fdopen(to_server), noop))
+            finally:
+                os._exit(0)
+        os.environ.pop('PDK_FRAMING', None)
+        os.close(to_server)
+        os.close(from_server)
+        framer = Framer(os.fdopen(from_client, 'w'),
+                        os.fdopen(to_client), lambda: os.waitpid(pid, 0))
+        if client_framing:
+            os.environ['PDK_FRAMING'] = client_framing
+        try:
+            verify_protocol(framer)
+        finally:
+            os.environ.pop('PDK_FRAMING', None)
+        framer.write_stream(['echo'])
+        framer.write_stream(['hello\n', 'world'])
+        frames = list(framer.iter_stream())
+        framer.write_stream(['done'])
+        framer.close()
+        self.assert_equal(['hello\n', 'world'], frames[:2])
+        return framer.version, int(frames[2])
+
+    def test_negotiate(self):
+        self.assert_equal((2, 2), self.converse(None))
+        self.assert_equal((1, 1), self.converse('1'))
+        self.assert_equal((1, 1), self.converse(None, '1'))
+
 class TestXML(Test):
     def test_writer(self):
         a = Element('a')
@@ -28,6 +28,7 @@ import md5
 from pprint import pformat
 from unittest import TestCase
 from pdk.package import Package, DebianVersion, srpm
+from pdk.cache import package_memo
 
 __revision__ = '$Progeny$'
 
@@ -56,6 +57,8 @@ class Test(TestCase, object):
         pass
 
     def setUp(self):
+        # Tests reuse blob_ids for different packages.
+        package_memo.clear()
         self.set_up()
 
     def tearDown(self):
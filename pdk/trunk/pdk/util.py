@@ -31,8 +31,10 @@ import re
 import sys
 import inspect
 import stat
+import struct
 import pycurl
 from cStringIO import StringIO
+from cPickle import Pickler, Unpickler
 from cElementTree import ElementTree
 from elementtree.ElementTree import XMLTreeBuilder
 from xml.sax.writer import XmlWriter
@@ -221,18 +223,22 @@ def curl_set_netrc(curl_object):
     curl_object.setopt(curl_object.NETRC, curl_object.NETRC_OPTIONAL)
 
 def get_remote_file(remote_url, local_filename, trust_timestamp = False,
-                    progress = None):
+                    progress = None, handle = None):
     '''Obtain a remote file via url.
 
     Copies the file to local_filename and attempts to set the last
     modified time.
+
+    If handle is given, the data is written to it rather than to a new
+    LazyWriter for local_filename. The handle must write local_filename.
     '''
     if os.path.exists(local_filename):
         mtime = os.stat(local_filename)[stat.ST_MTIME]
     else:
         mtime = None
 
-    handle = LazyWriter(local_filename)
+    if handle is None:
+        handle = LazyWriter(local_filename)
 
     curl = pycurl.Curl()
     curl.setopt(curl.URL, remote_url)
@@ -260,6 +266,146 @@ def get_remote_file(remote_url, local_filename, trust_timestamp = False,
     if mtime != -1:
         os.utime(local_filename, (mtime, mtime))
 
+default_max_connections = 4
+
+def get_max_connections():
+    '''Return the concurrent download limit.
+
+    The limit may be set with the PDK_MAX_CONNECTIONS environment
+    variable.
+    '''
+    try:
+        limit = int(os.environ['PDK_MAX_CONNECTIONS'])
+    except (KeyError, ValueError):
+        return default_max_connections
+    return max(limit, 1)
+
+class MultiDownloader(object):
+    '''Download many urls concurrently over a pool of curl handles.
+
+    max_connections - the number of simultaneous transfers. Defaults
+                      to get_max_connections().
+
+    The curl handles are reused from one transfer to the next and share
+    the connection cache of the curl multi handle, so consecutive
+    downloads from a host reuse open connections.
+
+    To use:
+    downloader = MultiDownloader()
+    many times:
+        downloader.add(url, local_filename, callback)
+    downloader.run()
+
+    The callback is called as callback(url, local_filename, error) as
+    each transfer finishes. Error is None on success, otherwise it is
+    a message describing the failure. Exceptions raised by a callback
+    abort the remaining transfers and propagate out of run.
+    '''
+    def __init__(self, max_connections = None):
+        if not max_connections:
+            max_connections = get_max_connections()
+        self.max_connections = max_connections
+        self.jobs = []
+
+    def add(self, remote_url, local_filename, callback, handle = None):
+        '''Queue a url to be downloaded to local_filename.
+
+        If handle is given, the data is written to it rather than to a
+        newly opened local_filename. The handle must write
+        local_filename.
+        '''
+        self.jobs.append((remote_url, local_filename, callback, handle))
+
+    def make_curl(self):
+        '''Create a curl handle with the options shared by all jobs.'''
+        curl = pycurl.Curl()
+        curl.setopt(curl.USERAGENT, 'pdk')
+        curl.setopt(curl.NOPROGRESS, True)
+        curl.setopt(curl.FAILONERROR, True)
+        curl.setopt(curl.OPT_FILETIME, True)
+        curl_set_ssl(curl)
+        curl_set_netrc(curl)
+        return curl
+
+    def start_job(self, multi, curl, job):
+        '''Attach a job to a free curl handle and start it.'''
+        remote_url, local_filename, dummy, handle = job
+        curl.job = job
+        curl.handle = handle or open(local_filename, 'w')
+        curl.setopt(curl.URL, remote_url)
+        curl.setopt(curl.WRITEFUNCTION, curl.handle.write)
+        multi.add_handle(curl)
+
+    def finish_job(self, multi, curl, error):
+        '''Detach a finished job from its curl handle.
+
+        Returns the job and the error message.
+        '''
+        multi.remove_handle(curl)
+        curl.handle.close()
+        curl.handle = None
+        job = curl.job
+        curl.job = None
+        remote_url, local_filename = job[:2]
+        if error is None:
+            mtime = curl.getinfo(curl.INFO_FILETIME)
+            if mtime != -1:
+                os.utime(local_filename, (mtime, mtime))
+        return job, error
+
+    def run(self):
+        '''Perform all queued downloads.'''
+        pending = list(self.jobs)
+        pending.reverse()
+        self.jobs = []
+        if not pending:
+            return
+
+        multi = pycurl.CurlMulti()
+        handle_count = min(self.max_connections, len(pending))
+        curls = [ self.make_curl() for dummy in range(handle_count) ]
+        free = list(curls)
+        active = 0
+        try:
+            while pending or active:
+                while pending and free:
+                    self.start_job(multi, free.pop(), pending.pop())
+                    active += 1
+
+                while True:
+                    status, dummy = multi.perform()
+                    if status != pycurl.E_CALL_MULTI_PERFORM:
+                        break
+
+                finished = []
+                while True:
+                    queued, ok_list, error_list = multi.info_read()
+                    for curl in ok_list:
+                        finished.append(self.finish_job(multi, curl,
+                                                        None))
+                        free.append(curl)
+                    for curl, dummy, message in error_list:
+                        finished.append(self.finish_job(multi, curl,
+                                                        message))
+                        free.append(curl)
+                    if not queued:
+                        break
+                active -= len(finished)
+
+                for job, error in finished:
+                    remote_url, local_filename, callback = job[:3]
+                    callback(remote_url, local_filename, error)
+
+                if active and not finished:
+                    multi.select(1.0)
+        finally:
+            for curl in curls:
+                if getattr(curl, 'handle', None):
+                    multi.remove_handle(curl)
+                    curl.handle.close()
+                curl.close()
+            multi.close()
+
 def get_remote_file_as_string(remote_url, progress = None):
     '''Returns the contents of a remote file as a string.'''
     result = StringIO()
@@ -571,6 +717,99 @@ def shell_command(command, set_up = noop, pipes = True):
     execv_args = ('/bin/sh', ['/bin/sh', '-c', shell_cmd])
     return execv(execv_args, set_up, pipes)
 
+def get_worker_count():
+    '''Return the number of worker processes to use for parallel work.
+
+    The count may be set with the PDK_WORKERS environment variable.
+    Otherwise it is the number of online processors.
+    '''
+    try:
+        count = int(os.environ['PDK_WORKERS'])
+    except (KeyError, ValueError):
+        try:
+            count = os.sysconf('SC_NPROCESSORS_ONLN')
+        except (AttributeError, ValueError, OSError):
+            count = 1
+    return max(count, 1)
+
+def parallel_map(function, items, workers = None):
+    '''Return [ function(item) for item in items ] using worker processes.
+
+    Workers are forked, so function and items need not be picklable,
+    but the results and any exceptions raised must be. Worker n handles
+    items n, n + workers, n + 2 * workers, etc. and pickles its results
+    back over a pipe, where they are read back in item order.
+
+    When there is only one worker, or at most one item, no process is
+    forked.
+
+    If function raises, the exception for the earliest item is raised
+    after all the workers have finished.
+    '''
+    items = list(items)
+    if workers is None:
+        workers = get_worker_count()
+    workers = min(workers, len(items))
+    if workers <= 1:
+        return [ function(item) for item in items ]
+
+    children = []
+    for worker in range(workers):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if not pid:
+            # child
+            status = 1
+            try:
+                try:
+                    os.close(read_fd)
+                    for dummy, handle in children:
+                        handle.close()
+                    handle = os.fdopen(write_fd, 'w')
+                    pickler = Pickler(handle, 2)
+                    for index in range(worker, len(items), workers):
+                        try:
+                            result = (True, function(items[index]))
+                        except Exception, error:
+                            result = (False, error)
+                        pickler.clear_memo()
+                        pickler.dump(result)
+                    handle.close()
+                    status = 0
+                except:
+                    pass
+            finally:
+                os._exit(status)
+        os.close(write_fd)
+        children.append((pid, os.fdopen(read_fd)))
+
+    results = [None] * len(items)
+    errors = []
+    unpicklers = [ Unpickler(handle) for dummy, handle in children ]
+    try:
+        for index in range(len(items)):
+            unpickler = unpicklers[index % workers]
+            if unpickler is None:
+                continue
+            try:
+                succeeded, value = unpickler.load()
+            except EOFError:
+                unpicklers[index % workers] = None
+                errors.append(SemanticError('worker process failed'))
+                continue
+            if succeeded:
+                results[index] = value
+            else:
+                errors.append(value)
+    finally:
+        for pid, handle in children:
+            handle.close()
+            os.waitpid(pid, 0)
+
+    if errors:
+        raise errors[0]
+    return results
+
 class NullTerminated(object):
     '''Reads null terminated "lines" from a file handle'''
     def __init__(self, handle, block_size = 8096):
@@ -598,6 +837,30 @@ class NullTerminated(object):
                     yield current
                     current = ''
 
+def get_framing_version():
+    '''Return the highest framing version this end should use.
+
+    The version may be limited with the PDK_FRAMING environment
+    variable, for instance to compare against version 1.
+    '''
+    try:
+        version = int(os.environ['PDK_FRAMING'])
+    except (KeyError, ValueError):
+        version = 2
+    return max(1, min(version, 2))
+
+def get_frame_size():
+    '''Return the largest data frame to send with framing version 2.
+
+    The size in bytes may be set with the PDK_FRAME_SIZE environment
+    variable.
+    '''
+    try:
+        size = int(os.environ['PDK_FRAME_SIZE'])
+    except (KeyError, ValueError):
+        size = 1024 * 1024
+    return max(size, 1)
+
 class Framer(object):
     '''Represents "frames" of data travelling over pipes.
 
@@ -612,14 +875,38 @@ class Framer(object):
     separate processes. The framers are given custody of the pipes
     between the processes and are responsible for marshalling well
     defined frames of data between the processes.
+
+    Framing version 1 sends each frame as a text length line, the data
+    and a blank line, with data streamed in 16k frames. It flushes at
+    the end of every stream.
+
+    Version 2 sends a four byte big endian length before the data,
+    streams data in frames of get_frame_size(), and only flushes when
+    it is about to wait for the remote, so many requests and replies
+    can share a write. Both ends must switch versions at the same
+    point in a conversation; see verify_protocol.
     '''
     def __init__(self, remote_in, remote_out, waiter):
         self.remote_in = remote_in
         self.remote_out = remote_out
         self.waiter = waiter
+        self.version = 1
+        self.block_size = default_block_size
+
+    def set_version(self, version):
+        '''Use the given framing version from now on.'''
+        self.version = version
+        if version >= 2:
+            self.block_size = get_frame_size()
+        else:
+            self.block_size = default_block_size
 
     def write_frame(self, data):
         '''Write the given to self.remote_out as a frame.'''
+        if self.version >= 2:
+            self.remote_in.write(struct.pack('!I', len(data)))
+            self.remote_in.write(data)
+            return
         self.remote_in.write('%s\n' % len(data))
         self.remote_in.write(data)
         self.remote_in.write('\n\n')
@@ -636,7 +923,8 @@ class Framer(object):
 
     def write_handle(self, handle, size_callback = noop):
         '''Read data from a handle in blocks and send it as a stream.'''
-        for fragment in gen_fragments(handle):
+        for fragment in gen_fragments(handle,
+                                      block_size = self.block_size):
             self.write_frame(fragment)
             size_callback(len(fragment))
         self.end_stream()
@@ -644,10 +932,23 @@ class Framer(object):
     def end_stream(self):
         '''Send a frame which terminates a stream.'''
         self.write_frame('')
-        self.remote_in.flush()
+        if self.version < 2:
+            self.remote_in.flush()
 
     def read_frame(self):
         '''Retreive a sent frame. This method blocks.'''
+        if self.version >= 2:
+            # Anything still buffered may be what the remote waits for.
+            self.remote_in.flush()
+            header = self.remote_out.read(4)
+            if len(header) < 4:
+                raise InputError('Unexpected EOF')
+            length = struct.unpack('!I', header)[0]
+            data = self.remote_out.read(length)
+            if len(data) < length:
+                raise InputError('Unexpected EOF')
+            return data
+
         len_line = self.remote_out.readline()
         if not len_line:
             raise InputError('Unexpected EOF')
@@ -682,6 +983,48 @@ class Framer(object):
         self.remote_out.close()
         self.waiter()
 
+# The version of the conversation held over framers.
+net_protocol_version = '2'
+
+def verify_protocol(framer):
+    '''Verify that the remote end of framer speaks our protocol.
+
+    If the remote offers framing version 2, both ends switch to it for
+    the rest of the conversation. Remotes which don't know about
+    framing versions never offer one.
+    '''
+    framer.write_stream(['verify-protocol'])
+    framer.write_stream([net_protocol_version])
+    frame = framer.read_frame()
+    if frame == 'error':
+        message = framer.read_frame()
+        raise SemanticError, message
+    framer.assert_end_of_stream()
+    offers = frame.split()[1:]
+    if 'framing-2' in offers and get_framing_version() >= 2:
+        framer.write_stream(['set-framing'])
+        framer.write_stream(['2'])
+        framer.set_version(2)
+
+def answer_verify_protocol(framer):
+    '''Answer a verify-protocol request sent by verify_protocol.
+
+    The framing offer shares a frame with the acknowledgement, as
+    older peers accept any single frame other than "error" here.
+    '''
+    framer.assert_frame(net_protocol_version)
+    framer.assert_end_of_stream()
+    if get_framing_version() >= 2:
+        framer.write_stream(['protocol-ok framing-2'])
+    else:
+        framer.write_stream(['protocol-ok'])
+
+def answer_set_framing(framer):
+    '''Switch framing versions as requested by verify_protocol.'''
+    version = int(framer.read_frame())
+    framer.assert_end_of_stream()
+    framer.set_version(version)
+
 def make_self_framer():
     '''Make a framer connected to stdin and stdout. Waiter is a noop.'''
     return Framer(sys.stdout, sys.stdin, noop)
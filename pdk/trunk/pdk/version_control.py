@@ -884,6 +884,30 @@ class VersionControl(object):
             blob_id = matching_files[0][2]
             return self.git.get_blob(blob_id)
 
+    def iter_committed_blobs(self, history = 0):
+        '''Iterate over the files committed at HEAD and before.
+
+        history - how many commits before HEAD to include.
+
+        Yields (filename, blob_id) once for each distinct blob. Open
+        a blob with get_blob.
+        '''
+        if self.is_new():
+            return
+        revisions = self.git.get_rev_list(['HEAD'], [])[:history + 1]
+        seen = Set()
+        for revision in revisions:
+            for dummy, kind, blob_id, filename \
+                    in self.git.iter_ls_tree(revision, []):
+                if kind != 'blob' or blob_id in seen:
+                    continue
+                seen.add(blob_id)
+                yield filename, blob_id
+
+    def get_blob(self, blob_id):
+        '''Return a handle for reading a committed blob.'''
+        return self.git.get_blob(blob_id)
+
     def is_new(self):
         '''Is this a "new" workspace (no commits)?'''
         return self.git.is_new()
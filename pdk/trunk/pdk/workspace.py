@@ -38,10 +38,12 @@ from pdk.exceptions import ConfigurationError, SemanticError, \
      CommandLineError, InputError
 from pdk.util import pjoin, make_self_framer, cached_property, \
      relative_path, get_remote_file_as_string, make_ssh_framer, \
-     make_fs_framer, get_remote_file, noop, string_domain
+     make_fs_framer, get_remote_file, noop, string_domain, \
+     net_protocol_version, verify_protocol, answer_verify_protocol, \
+     answer_set_framing
 from pdk.semdiff import print_bar_separated, print_man, \
      iter_diffs, iter_diffs_meta, filter_predicate, filter_data
-from pdk.component import ComponentDescriptor
+from pdk.component import ComponentDescriptor, resolve_descriptors
 from pdk.repogen import compile_product
 from pdk.progress import ConsoleMassProgress, NullMassProgress, \
      SizeCallbackAdapter
@@ -291,6 +293,13 @@ def repogen(args):
 .PP
 Generate a file-system repository
 for a linux product.
+.PP
+With --incremental, an apt repository left by an earlier run is
+updated in place. Only changed pool links and package indexes are
+touched, and the new dists tree is swapped in when it is complete.
+.PP
+With --jobs, the pool links and package indexes are written by
+several processes.
     """
     ws = current_workspace()
     product_file = args.get_one_reoriented_file(ws)
@@ -301,9 +310,10 @@ for a linux product.
     else:
         repo_dir = pjoin(ws.location, 'repo')
     ws.download([ws.get_component_descriptor(product_file)])
-    compile_product(product_file, ws.cache, repo_dir, get_desc)
+    compile_product(product_file, ws.cache, repo_dir, get_desc,
+                    args.opts.incremental, args.opts.jobs)
 
-repogen = make_invokable(repogen, 'output-dest')
+repogen = make_invokable(repogen, 'output-dest', 'incremental', 'jobs')
 
 def mediagen(args):
     """\\fB%prog\\fP \\fICOMPONENT\\fP
@@ -696,13 +706,14 @@ def run_resolve(args, find_package, assert_resolved, abstract_constraint):
     get_desc = workspace.get_component_descriptor
     component_names = args.get_reoriented_files(workspace)
     os.chdir(workspace.location)
-    for component_name in component_names:
-        descriptor = get_desc(component_name)
-        channel_names = args.opts.channels
-        world_index = workspace.world.get_limited_index(channel_names)
-        descriptor.resolve(find_package, extended_cache, world_index,
-                           abstract_constraint)
-
+    channel_names = args.opts.channels
+    world_index = workspace.world.get_limited_index(channel_names,
+                                                    args.opts.explain)
+    descriptors = [ get_desc(n) for n in component_names ]
+    resolve_descriptors(descriptors, find_package, extended_cache,
+                        world_index, abstract_constraint, args.opts.jobs)
+
+    for descriptor in descriptors:
         if assert_resolved:
             descriptor._assert_resolved()
 
@@ -749,12 +760,23 @@ to resolve references.
 .PP
 A warning is given
 if any unresolved references remain.
+.PP
+With --explain,
+the index lookups used to find candidate packages
+are logged for each reference.
+.PP
+All the given components are resolved as one batch,
+loading each set of candidate packages once.
+With --jobs,
+the search for matching packages
+is spread over several processes.
     """
 
     run_resolve(args, find_newest, True, True)
 
 resolve = make_invokable(resolve, 'machine-readable', 'no-report',
-                         'dry-run', 'channels', 'show-unchanged')
+                         'dry-run', 'channels', 'show-unchanged', 'explain',
+                         'jobs')
 
 def find_upgrade(cache, stanza, iter_world_items):
     '''Find the best stanza upgrade in iter_world_items.
@@ -806,7 +828,8 @@ to resolve references.
     run_resolve(args, find_upgrade, False, False)
 
 upgrade = make_invokable(upgrade, 'machine-readable', 'no-report',
-                         'dry-run', 'channels', 'show-unchanged')
+                         'dry-run', 'channels', 'show-unchanged', 'explain',
+                         'jobs')
 
 def download(args):
     """\\fB%prog\\fP \\fIFILES\\fP
@@ -824,6 +847,19 @@ on the package indexes of configured channels.
 
 download = make_invokable(download)
 
+def cache_layout(args):
+    """\\fB%prog\\fP [\\fIOPTIONS\\fP]
+.PP
+Move the files in the cache under \\fB--levels\\fP directory levels.
+Each level is named by the next two hex digits of a checksum.
+The default layout has one level;
+more levels keep directories small in very large caches.
+    """
+    workspace = current_workspace()
+    workspace.cache.set_layout(args.opts.levels)
+
+cache_layout = make_invokable(cache_layout, 'levels')
+
 class _Workspace(object):
     """
     Library interface to pdk workspace
@@ -983,29 +1019,26 @@ class Net(object):
     send_* methods correspond to handle_* methods on remote processes.
     (mostly)
     '''
-    protocol_version = '2'
+    protocol_version = net_protocol_version
 
     def __init__(self, framer, local_workspace):
         self.framer = framer
         self.ws = local_workspace
 
     def verify_protocol(self):
-        '''Verify that the remote can speak our protocol version.'''
-        self.framer.write_stream(['verify-protocol'])
-        self.framer.write_stream(self.protocol_version)
-        frame = self.framer.read_frame()
-        if frame == 'protocol-ok':
-            pass
-        elif frame == 'error':
-            message = self.framer.read_frame()
-            raise SemanticError, message
-        self.framer.assert_end_of_stream()
+        '''Verify that the remote can speak our protocol version.
+
+        Switches to the fastest framing both ends know.
+        '''
+        verify_protocol(self.framer)
 
     def handle_verify_protocol(self):
         '''Handle protocl verification'''
-        self.framer.assert_frame(self.protocol_version)
-        self.framer.assert_end_of_stream()
-        self.framer.write_stream(['protocol-ok'])
+        answer_verify_protocol(self.framer)
+
+    def handle_set_framing(self):
+        '''Handle a switch of framing version.'''
+        answer_set_framing(self.framer)
 
     def send_done(self):
         '''Indicate that we are done speaking with the remote process.'''
@@ -1157,7 +1190,8 @@ class Net(object):
                         'pull-pack': self.handle_pull_pack,
                         'pull-blob-list': self.handle_pull_blob_list,
                         'pull-blobs': self.handle_pull_blobs,
-                        'verify-protocol': self.handle_verify_protocol, }
+                        'verify-protocol': self.handle_verify_protocol,
+                        'set-framing': self.handle_set_framing, }
 
         while 1:
             first = self.framer.read_frame()
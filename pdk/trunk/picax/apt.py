@@ -30,8 +30,15 @@ import picax.config
 import picax.log
 
 cache = None
+records = None
 config = {}
 
+# Built by init(): the apt package object for each name, and the
+# (index file, offset) of the stanza for each (name, version).
+
+package_index = {}
+stanza_index = {}
+
 class FoundPackage(Exception):
     "Exception to flag when a package is found."
     pass
@@ -107,19 +114,45 @@ Dir "%s/"
     cache = apt_pkg.GetCache()
     global_conf["apt_path"] = base_dir
 
-def _find_package_in_cache(pkg_name):
-    global cache
+    _build_indexes()
+
+def _build_indexes():
+    """Index the apt cache by package name, and every index file
+    stanza by package name and version, so later lookups don't have
+    to search for them."""
 
-    found_pkg = None
+    global records
+
+    records = apt_pkg.GetPkgRecords(cache)
+
+    package_index.clear()
     for pkg in cache.Packages:
-        if pkg.Name == pkg_name:
-            found_pkg = pkg
-            break
+        if not package_index.has_key(pkg.Name):
+            package_index[pkg.Name] = pkg
+
+    stanza_index.clear()
+    for pkg_file in cache.FileList:
+        filename = pkg_file.FileName
+        if not os.path.isfile(filename):
+            continue
+        fo = open(filename)
+        try:
+            tag = apt_pkg.ParseTagFile(fo)
+            offset = tag.Offset()
+            while tag.Step():
+                key = (tag.Section.get("Package"),
+                       tag.Section.get("Version"))
+                if not stanza_index.has_key(key):
+                    stanza_index[key] = (filename, offset)
+                offset = tag.Offset()
+        finally:
+            fo.close()
 
-    if found_pkg is None:
+def _find_package_in_cache(pkg_name):
+    if not package_index.has_key(pkg_name):
         raise RuntimeError, "could not find package %s" % (pkg_name,)
 
-    return found_pkg
+    return package_index[pkg_name]
 
 def find_package_uri(pkg_name):
     "Get a URI to the binary package with the given name."
@@ -130,21 +163,20 @@ def find_package_uri(pkg_name):
         raise RuntimeError, "package %s exists, but cannot be found" \
               % (pkg_name,)
 
+    base_paths = [ "file://" + global_conf["base_path"] ]
+    base_paths.extend(["file://" + x
+                       for x in global_conf["base_media"]])
+    if global_conf.has_key("correction_apt_repo"):
+        path = global_conf["correction_apt_repo"].split()[1]
+        base_paths.append(path)
+
     full_uri = None
     for pkg_version in found_pkg.VersionList:
         if full_uri:
             break
 
-        pkg_records = apt_pkg.GetPkgRecords(cache)
-        pkg_records.Lookup(pkg_version.FileList[0])
-        pkg_path = pkg_records.FileName
-
-        base_paths = [ "file://" + global_conf["base_path"] ]
-        base_paths.extend(["file://" + x
-                           for x in global_conf["base_media"]])
-        if global_conf.has_key("correction_apt_repo"):
-            path = global_conf["correction_apt_repo"].split()[1]
-            base_paths.append(path)
+        records.Lookup(pkg_version.FileList[0])
+        pkg_path = records.FileName
 
         for base_path in base_paths:
             if full_uri:
@@ -162,28 +194,26 @@ def get_package_data(pkg_name_or_ver):
     "Retrieve the given package's index data."
 
     if isinstance(pkg_name_or_ver, types.StringType):
-        version = cache[pkg_name_or_ver].VersionList[0]
+        version = _find_package_in_cache(pkg_name_or_ver).VersionList[0]
     else:
         version = pkg_name_or_ver
 
-    filename = version.FileList[0][0].FileName
+    key = (version.ParentPkg.Name, version.VerStr)
+    if not stanza_index.has_key(key):
+        raise RuntimeError, "could not find package in its cache file"
+    (filename, offset) = stanza_index[key]
 
     fo = open(filename)
-    tag = apt_pkg.ParseTagFile(fo)
-    tag_valid = 1
-    while tag_valid:
-        if tag.Section["Package"] == version.ParentPkg.Name:
-            break
-        tag_valid = tag.Step()
-
-    if not tag_valid:
-        raise RuntimeError, "could not find package in its cache file"
+    try:
+        tag = apt_pkg.ParseTagFile(fo)
+        tag.Jump(offset)
 
-    results = {}
-    for key in tag.Section.keys():
-        results[key] = tag.Section[key]
+        results = {}
+        for key in tag.Section.keys():
+            results[key] = tag.Section[key]
+    finally:
+        fo.close()
 
-    fo.close()
     return results
 
 def _get_latest_version(pkg):
@@ -243,7 +273,10 @@ def resolve_package_list(pkgs, pkgs_to_ignore, loose_deps = True):
         # Make sure that a package by this name exists; if not, add it
         # to the rejects list.
 
-        current_ver = _get_latest_version(cache[current_in])
+        if package_index.has_key(current_in):
+            current_ver = _get_latest_version(package_index[current_in])
+        else:
+            current_ver = None
 
         if not current_ver:
             reject.append(current_in)
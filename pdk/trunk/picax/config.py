@@ -103,6 +103,20 @@ main_options = { "help":
                                               "immediate", "mixed" ],
                    "parameter-desc": "type",
                    "doc": ("Set type of source media to create",) },
+                 "order-resolver":
+                 { "config-key": "order_resolver",
+                   "parameter": True,
+                   "parameter-default": "graph",
+                   "parameter-constraints": [ "graph", "apt" ],
+                   "parameter-desc": "type",
+                   "doc": ("How to resolve the package order",) },
+                 "split-mode":
+                 { "config-key": "split_mode",
+                   "parameter": True,
+                   "parameter-default": "greedy",
+                   "parameter-constraints": [ "greedy", "packed" ],
+                   "parameter-desc": "mode",
+                   "doc": ("How to fill parts with packages",) },
                  "apt-repo-path":
                  { "config-key": "correction_apt_repo",
                    "parameter": True },
@@ -0,0 +1,214 @@
+# $Progeny$
+#
+# Order packages by their dependency graph.
+#
+#   Copyright 2006 Progeny Linux Systems, Inc.
+#
+#   This file is part of PDK.
+#
+#   PDK is free software; you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   PDK is distributed in the hope that it will be useful, but WITHOUT
+#   ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#   or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+#   License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with PDK; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""This module orders binary packages so that each package comes after
+its dependencies, working from the Depends and Pre-Depends fields of
+the packages themselves rather than from apt.  Packages which depend
+on each other in a cycle are collapsed into clusters, which are kept
+together in the order.  The order is computed in a single depth-first
+pass over the graph (Tarjan's strongly connected components
+algorithm), so it takes time linear in the size of the graph."""
+
+import apt_pkg
+
+import picax.log
+
+def parse_depends(value):
+    """Parse a Depends-style field into a list of dependencies, each a
+    list of alternative package names.  Version and architecture
+    restrictions are dropped."""
+
+    deps = []
+    for dep in value.split(","):
+        alternatives = []
+        for alternative in dep.split("|"):
+            name = alternative.split("(")[0].split("[")[0].strip()
+            if name:
+                alternatives.append(name)
+        if alternatives:
+            deps.append(alternatives)
+
+    return deps
+
+class DependencyGraph:
+    """The dependency graph of a set of binary packages.  Packages
+    named in the ignore list, given as (name, version) pairs, are
+    taken to be available already; dependencies on them are satisfied,
+    and they are left out of the order."""
+
+    def __init__(self, packages, ignore = None):
+        self.log = picax.log.get_logger()
+        self.packages = {}
+        self.providers = {}
+        self.ignore = {}
+        self.edges = {}
+        self.parsed = {}
+
+        if ignore is not None:
+            self.ignore = dict(ignore)
+
+        for pkg in packages:
+            name = pkg["Package"]
+            if not self.packages.has_key(name) or \
+               apt_pkg.VersionCompare(pkg["Version"],
+                                      self.packages[name]["Version"]) > 0:
+                self.packages[name] = pkg
+
+        for pkg in packages:
+            if not pkg.has_key("Provides"):
+                continue
+            name = pkg["Package"]
+            for alternatives in self._parse(pkg["Provides"]):
+                for virtual in alternatives:
+                    providers = self.providers.setdefault(virtual, [])
+                    if name not in providers:
+                        providers.append(name)
+
+    def _parse(self, value):
+        "Parse a dependency field, reusing earlier parses of it."
+
+        if not self.parsed.has_key(value):
+            self.parsed[value] = parse_depends(value)
+        return self.parsed[value]
+
+    def _is_ignored(self, name):
+        if not self.ignore.has_key(name):
+            return False
+        if not self.packages.has_key(name):
+            return True
+        return self.ignore[name] == self.packages[name]["Version"]
+
+    def _choose(self, alternatives, seen):
+        """Pick the package which satisfies a dependency.  Return a
+        tuple of the package name (or None if no package is needed)
+        and whether the dependency could be satisfied at all.
+
+        Ignored packages satisfy a dependency outright.  Otherwise,
+        packages already seen in the order are preferred, then real
+        packages, then providers of virtual packages, each in the
+        order they are listed."""
+
+        candidates = []
+        for name in alternatives:
+            if self._is_ignored(name):
+                return (None, True)
+            if self.packages.has_key(name):
+                candidates.append(name)
+        for name in alternatives:
+            for provider in self.providers.get(name, []):
+                if self._is_ignored(provider):
+                    return (None, True)
+                candidates.append(provider)
+
+        for name in candidates:
+            if seen.has_key(name):
+                return (name, True)
+        if candidates:
+            return (candidates[0], True)
+        return (None, False)
+
+    def get_edges(self, name, seen):
+        """Return the names of the packages the named package depends
+        on, in the order the dependencies are listed."""
+
+        if self.edges.has_key(name):
+            return self.edges[name]
+
+        pkg = self.packages[name]
+        edges = []
+        for key in ("Pre-Depends", "Depends"):
+            if not pkg.has_key(key):
+                continue
+            for alternatives in self._parse(pkg[key]):
+                (target, found) = self._choose(alternatives, seen)
+                if not found:
+                    self.log.warning(
+                        "Could not resolve dep '%s' for package %s"
+                        % (" | ".join(alternatives), name))
+                elif target is not None and target != name and \
+                     target not in edges:
+                    edges.append(target)
+
+        self.edges[name] = edges
+        return edges
+
+    def order(self, names):
+        """Return the given packages, and the packages they depend on,
+        with every package after its dependencies.  Clusters of
+        packages depending on each other are returned as lists of
+        names.  The names are taken in the order given, and each
+        package is placed as early as its dependencies allow, so
+        packages earlier in the list come earlier in the order.
+        Unknown and ignored names are dropped."""
+
+        index = {}
+        lowlink = {}
+        stack = []
+        on_stack = {}
+        results = []
+
+        for root in names:
+            if index.has_key(root) or not self.packages.has_key(root) \
+               or self._is_ignored(root):
+                continue
+
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            on_stack[root] = True
+            work = [(root, iter(self.get_edges(root, index)))]
+
+            while work:
+                (node, edges) = work[-1]
+                for target in edges:
+                    if not index.has_key(target):
+                        index[target] = lowlink[target] = len(index)
+                        stack.append(target)
+                        on_stack[target] = True
+                        work.append((target,
+                                     iter(self.get_edges(target, index))))
+                        break
+                    elif on_stack.has_key(target):
+                        lowlink[node] = min(lowlink[node], index[target])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent],
+                                              lowlink[node])
+
+                    if lowlink[node] == index[node]:
+                        cluster = []
+                        while True:
+                            member = stack.pop()
+                            del on_stack[member]
+                            cluster.append(member)
+                            if member == node:
+                                break
+                        cluster.reverse()
+                        if len(cluster) == 1:
+                            results.append(cluster[0])
+                        else:
+                            results.append(cluster)
+
+        return results
+
+# vim:set ai et sw=4 ts=4 tw=75:
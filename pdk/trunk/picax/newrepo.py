@@ -31,6 +31,7 @@ import sha
 import gzip
 
 import picax.config
+import picax.package
 
 def _gen_release_key(distro, component):
     return "%s:%s" % (distro, component)
@@ -143,13 +144,12 @@ class NewRepository:
 
             pkg.link(self.dest_path)
 
-            if pkg.has_key("Binary"):
+            if isinstance(pkg, picax.package.SourcePackage):
                 index_file = srcs_file
             else:
                 index_file = pkgs_file
 
-            for line in pkg.get_lines():
-                index_file.write(line)
+            index_file.write(pkg.get_data())
             index_file.write("\n")
 
         for distro_key in index_files.keys():
@@ -28,6 +28,7 @@ import os
 
 import picax.package
 import picax.apt
+import picax.depgraph
 import picax.config
 import picax.log
 
@@ -105,9 +106,11 @@ def _order_rest(packages, current_order):
     conf = picax.config.get_config()
     if not conf["short_package_list"]:
         new_order = current_order[:]
+        in_order = dict([(x, True) for x in new_order])
         for pkg in packages:
-            if pkg["Package"] not in new_order:
+            if not in_order.has_key(pkg["Package"]):
                 new_order.append(pkg["Package"])
+                in_order[pkg["Package"]] = True
         return new_order
     else:
         return current_order
@@ -123,8 +126,28 @@ def _order_apt(dummy, current_order):
                                                base_media_list)
     return new_order
 
+def _order_graph(packages, current_order):
+    """Resolve the package order from the packages' own dependency
+    graph, so that a package's dependencies show up earlier in the
+    order than the package."""
+
+    base_media_pkgs = picax.package.get_base_media_packages()
+    base_media_list = [(x["Package"], x["Version"])
+                       for x in base_media_pkgs]
+    graph = picax.depgraph.DependencyGraph(packages, base_media_list)
+    return graph.order(current_order)
+
+def _order_deps(packages, current_order):
+    """Resolve the package order with the configured resolver."""
+
+    conf = picax.config.get_config()
+    if conf["order_resolver"] == "apt":
+        return _order_apt(packages, current_order)
+    else:
+        return _order_graph(packages, current_order)
+
 default_order_funcs = [ _order_udebs, _order_explicit, _order_debootstrap,
-                        _order_installer, _order_rest, _order_apt ]
+                        _order_installer, _order_rest, _order_deps ]
 
 def order(packages):
     """Apply order functions and return the resulting order."""
@@ -26,59 +26,118 @@ create a PackageFactory, which creates and returns subclasses of Package
 objects."""
 
 import os
+import mmap
 import apt_pkg
 
 import picax.config
 import picax.log
 
+def _map_index(index_file):
+    """Return a read-only memory map of an open index file, or None if
+    the file is empty."""
+
+    if os.fstat(index_file.fileno()).st_size == 0:
+        return None
+    return mmap.mmap(index_file.fileno(), 0, access = mmap.ACCESS_READ)
+
 # Class definitions
 
-class Package:
+class Package(object):
     """This class encapsulates a Package as represented in an apt
     Packages file.  Don't create one of your own; instead, rely on the
-    PackageFactory class below to create these for you."""
+    PackageFactory class below to create these for you.
+
+    Only the fields picax itself uses are kept, in slots, with the
+    shorter ones interned; any other field is parsed out of the
+    package's stanza in the index when it is asked for."""
+
+    __slots__ = ("base_path", "fn", "index_map", "start_pos", "end_pos",
+                 "distro", "component", "meta", "package", "version",
+                 "source", "filename", "directory", "files", "depends",
+                 "pre_depends", "provides")
+
+    _field_slots = { "Package": "package",
+                     "Version": "version",
+                     "Source": "source",
+                     "Filename": "filename",
+                     "Directory": "directory",
+                     "Files": "files",
+                     "Depends": "depends",
+                     "Pre-Depends": "pre_depends",
+                     "Provides": "provides" }
+
+    _fixed_meta = { "distribution": "distro",
+                    "component": "component" }
+
+    _calc_meta = { "Package-Size": "_get_package_size" }
 
-    def __init__(self, base_path, fn, start_pos, section, distro,
-                 component):
+    def __init__(self, base_path, fn, index_map, start_pos, end_pos,
+                 section, distro, component):
         self.base_path = base_path
         self.fn = fn
+        self.index_map = index_map
         self.start_pos = start_pos
-        self.lines = []
-        self.meta = {}
-
-        self.fields = {}
-        for key in section.keys():
-            self.fields[key] = section[key]
-
-        self.meta["distribution"] = distro
-        self.meta["component"] = component
-
-        self.log = picax.log.get_logger()
+        self.end_pos = end_pos
+        self.distro = intern(distro)
+        self.component = intern(component)
+        self.meta = None
+
+        for (key, slot) in self._field_slots.items():
+            value = None
+            if section.has_key(key):
+                value = section[key]
+                if key != "Files":
+                    value = intern(value)
+            setattr(self, slot, value)
 
     def __str__(self):
         return self["Package"]
 
+    def get_data(self):
+        """Retrieve this package's stanza from the index as a single
+        string, without the blank line separating it from the next."""
+
+        data = self.index_map[self.start_pos:self.end_pos]
+        return data.strip("\n") + "\n"
+
     def get_lines(self):
         "Retrieve the data about this package from the index."
 
-        if len(self.lines) == 0:
-            tagfile = open(self.fn)
-            tagfile.seek(self.start_pos)
-            line = tagfile.readline()
-            while len(line.strip()) > 0:
-                self.lines.append(line)
-                line = tagfile.readline()
-            tagfile.close()
+        return self.get_data().splitlines(True)
+
+    def _get_section(self):
+        "Parse the package's stanza, for fields which aren't kept."
+
+        return apt_pkg.ParseSection(self.get_data() + "\n")
+
+    def _get_field(self, key):
+        """Return the value of a field from the index, or None if the
+        package doesn't have it."""
+
+        if self._field_slots.has_key(key):
+            return getattr(self, self._field_slots[key])
+
+        section = self._get_section()
+        if section.has_key(key):
+            return section[key]
+        return None
 
-        return self.lines[:]
+    def _has_meta(self, key):
+        return self._fixed_meta.has_key(key) or \
+               (self.meta is not None and self.meta.has_key(key))
+
+    def _set_meta(self, key, value):
+        if self.meta is None:
+            self.meta = {}
+        self.meta[key] = value
 
     def get_source_info(self):
         """Retrieve the information about this package's source package.
         If the package is a source package, just return its own
         information."""
 
-        if self.fields.has_key("Source"):
-            source = self["Source"].strip().split()
+        if self.source is not None:
+            source = self.source.strip().split()
             if len(source) == 1:
                 return (source[0], self["Version"])
             else:
@@ -101,33 +160,44 @@ class Package:
     def has_key(self, key):
         "Verify that the package has the particular key."
 
-        if self.fields.has_key(key) or \
-           self._calc_meta.has_key(key) or \
-           self.meta.has_key(key):
+        if self._has_meta(key) or self._calc_meta.has_key(key):
             return True
-        else:
-            return False
+        return self._get_field(key) is not None
 
     def __getitem__(self, key):
-        if self.fields.has_key(key):
-            return self.fields[key]
+        if self._field_slots.has_key(key):
+            value = getattr(self, self._field_slots[key])
+            if value is not None:
+                return value
+
+        if self._fixed_meta.has_key(key):
+            return getattr(self, self._fixed_meta[key])
 
-        if not self.meta.has_key(key) and self._calc_meta.has_key(key):
+        if not self._has_meta(key) and self._calc_meta.has_key(key):
             func = getattr(self, self._calc_meta[key])
             func(key)
 
-        return self.meta[key]
+        if self._has_meta(key):
+            return self.meta[key]
+
+        if not self._field_slots.has_key(key):
+            value = self._get_field(key)
+            if value is not None:
+                return value
+
+        raise KeyError, key
 
     def __setitem__(self, key, value):
-        if self.fields.has_key(key):
+        if self._fixed_meta.has_key(key) or \
+           self._get_field(key) is not None:
             raise KeyError, "meta field already defined in Packages file"
-        self.meta[key] = value
-
-    _calc_meta = { "Package-Size": "_get_package_size" }
+        self._set_meta(key, value)
 
 class BinaryPackage(Package):
     "This is a subclass of Package to support binary packages."
 
+    __slots__ = ()
+
     def __repr__(self):
         return "<picax.package.BinaryPackage instance: %s>" \
                % (self["Package"],)
@@ -140,7 +210,7 @@ class BinaryPackage(Package):
         dest_path = dest_root_path + "/" + pkg_path
 
         if os.path.exists(dest_path):
-            self.log.warning(
+            picax.log.get_logger().warning(
                 "Binary package %s already copied once, skipping"
                 % (self["Package"],))
             return
@@ -154,12 +224,14 @@ class BinaryPackage(Package):
     def _get_package_size(self, key):
         "Return the size of the package file."
 
-        self.meta[key] = os.stat(self.base_path + "/"
-                                 + self["Filename"]).st_size
+        self._set_meta(key, os.stat(self.base_path + "/"
+                                    + self["Filename"]).st_size)
 
 class UBinaryPackage(BinaryPackage):
     "This is a subclass of Package to support binary udebs."
 
+    __slots__ = ()
+
     def __repr__(self):
         return "<picax.package.UBinaryPackage instance: %s>" \
                % (self["Package"],)
@@ -167,10 +239,12 @@ class UBinaryPackage(BinaryPackage):
 class SourcePackage(Package):
     "This is a subclass of Package to support source packages."
 
-    def __init__(self, base_path, fn, start_pos, section, distro,
-                 component):
-        Package.__init__(self, base_path, fn, start_pos,
-                         section, distro, component)
+    __slots__ = ("file_list",)
+
+    def __init__(self, base_path, fn, index_map, start_pos, end_pos,
+                 section, distro, component):
+        Package.__init__(self, base_path, fn, index_map, start_pos,
+                         end_pos, section, distro, component)
         self.file_list = []
 
     def __str__(self):
@@ -197,7 +271,7 @@ class SourcePackage(Package):
         for path in self._get_file_list():
             dest_file_path = dest_path + "/" + path
             if os.path.exists(dest_file_path):
-                self.log.warning(
+                picax.log.get_logger().warning(
                     "Source package %s already copied once, skipping"
                     % (self["Package"],))
                 return
@@ -215,12 +289,16 @@ class SourcePackage(Package):
         for path in self._get_file_list():
             total_size = total_size + os.stat(self.base_path + "/"
                                               + path).st_size
-        self.meta[key] = total_size
+        self._set_meta(key, total_size)
 
 class PackageFactory:
     """This class creates Package objects from the Packages file it is
     given.  Besides the explicit function calls, PackageFactory
-    objects can be treated as iterators."""
+    objects can be treated as iterators.
+
+    The file is mapped into memory once, and each package records the
+    byte range of its stanza in the map, so the stanza can be copied
+    back out later without reopening the file."""
 
     def __init__(self, package_file_stream, base_path, distro, component):
         self.base_path = base_path
@@ -228,6 +306,7 @@ class PackageFactory:
         self.component = component
         self.package_file = package_file_stream
         self.package_parser = apt_pkg.ParseTagFile(package_file_stream)
+        self.index_map = _map_index(package_file_stream)
         self.eof = False
         self.last_pos = None
 
@@ -254,17 +333,20 @@ class PackageFactory:
 
         if self.package_parser.Section.has_key("Binary"):
             return SourcePackage(self.base_path, self.package_file.name,
-                                 self.last_pos,
+                                 self.index_map, self.last_pos,
+                                 self.current_pos,
                                  self.package_parser.Section,
                                  self.distro, self.component)
         elif self.package_parser.Section["Filename"][-4:] == "udeb":
             return UBinaryPackage(self.base_path, self.package_file.name,
-                                  self.last_pos,
+                                  self.index_map, self.last_pos,
+                                  self.current_pos,
                                   self.package_parser.Section,
                                   self.distro, self.component)
         else:
             return BinaryPackage(self.base_path, self.package_file.name,
-                                 self.last_pos,
+                                 self.index_map, self.last_pos,
+                                 self.current_pos,
                                  self.package_parser.Section,
                                  self.distro, self.component)
 
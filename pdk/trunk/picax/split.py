@@ -29,9 +29,28 @@ import types
 import picax.config
 import picax.log
 
-def _get_binary_and_source(binary_name, binary_list, source_list):
+def _index_binaries(binary_list):
+    """Map each binary package name to a list of (position, package)
+    pairs, where position is the package's place in binary_list."""
+
+    index = {}
+    for position, pkg in enumerate(binary_list):
+        index.setdefault(pkg["Package"], []).append((position, pkg))
+    return index
+
+def _index_sources(source_list):
+    """Map each (source name, version) pair to the list of source
+    packages with that name and version, in source_list order."""
+
+    index = {}
+    for pkg in source_list:
+        key = (pkg["Package"], pkg["Version"])
+        index.setdefault(key, []).append(pkg)
+    return index
+
+def _get_binary_and_source(binary_name, binary_index, source_index):
     """Take a binary package name (or a list of names that must be kept
-    together) and lists of binary packages and source packages, and
+    together) and indexes of binary packages and source packages, and
     return two lists: one of packages to add now, and one of packages
     to add later.  'Now' and 'later' have to do with the source packing
     type."""
@@ -44,8 +63,16 @@ def _get_binary_and_source(binary_name, binary_list, source_list):
     else:
         binary_names = binary_name
 
-    binary_pkgs = [pkg for pkg in binary_list
-                   if pkg["Package"] in binary_names]
+    # Packages found under several names still come back once each,
+    # in the order of the original binary list.
+
+    found = {}
+    for name in binary_names:
+        for (position, pkg) in binary_index.get(name, []):
+            found[position] = pkg
+    positions = found.keys()
+    positions.sort()
+    binary_pkgs = [found[position] for position in positions]
 
     if len(binary_pkgs) < 1:
         raise IndexError, \
@@ -58,10 +85,8 @@ def _get_binary_and_source(binary_name, binary_list, source_list):
     source_pkgs = []
     if conf["source"] != "none":
         for now_pkg in now_pkgs:
-            (source_name, source_version) = now_pkg.get_source_info()
-            new_source_pkgs = [pkg for pkg in source_list
-                               if pkg["Package"] == source_name and
-                               pkg["Version"] == source_version]
+            new_source_pkgs = source_index.get(now_pkg.get_source_info(),
+                                               [])
             if len(new_source_pkgs) < 1:
                 log.warning("package %s has no proper source"
                             % (now_pkg["Package"],))
@@ -76,10 +101,51 @@ def _get_binary_and_source(binary_name, binary_list, source_list):
 
     return (now_pkgs, later_pkgs)
 
+def _pack_first_fit(pkgs, part_size, current_list, current_size):
+    """Pack the packages into parts of part_size bytes, largest first,
+    putting each in the first part with room for it.  The first part
+    starts out holding current_list, which fills current_size bytes.
+    Within a part, packages keep their original order.  Return the
+    non-empty parts."""
+
+    by_size = [(-pkg["Package-Size"], position, pkg)
+               for position, pkg in enumerate(pkgs)]
+    by_size.sort()
+
+    parts = [[current_size, []]]
+    for (neg_size, position, pkg) in by_size:
+        pkg_size = -neg_size
+        for part in parts:
+            if (part[0] + pkg_size) <= part_size:
+                break
+        else:
+            part = [0, []]
+            parts.append(part)
+        part[0] = part[0] + pkg_size
+        part[1].append((position, pkg))
+
+    part_lists = []
+    for index, (dummy, entries) in enumerate(parts):
+        entries.sort()
+        part_list = [pkg for (position, pkg) in entries]
+        if index == 0:
+            part_list = current_list + part_list
+        if part_list:
+            part_lists.append(part_list)
+
+    return part_lists
+
 def split(binary_order, binary_list, source_list, first_part_size = 0):
     """Take the binary and source packages, and split them into parts
     of part_size bytes, using the given order.  Return the package
-    objects stuffed into a list of lists in part order."""
+    objects stuffed into a list of lists in part order.
+
+    In the default "greedy" split mode, packages fill each part in
+    order until the next one doesn't fit.  In the "packed" mode, the
+    source packages placed after the binaries, which need no
+    particular order, are packed first-fit-decreasing into as few
+    parts as possible instead.  Binaries are always placed in order,
+    since the install order depends on it."""
 
     conf = picax.config.get_config()
 
@@ -90,20 +156,30 @@ def split(binary_order, binary_list, source_list, first_part_size = 0):
         total_size = total_binary_size + total_source_size
         part_size = total_size / conf["num_parts"]
 
+    binary_index = _index_binaries(binary_list)
+    source_index = _index_sources(source_list)
+
+    # Package defines no __eq__, so list membership compares identity;
+    # these dictionaries are keyed on id() to match.
+
     post_binary_list = []
+    post_binary_seen = {}
     current_size = first_part_size
     current_list = []
     part_lists = []
-    already_added = []
+    already_added = {}
 
     for pkg_name in binary_order:
         (now_pkgs, later_pkgs) = _get_binary_and_source(pkg_name,
-                                                        binary_list,
-                                                        source_list)
-        post_binary_list.extend([x for x in later_pkgs
-                                 if x not in post_binary_list])
-
-        pkgs_to_add = [x for x in now_pkgs if x not in already_added]
+                                                        binary_index,
+                                                        source_index)
+        for pkg in later_pkgs:
+            if not post_binary_seen.has_key(id(pkg)):
+                post_binary_seen[id(pkg)] = True
+                post_binary_list.append(pkg)
+
+        pkgs_to_add = [x for x in now_pkgs
+                       if not already_added.has_key(id(x))]
         if not pkgs_to_add:
             continue
 
@@ -117,17 +193,23 @@ def split(binary_order, binary_list, source_list, first_part_size = 0):
         current_list.extend(pkgs_to_add)
         current_size = current_size + pkg_size
 
-        already_added.extend(pkgs_to_add)
+        for pkg in pkgs_to_add:
+            already_added[id(pkg)] = True
 
     if conf["source"] == "separate":
         part_lists.append(current_list)
         current_list = []
         current_size = 0
 
-    for pkg in post_binary_list:
-        if pkg in already_added:
-            continue
+    post_binary_list = [pkg for pkg in post_binary_list
+                        if not already_added.has_key(id(pkg))]
+
+    if conf["split_mode"] == "packed":
+        part_lists.extend(_pack_first_fit(post_binary_list, part_size,
+                                          current_list, current_size))
+        return part_lists
 
+    for pkg in post_binary_list:
         if (current_size + pkg["Package-Size"]) > part_size:
             part_lists.append(current_list)
             current_list = []
@@ -136,8 +218,6 @@ def split(binary_order, binary_list, source_list, first_part_size = 0):
         current_list.append(pkg)
         current_size = current_size + pkg["Package-Size"]
 
-        already_added.append(pkg)
-
     if current_list:
         part_lists.append(current_list)
 
@@ -29,6 +29,30 @@ import unittest
 
 import picax.config
 
+class FakePackage:
+    """A stand-in for picax.package.Package, holding just the fields
+    a test gives it."""
+
+    def __init__(self, name, size = None, source = None, depends = None,
+                 provides = None, version = "1"):
+        self.fields = { "Package": name, "Version": version }
+        if size is not None:
+            self.fields["Package-Size"] = size
+        if depends:
+            self.fields["Depends"] = depends
+        if provides:
+            self.fields["Provides"] = provides
+        self.source = source or name
+
+    def __getitem__(self, key):
+        return self.fields[key]
+
+    def has_key(self, key):
+        return self.fields.has_key(key)
+
+    def get_source_info(self):
+        return (self.source, self.fields["Version"])
+
 class PackageBaseHarness(unittest.TestCase):
     "Shared harness sets up an environment for reading package info."
 
@@ -0,0 +1,98 @@
+# $Progeny$
+#
+# Test picax.depgraph.
+#
+#   Copyright 2006 Progeny Linux Systems, Inc.
+#
+#   This file is part of PDK.
+#
+#   PDK is free software; you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   PDK is distributed in the hope that it will be useful, but WITHOUT
+#   ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#   or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+#   License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with PDK; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+"This module tests the picax.depgraph module."
+
+import unittest
+
+import picax.config
+import picax.depgraph
+
+from picax.test.harnesses import FakePackage
+
+class TestParseDepends(unittest.TestCase):
+    "Test parsing dependency fields."
+
+    def testParse(self):
+        "Versions and architectures are dropped from alternatives."
+
+        self.assertEqual([["a"], ["b", "c"], ["d"]],
+                         picax.depgraph.parse_depends(
+                             "a (>= 1.0), b | c (<< 2) [i386],d"))
+
+class TestOrder(unittest.TestCase):
+    "Test ordering packages by dependency."
+
+    def setUp(self):
+        picax.config.config = { "debug": False, "quiet": True }
+
+        self.packages = [
+            FakePackage("app", depends = "lib, mta | postfix"),
+            FakePackage("lib", depends = "base"),
+            FakePackage("base"),
+            FakePackage("exim", depends = "lib", provides = "mta"),
+            FakePackage("loop1", depends = "loop2"),
+            FakePackage("loop2", depends = "loop1, base"),
+            FakePackage("top", depends = "loop2"),
+            FakePackage("broken", depends = "missing") ]
+
+    def tearDown(self):
+        picax.config.config = None
+
+    def order(self, names, ignore = None):
+        graph = picax.depgraph.DependencyGraph(self.packages, ignore)
+        return graph.order(names)
+
+    def testDependenciesFirst(self):
+        "Dependencies, and providers of virtual packages, come first."
+
+        self.assertEqual(["base", "lib", "exim", "app"],
+                         self.order(["app"]))
+
+    def testPriority(self):
+        "Earlier names come earlier, each package only once."
+
+        self.assertEqual(["base", "lib", "exim", "app"],
+                         self.order(["exim", "app", "lib"]))
+        self.assertEqual(["base", "lib", "exim"],
+                         self.order(["base", "exim", "base"]))
+
+    def testCluster(self):
+        "Packages in a dependency cycle are kept together."
+
+        self.assertEqual(["base", ["loop2", "loop1"], "top"],
+                         self.order(["top"]))
+
+    def testIgnore(self):
+        "Ignored packages satisfy dependencies and are left out."
+
+        self.assertEqual(["lib", "exim", "app"],
+                         self.order(["app", "base"], [("base", "1")]))
+        self.assertEqual(["base", "lib", "app"],
+                         self.order(["app"], [("postfix", "2")]))
+
+    def testUnknown(self):
+        "Unknown packages and unresolvable dependencies are skipped."
+
+        self.assertEqual(["broken"], self.order(["broken", "nothing"]))
+
+# vim:set ai et sw=4 ts=4 tw=75:
@@ -108,6 +108,36 @@ class TestPackage(PackageBaseHarness):
                             "unequal lines: expected '%s', got '%s'"
                             % (l2, l1))
 
+    def testPackageData(self):
+        """Test that the stanzas of all the packages, separated by
+        blank lines, make up the original index."""
+
+        index_fn = "temp/dists/foo/main/binary-i386/Packages"
+        index = open(index_fn)
+        factory = package_factory(index, "temp", "foo", "main")
+        data = "\n".join([pkg.get_data() for pkg in factory])
+        index.close()
+
+        self.failUnless(data.strip() == open(index_fn).read().strip(),
+                        "stanzas do not match the index")
+
+    def testFields(self):
+        """Test that fields which aren't kept in the package are still
+        read from the index."""
+
+        index = open("temp/dists/foo/main/binary-i386/Packages")
+        factory = package_factory(index, "temp", "foo", "main")
+        pkg = factory.get_next_package()
+        index.close()
+
+        self.failUnless(pkg["Package"] == "install-dcc")
+        self.failUnless(pkg["Priority"] == "standard")
+        self.failUnless(pkg["distribution"] == "foo")
+        self.failUnless(pkg.has_key("Section"))
+        self.failIf(pkg.has_key("Source"))
+        self.assertRaises(KeyError, pkg.__getitem__, "Bogus-Field")
+        self.assertRaises(KeyError, pkg.__setitem__, "Priority", "extra")
+
     def testCalculatedField(self):
         "Test that calculated fields work properly."
 
@@ -0,0 +1,117 @@
+# $Progeny$
+#
+# Test picax.split.
+#
+#   Copyright 2006 Progeny Linux Systems, Inc.
+#
+#   This file is part of PDK.
+#
+#   PDK is free software; you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   PDK is distributed in the hope that it will be useful, but WITHOUT
+#   ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#   or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+#   License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with PDK; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+"This module tests the picax.split module."
+
+import unittest
+
+import picax.config
+import picax.split
+
+from picax.test.harnesses import FakePackage
+
+class SplitBaseHarness(unittest.TestCase):
+    """Set up a small distribution of binaries and sources.  Sizes are
+    chosen so the order matters for how parts are filled."""
+
+    source = "separate"
+    split_mode = "greedy"
+
+    def setUp(self):
+        picax.config.config = { "debug": False, "quiet": True,
+                                "part_size": 10, "num_parts": 0,
+                                "source": self.source,
+                                "split_mode": self.split_mode }
+
+        self.binaries = [ FakePackage("a", 4), FakePackage("b", 3),
+                          FakePackage("c", 5, "ab"), FakePackage("d", 2),
+                          FakePackage("e", 1, "ab") ]
+        self.sources = [ FakePackage("a", 5), FakePackage("b", 6),
+                         FakePackage("ab", 4), FakePackage("d", 5) ]
+
+    def tearDown(self):
+        picax.config.config = None
+
+    def names(self, parts):
+        "Return the package names in each part."
+
+        return [[pkg["Package"] for pkg in part] for part in parts]
+
+class TestGreedySplit(SplitBaseHarness):
+    "Test the default greedy split."
+
+    def testSeparate(self):
+        "Binaries fill parts in order, with sources after them."
+
+        parts = picax.split.split(["a", "b", ["c", "e"], "d"],
+                                  self.binaries, self.sources)
+        self.assertEqual([["a", "b"], ["c", "e", "d"], ["a"],
+                          ["b", "ab"], ["d"]],
+                         self.names(parts))
+
+    def testGroupOrder(self):
+        "Groups come out in binary list order, each package once."
+
+        parts = picax.split.split([["e", "c", "e"], "a"],
+                                  self.binaries, self.sources)
+        self.assertEqual(["c", "e", "a"], self.names(parts)[0])
+
+    def testFirstPartSize(self):
+        "Space reserved on the first part is honored."
+
+        parts = picax.split.split(["a", "b"], self.binaries,
+                                  self.sources, 5)
+        self.assertEqual([["a"], ["b"]], self.names(parts)[:2])
+
+    def testMissing(self):
+        "Unknown packages raise IndexError."
+
+        self.assertRaises(IndexError, picax.split.split, ["z"],
+                          self.binaries, self.sources)
+
+class TestMixedSplit(SplitBaseHarness):
+    "Test splitting with sources next to their binaries."
+
+    source = "mixed"
+
+    def testMixed(self):
+        "Sources follow their binaries, and are only added once."
+
+        parts = picax.split.split(["c", "e"], self.binaries,
+                                  self.sources)
+        self.assertEqual([["c", "ab", "e"]], self.names(parts))
+
+class TestPackedSplit(SplitBaseHarness):
+    "Test packing sources into as few parts as possible."
+
+    split_mode = "packed"
+
+    def testPacked(self):
+        "Sources are packed largest first, binaries stay in order."
+
+        parts = picax.split.split(["a", "b", ["c", "e"], "d"],
+                                  self.binaries, self.sources)
+        self.assertEqual([["a", "b"], ["c", "e", "d"], ["b", "ab"],
+                          ["a", "d"]],
+                         self.names(parts))
+
+# vim:set ai et sw=4 ts=4 tw=75:
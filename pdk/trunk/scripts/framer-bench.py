@@ -0,0 +1,101 @@
+#!/usr/bin/python
+#
+# $Progeny$
+#
+#   Copyright 2006 Progeny Linux Systems, Inc.
+#
+#   This file is part of PDK.
+#
+#   PDK is free software; you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   PDK is distributed in the hope that it will be useful, but WITHOUT
+#   ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#   or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+#   License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with PDK; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+# framer-bench.py - time blob transfers between two framers over a
+#                   local pipe, with each framing version.
+#
+# usage: framer-bench.py [MEGABYTES [BLOBS]]
+#
+# To compare whole pulls instead, run pdk pull from a workspace on
+# this machine with and without PDK_FRAMING=1 in the environment.
+
+import sys
+import os
+import time
+from cStringIO import StringIO
+from pdk.util import Framer, noop
+
+def send_blobs(framer, blobs):
+    """Send blobs the way Cache.send_via_framer does."""
+    for blob_id, data in blobs:
+        framer.write_frame(blob_id)
+        framer.write_handle(StringIO(data))
+        framer.write_stream(['0'])
+    framer.write_stream(['done'])
+    framer.remote_in.flush()
+
+def receive_blobs(framer):
+    """Read blobs the way Cache.import_from_framer does."""
+    total = 0
+    while True:
+        first = framer.read_frame()
+        if first == 'done':
+            framer.assert_end_of_stream()
+            break
+        for frame in framer.iter_stream():
+            total += len(frame)
+        framer.read_frame()
+        framer.assert_end_of_stream()
+    return total
+
+def run(version, blobs):
+    """Return the seconds taken to pass blobs through a framer pair."""
+    read_fd, write_fd = os.pipe()
+    start = time.time()
+    pid = os.fork()
+    if not pid:
+        try:
+            os.close(read_fd)
+            framer = Framer(os.fdopen(write_fd, 'w'), None, noop)
+            framer.set_version(version)
+            send_blobs(framer, blobs)
+            framer.remote_in.close()
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    framer = Framer(None, os.fdopen(read_fd), noop)
+    framer.set_version(version)
+    # read_frame flushes remote_in in version 2.
+    framer.remote_in = StringIO()
+    receive_blobs(framer)
+    os.waitpid(pid, 0)
+    return time.time() - start
+
+def main(args):
+    megabytes = 256
+    count = 64
+    if args:
+        megabytes = int(args[0])
+    if args[1:]:
+        count = int(args[1])
+    blob_size = megabytes * 1024 * 1024 / count
+    blobs = [ ('sha-1:%040d' % index, 'x' * blob_size)
+              for index in range(count) ]
+    for version in (1, 2):
+        seconds = run(version, blobs)
+        print 'framing %d: %d blobs, %d MB in %.2fs, %.1f MB/s' \
+              % (version, count, megabytes, seconds, megabytes / seconds)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
+
+# vim:set ai et sw=4 ts=4 tw=75:
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+#
+# $Progeny$
+#
+#   Copyright 2006 Progeny Linux Systems, Inc.
+#
+#   This file is part of PDK.
+#
+#   PDK is free software; you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   PDK is distributed in the hope that it will be useful, but WITHOUT
+#   ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#   or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+#   License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with PDK; if not, write to the Free Software Foundation,
+#   Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+# order-bench.py - time the graph resolver against the apt resolver on
+#                  the package order picax would compute.
+#
+# usage: order-bench.py PICAX-OPTIONS... REPOSITORY DIST:COMPONENT...
+#
+# The options and arguments are the same as for picax.  Each resolver
+# is timed on the same starting order, and its result is checked so
+# that every package comes after the packages it depends on.
+
+import sys
+import time
+
+import picax.config
+import picax.apt
+import picax.package
+import picax.order
+import picax.depgraph
+
+def check_order(packages, result):
+    """Return the number of dependencies in the result which are
+    placed after the package depending on them."""
+
+    by_name = dict([(pkg["Package"], pkg) for pkg in packages])
+    position = {}
+    for index in range(len(result)):
+        item = result[index]
+        if not isinstance(item, list):
+            item = [item]
+        for name in item:
+            position[name] = index
+
+    late = 0
+    for name in position.keys():
+        pkg = by_name.get(name)
+        if pkg is None:
+            continue
+        for key in ("Pre-Depends", "Depends"):
+            if not pkg.has_key(key):
+                continue
+            for alternatives in picax.depgraph.parse_depends(pkg[key]):
+                placed = [position[x] for x in alternatives
+                          if position.has_key(x)]
+                if placed and min(placed) > position[name]:
+                    late = late + 1
+    return late
+
+def run(name, resolver, packages, start_order):
+    start = time.time()
+    result = resolver(packages, start_order)
+    seconds = time.time() - start
+    print '%s: %d entries in %.2fs, %d late dependencies' \
+          % (name, len(result), seconds, check_order(packages, result))
+
+def main(args):
+    picax.config.handle_args(args)
+    picax.apt.init()
+    (packages, dummy) = picax.package.get_all_distro_packages()
+
+    start_order = []
+    for order_func in picax.order.default_order_funcs[:-1]:
+        start_order = order_func(packages, start_order)
+
+    run('graph', picax.order._order_graph, packages, start_order)
+    run('apt', picax.order._order_apt, packages, start_order)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
+
+# vim:set ai et sw=4 ts=4 tw=75:
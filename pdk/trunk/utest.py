@@ -27,6 +27,7 @@ from pdk.test.test_compile import *
 from pdk.test.test_util import *
 from pdk.test.test_component import *
 from pdk.test.test_cache import *
+from pdk.test.test_cache_gc import *
 from pdk.test.test_audit import *
 from pdk.test.test_channels import *
 from pdk.test.test_rules import *
@@ -38,6 +39,7 @@ from pdk.test.test_index_file import *
 from pdk.test.test_debish_condition import *
 from pdk.test.test_media import *
 from pdk.test.test_commands import *
+from pdk.test.test_query import *
 
 if __name__ == "__main__":
     unittest.main()